@@ -9,28 +9,48 @@ Version:     0.0
 import sys
 import os
 import time
+import functools
 import dcload
+import bench
+import sweepplan
+import runarchive
+import calibration
+import channels
+import hysteresis
+import livebus
+import pipeline
+import resultwriter
+import trafficlog
 from ntbvisa import *
 #import serial
 import matplotlib.pyplot as plt
 
-# DC-Load COM-port
-DCLOAD_COMPORT = "COM8"
-DCLOAD_BAUD = 38400
+# COM port, DMM names and shunt gains of the bench are set in bench.py
 
-# parameters for load sweep
-startCurrent = 1000     #in mA
-endCurrent   = 9000     #in mA
-stepSize     =  1000     #in mA
-shuntGainIin =    1
-shuntGainIout=    1
+# channel file (channels.py) of a bench with other meters, None for the four
+# DMMs of bench.py
+CHANNELS = None
 
-# Set DMM names
-dmm_uin_name =  'TCPIP::128.138.189.186::3490::SOCKET'
-dmm_uout_name = 'TCPIP::128.138.189.69::3490::SOCKET'
+# parameters for load sweep (start/end current, step size, settling time)
+SWEEP_PLAN = "sweep_plan.json"
+LATENCY_LOG = "latencies.json"
 
-dmm_iin_name =  'TCPIP::128.138.189.39::3490::SOCKET'
-dmm_iout_name = 'TCPIP::128.138.189.162::3490::SOCKET'
+# per-range calibration file, None to use the channel gains (shunt gains)
+CALIBRATION = None
+AMBIENT_TEMPERATURE = None      # degC for the temperature terms, None to ignore
+
+# run metadata stored in the run archive
+DUT          = "3-to-1 ladder converter"
+DUT_REVISION = ""
+BENCH        = ""
+RUN_ARCHIVE  = runarchive.DEFAULT_ARCHIVE
+
+# file name to record all instrument traffic to, None to disable
+TRAFFIC_TRACE = None
+
+# shared memory name to publish the points to (livebus.py), None to disable
+LIVE_BUS = None
+LIVE_COLUMNS = ('t', 'setpoint') + bench.COLUMNS
 
 
 def main():
@@ -55,59 +75,86 @@ def main():
     logger.addHandler(ch)
     #------------------------------------------------------------------------------
     
-    # create instance
-    load = dcload.DCLoad()
+    # Open log file
+    try:
+        filename = sys.argv[1]
+    except:
+        timestr = time.strftime("%Y%m%d-%H%M%S")   
+        filename = timestr + ".txt"
+        
+    if os.path.isfile(filename):
+        print('file already exists')
+        return
+
+    # find the instruments by serial number if configured
+    bench.resolve_instruments()
+
+    if not TRAFFIC_TRACE:
+        measure(filename)
+        return
+    recorder = trafficlog.Recorder(TRAFFIC_TRACE)
+    trafficlog.install_recorder(recorder)
+    try:
+        measure(filename)
+    finally:
+        recorder.close()        # keep the trace of a failed run too
+
+
+def measure(filename):
+    ''' Sweep the load, log, archive and plot the efficiency '''
+    # create instance, remembers its settings to save round trips
+    load = dcload.ShadowDCLoad()
+
+    # validate the sweep plan and build all load packets before the run
+    plan = sweepplan.compile_plan(SWEEP_PLAN, bench.DCLOAD_ADDRESS)
+    latency = sweepplan.LatencyRecorder(LATENCY_LOG)
+
+    # meters, calibration and derived values of the bench
+    if CHANNELS:
+        registry = channels.load_registry(CHANNELS)
+    else:
+        registry = channels.default_registry()
+    if CALIBRATION:
+        registry.load_calibration(CALIBRATION)
+    missing = [name for name in bench.COLUMNS if name not in registry.columns]
+    if missing:
+        raise channels.ChannelError('No channel or derived value for ' +
+                                    ', '.join(missing))
+    # the archive only has raw columns for the four bench meters
+    keep_raw = registry.names == calibration.RAW_COLUMNS
+
+    print("Sweep plan: %i points, estimated %.0f s" %
+          (len(plan), plan.estimate_runtime(latency.latencies, len(registry.channels),
+                                            pipelined=True)))
     
     # list for efficiency values for plot
     efficiency = []
     current    = []
-         
-    # DMM Config
-    dmm_u_config = ['CONF:VOLT:DC',
-                          'SENS:VOLT:DC:RANG 100',          #up tp 100V
-                          'TRIG:DEL 0',                     #Set the delay between trigger and measurement
-                          'TRIG:SOUR IMM',                  #Set meter’s trigger source
-                          'SAMP:COUN 1']                    #Set number of samples per trigger
-    
-    dmm_i_config = ['CONF:CURR:DC',
-                          'SENS:CURR:DC:RANG 10',           #up tp 10V
-                          'TRIG:DEL 0',                     #Set the delay between trigger and measurement
-                          'TRIG:SOUR IMM',                  #Set meter’s trigger source
-                          'SAMP:COUN 1']                    #Set number of samples per trigger
-                          
-    #set up digital multimeter
-    time.sleep(1)
-    dmm_uin = NTBResource(dmm_uin_name, dmm_u_config)
-    time.sleep(1)
-    dmm_uout = NTBResource(dmm_uout_name, dmm_u_config)
-    time.sleep(1)
-    dmm_iin = NTBResource(dmm_iin_name, dmm_i_config)
-    time.sleep(1)
-    dmm_iout = NTBResource(dmm_iout_name, dmm_i_config)
-    time.sleep(1)
+    efficiency_down = []    # down ramp of a bidirectional sweep
+    current_down    = []
+    setpoints  = []         # both ramps in measuring order, for the archive
+    raw        = []         # raw readings and ranges for the archive
+
+    #set up digital multimeters, all at once
+    registry.open()
     #dmm_v_name = 'TCPIP0::mmies006::INSTR'     NTB-style
-        
-    setup = NTBSetup([dmm_uin, dmm_uout, dmm_iin, dmm_iout])
-    time.sleep(1)
+
+    # range and NPLC of each meter follow the expected reading
+    ranging = registry.range_setup()
     
     #set up DC load
     print("DC-load, init")
-    load.initialize(DCLOAD_COMPORT, DCLOAD_BAUD) # Open a serial connection
+    load.initialize(bench.DCLOAD_COMPORT, bench.DCLOAD_BAUD, bench.DCLOAD_ADDRESS) # Open a serial connection
     print("DC-load, set remote control", load.setRemoteControl())
-    print("DC-load, set max voltage to 15V", load.setMaxVoltage(15))
-    print("DC-load, set max power to 300W", load.setMaxPower(300))
+    print("DC-load, set max voltage to %gV" % plan.max_voltage,
+          load.setMaxVoltage(plan.max_voltage))
+    print("DC-load, set max power to %gW" % plan.max_power,
+          load.setMaxPower(plan.max_power))
     print("DC-load, to constant current mode", load.setMode('cc'))
-    print("DC-load, set first current", load.setCCCurrent(startCurrent))
-    print("DC-load, turn on", load.turnLoadOn())
-    
-    # Open log file
+    print("DC-load, set first current", load.setCCCurrent(plan.start_current))
     try:
-        filename = sys.argv[1]
-    except:
-        timestr = time.strftime("%Y%m%d-%H%M%S")   
-        filename = timestr + ".txt"
-        
-    if not os.path.isfile(filename):
+        print("DC-load, turn on", load.turnLoadOn())
+
         with open(filename, 'w') as logdata: 
 
             # Print header
@@ -115,87 +162,97 @@ def main():
             print(row_head, file=logdata)
             print(row_head)
             
-            try:
-                for actualCurrent in range(startCurrent, endCurrent + stepSize, stepSize):
-                    #print("Set current to %i mA" % actualCurrent)
-                    load.setCCCurrent(actualCurrent)
-                    time.sleep(2)                               #wait until steady state
-
-                    # Arm and trig the instruments
-                    setup.write_all('INIT')
-                    #setup.write_all('*TRG')
-                            
-                    # Read out the measurment values
-                    res_uin_raw = dmm_uin.query('FETC?', 'values')[0]
-                    res_uout_raw = dmm_uout.query('FETC?', 'values')[0]
-                    res_iin_raw = dmm_iin.query('FETC?', 'values')[0]
-                    res_iout_raw = dmm_iout.query('FETC?', 'values')[0]
-                    
-                    res_time = time.strftime('%H:%M:%S')                    
-                    
-                    #scale if shunt is used
-                    res_uin = res_uin_raw 
-                    res_uout = res_uout_raw
-                    res_iin = res_iin_raw * shuntGainIin
-                    res_iout = res_iout_raw * shuntGainIout
-
-                    #calculate power and efficiency
-                    res_pin = res_uin * res_iin
-                    res_pout = res_uout * res_iout
-                    
-                    try:                                #if division thru zero
-                        res_eff = res_pout / res_pin
-                    except:
-                        res_eff = 0
-                    
-                    #store efficiency for plot
-                    efficiency.append(res_eff)
-                    current.append(actualCurrent/1000)
+            writer = resultwriter.ResultWriter(logdata)
+            bus = livebus.LiveBusWriter(LIVE_BUS, LIVE_COLUMNS) if LIVE_BUS else None
 
-                    
-                    #Save measurements in logfile
-                    row_content = '{0} {1} {2} {3} {4} {5} {6} {7}' \
-                    .format(res_time, res_uin, res_iin, res_pin, res_uout, res_iout, res_pout, res_eff)
-                    print(row_content, file=logdata)
-                    
-                    row_content_console = ("{0},Uin={1:2.3f}V,Iin={2:1.3f}A,Pin={3:3.3f}W,Uout={4:2.3f}V,Iout={5:2.3f}A,Pout={6:3.3f}W,n={7:1.4f}") \
-                    .format(res_time, res_uin, res_iin, res_pin, res_uout, res_iout, res_pout, res_eff)
-                    print(row_content_console)
-                    
+            def store_point(ramp_current, ramp_efficiency, actualCurrent, readings):
+                res_time = time.strftime('%H:%M:%S')                    
+                ranges = ranging.ranges()
+                if keep_raw:
+                    raw.append(list(readings) + ranges + [AMBIENT_TEMPERATURE])
+
+                #calibrate, calculate power and efficiency (0 if Pin is 0)
+                values = registry.evaluate(readings, ranges, AMBIENT_TEMPERATURE)
+                res_uin, res_iin, res_pin, res_uout, res_iout, res_pout, res_eff = \
+                    [float(values[name]) for name in bench.COLUMNS]
+                
+                #store efficiency for plot
+                ramp_efficiency.append(res_eff)
+                ramp_current.append(actualCurrent/1000)
+                setpoints.append(actualCurrent)
+
+                #Save measurements in logfile and show them (writer thread)
+                writer.put((res_time, res_uin, res_iin, res_pin, res_uout, res_iout, res_pout, res_eff))
+                if bus is not None:
+                    bus.publish((time.time(), actualCurrent, res_uin, res_iin, res_pin,
+                                 res_uout, res_iout, res_pout, res_eff))
+
+            # the meters are read out while the load settles at the next point
+            sweep = pipeline.PipelinedSweep(plan, load, registry, ranging, latency,
+                                            check_channel='iout')
+            try:
+                sweep.run(functools.partial(store_point, current, efficiency))
+                if plan.bidirectional:
+                    # measure on the way down too, after a dwell at the top
+                    time.sleep(plan.turnaround_time)
+                    sweep.run(functools.partial(store_point, current_down, efficiency_down),
+                              plan.down_points(), plan.down_settle_time)
                     
             except KeyboardInterrupt:
                 print('Aborted')
+            finally:
+                writer.close()          #write everything still queued
+                if bus is not None:
+                    bus.close()
                 
-  
-        print("close file and disconnect digital multimeter")    
-        logdata.close()
-        setup.close_all()
-        
-        #ramp down current
-        print("Ramp down current")
-        lastCurrentSetting = int(load.getCCCurrent())
-
-        for actualCurrent in range(lastCurrentSetting, startCurrent-stepSize, -stepSize):
-            print("Set current to %i A" % actualCurrent)
-            load.setCCCurrent(actualCurrent)
-            time.sleep(0.1)
-        
-        print("turn off load and set local control")
-        print(load.turnLoadOff())
-        print(load.setLocalControl())
-        
-        plt.figure("Efficiency")
-        plt.title("Efficiency")
-        plt.xlabel('Current [A]')
-        plt.ylabel('Efficiency []')
-        plt.plot(current, efficiency)
-        plt.grid(b=True, which='major', color='b', linestyle='-')
-        plt.show()
-        
-            
-    else:
-        print('file already exists')
+    finally:
+        # the load must not stay on, whatever went wrong above
+        try:
+            #ramp down current
+            print("Ramp down current")
+            lastCurrentSetting = int(load.getCCCurrent())
+
+            for actualCurrent in range(lastCurrentSetting, plan.start_current-plan.step_size, -plan.step_size):
+                print("Set current to %i A" % actualCurrent)
+                load.setCCCurrent(actualCurrent)
+                time.sleep(0.1)
+        finally:
+            print("turn off load and set local control")
+            print(load.turnLoadOff())
+            print(load.setLocalControl())
+
+            print("disconnect digital multimeter")    
+            registry.close()
+            latency.save()
+
+    archive = runarchive.RunArchive(RUN_ARCHIVE)
+    archive.import_log(filename, dut=DUT, revision=DUT_REVISION,
+                       bench=BENCH, shunt_gain_iin=bench.shuntGainIin,
+                       shunt_gain_iout=bench.shuntGainIout, plan=plan.plan,
+                       setpoints=setpoints,
+                       raw=raw if keep_raw else None,
+                       calibration=registry.calibration)
+    archive.close()
 
+    if current_down:
+        rows = hysteresis.compare(current, efficiency, current_down, efficiency_down)
+        hysteresis.write_report(os.path.splitext(filename)[0] + ".hysteresis", rows)
+        print(hysteresis.summary(rows))
+    
+    plt.figure("Efficiency")
+    plt.title("Efficiency")
+    plt.xlabel('Current [A]')
+    plt.ylabel('Efficiency []')
+    if current_down:
+        plt.plot(current, efficiency, label='up')
+        plt.plot(current_down, efficiency_down, label='down')
+        plt.plot(*hysteresis.merge(current, efficiency, current_down, efficiency_down),
+                 'k--', label='mean')
+        plt.legend()
+    else:
+        plt.plot(current, efficiency)
+    plt.grid(b=True, which='major', color='b', linestyle='-')
+    plt.show()
 
 if __name__== "__main__":
     main()
@@ -0,0 +1,228 @@
+"""
+Title:       Batch reprocessing of archived efficiency logs
+Description: Scans a directory tree for the text logs written by
+             Just_Efficiency, parses them with NumPy in a process pool and
+             writes an aggregate report and summary plots.
+Comments:    Per-file results are cached in a JSON file keyed by path.  A
+             file is only parsed again if its content hash changed; size and
+             modification time are checked first so unchanged files are not
+             even read.
+
+Usage:
+    python batchanalysis.py logs/ --report report.txt --plots plots/
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import numpy as np
+import runarchive
+
+DEFAULT_CACHE = '.batchanalysis_cache.json'
+
+# Index of the numeric columns in a log (column 0 is the time of day)
+UIN, IIN, PIN, UOUT, IOUT, POUT, EFF = range(7)
+
+SUMMARY_FIELDS = ('file', 'points', 'peak_eff', 'iout_at_peak', 'mean_eff',
+                  'eff_at_max_iout', 'max_iout', 'mean_uin', 'mean_uout')
+
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_values(filename, data=None):
+    '''Numeric columns of a log as an (n, 7) array.  data is the content
+    of the file if it was read already.
+    '''
+    try:
+        if data is None:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        return np.loadtxt(io.BytesIO(data), skiprows=1, usecols=range(1, 8),
+                          ndmin=2)
+    except ValueError:
+        # truncated or hand edited file, fall back to the tolerant reader
+        rows = runarchive.read_log(filename)
+        return np.array([row[1:] for row in rows],
+                        dtype=float).reshape(-1, 7)
+
+
+def summarize(filename, data=None):
+    ''' Summary dict and the Iout/efficiency curve of one log '''
+    values = read_values(filename, data)
+    summary = {'file': filename, 'points': len(values)}
+    curve = ([], [])
+    if len(values):
+        eff = values[:, EFF]
+        iout = values[:, IOUT]
+        peak = int(np.argmax(eff))
+        full = int(np.argmax(iout))
+        summary.update({
+            'peak_eff': float(eff[peak]),
+            'iout_at_peak': float(iout[peak]),
+            'mean_eff': float(eff.mean()),
+            'eff_at_max_iout': float(eff[full]),
+            'max_iout': float(iout[full]),
+            'mean_uin': float(values[:, UIN].mean()),
+            'mean_uout': float(values[:, UOUT].mean())})
+        curve = (iout.tolist(), eff.tolist())
+    return summary, curve
+
+
+def process(filename):
+    '''summarize() for the process pool.  The file is read once and its
+    size, mtime and hash for the cache are returned with the result.
+    '''
+    stat = os.stat(filename)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    return summarize(filename, data), {
+        'size': stat.st_size, 'mtime': stat.st_mtime,
+        'hash': hashlib.sha1(data).hexdigest()}
+
+
+def find_logs(path, extension='.txt'):
+    for root, dirs, files in os.walk(path):
+        for name in sorted(files):
+            if name.endswith(extension):
+                yield os.path.join(root, name)
+
+
+class ResultCache:
+    ''' Per-file results keyed by path, validated by size, mtime and hash '''
+
+    def __init__(self, filename=DEFAULT_CACHE):
+        self.filename = filename
+        self.entries = {}
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+
+    def lookup(self, filename):
+        ''' Cached (summary, curve) or None if the file changed '''
+        entry = self.entries.get(filename)
+        if entry is None:
+            return None
+        stat = os.stat(filename)
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['summary'], entry['curve']
+        digest = file_hash(filename)
+        if entry['hash'] != digest:
+            return None
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime
+        return entry['summary'], entry['curve']
+
+    def store(self, filename, result, info):
+        ''' info is the size, mtime and hash of the file, see process() '''
+        self.entries[filename] = dict(info, summary=result[0],
+                                      curve=result[1])
+
+    def save(self):
+        with open(self.filename, 'w') as f:
+            json.dump(self.entries, f)
+
+
+def analyze(paths, cache=None, workers=None):
+    ''' Return {file: (summary, curve)} for all logs below paths '''
+    files = []
+    for path in paths:
+        files.extend(find_logs(path) if os.path.isdir(path) else [path])
+    results = {}
+    todo = []
+    for filename in files:
+        cached = cache.lookup(filename) if cache is not None else None
+        if cached is None:
+            todo.append(filename)
+        else:
+            results[filename] = cached
+    if todo:
+        workers = workers or os.cpu_count() or 1
+        chunksize = max(1, len(todo) // (4 * workers))
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            for filename, (result, info) in zip(
+                    todo, pool.map(process, todo, chunksize=chunksize)):
+                results[filename] = result
+                if cache is not None:
+                    cache.store(filename, result, info)
+    return results
+
+
+def write_report(results, filename):
+    with open(filename, 'w') as report:
+        print(' '.join(SUMMARY_FIELDS), file=report)
+        for name in sorted(results):
+            summary = results[name][0]
+            print(' '.join(str(summary.get(field, 'nan'))
+                           for field in SUMMARY_FIELDS), file=report)
+
+
+def aggregate(results):
+    ''' Statistics of the per-file peak efficiencies '''
+    summaries = [summary for summary, curve in results.values()
+                 if 'peak_eff' in summary]
+    if not summaries:
+        return {'files': len(results)}
+    peaks = np.array([summary['peak_eff'] for summary in summaries])
+    best = summaries[int(np.argmax(peaks))]
+    return {'files': len(results), 'median_peak_eff': float(np.median(peaks)),
+            'min_peak_eff': float(peaks.min()),
+            'max_peak_eff': float(peaks.max()), 'best_file': best['file']}
+
+
+def save_plots(results, directory):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    os.makedirs(directory, exist_ok=True)
+    plt.figure("Efficiency")
+    plt.title("Efficiency of {0} runs".format(len(results)))
+    plt.xlabel('Current [A]')
+    plt.ylabel('Efficiency []')
+    for summary, (iout, eff) in results.values():
+        plt.plot(iout, eff, linewidth=0.5, alpha=0.5)
+    plt.grid(True, which='major', color='b', linestyle='-')
+    plt.savefig(os.path.join(directory, 'efficiency_curves.png'), dpi=150)
+    plt.close()
+
+    peaks = [summary['peak_eff'] for summary, curve in results.values()
+             if 'peak_eff' in summary]
+    plt.figure("Peak efficiency")
+    plt.title("Peak efficiency")
+    plt.xlabel('Efficiency []')
+    plt.ylabel('Runs')
+    plt.hist(peaks, bins=50)
+    plt.savefig(os.path.join(directory, 'peak_efficiency.png'), dpi=150)
+    plt.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocess efficiency logs')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--report', default='report.txt')
+    parser.add_argument('--plots', help='directory for summary plots')
+    parser.add_argument('--cache', default=DEFAULT_CACHE)
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else ResultCache(args.cache)
+    results = analyze(args.paths, cache, args.workers)
+    if cache is not None:
+        cache.save()
+    write_report(results, args.report)
+    for key, value in sorted(aggregate(results).items()):
+        print('{0}: {1}'.format(key, value))
+    print('report in {0}'.format(args.report))
+    if args.plots:
+        save_plots(results, args.plots)
+
+
+if __name__ == '__main__':
+    main()
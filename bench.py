@@ -0,0 +1,154 @@
+"""
+Title:       Bench bring-up and single point measurement
+Description: Opens the DC load and the four DMMs (Uin, Uout, Iin, Iout) the
+             same way Just_Efficiency does and measures one operating point.
+             Used by the test modes that do not run a plain sweep.
+Comments:    The COM port, DMM names and shunt gains of the bench are set
+             here and used by Just_Efficiency and all test modes, so the
+             bench is configured in one place.
+"""
+
+import logging
+import time
+import dcload
+import discovery
+from ntbvisa import NTBResource, NTBSetup
+
+logger = logging.getLogger(__name__)
+
+# DMM Config
+DMM_U_CONFIG = ['CONF:VOLT:DC',
+                'SENS:VOLT:DC:RANG 100',    #up tp 100V
+                'TRIG:DEL 0',               #Set the delay between trigger and measurement
+                'TRIG:SOUR IMM',            #Set meter's trigger source
+                'SAMP:COUN 1']              #Set number of samples per trigger
+
+DMM_I_CONFIG = ['CONF:CURR:DC',
+                'SENS:CURR:DC:RANG 10',     #up tp 10A
+                'TRIG:DEL 0',               #Set the delay between trigger and measurement
+                'TRIG:SOUR IMM',            #Set meter's trigger source
+                'SAMP:COUN 1']              #Set number of samples per trigger
+
+# Order of the values returned by Bench.measure()
+COLUMNS = ('uin', 'iin', 'pin', 'uout', 'iout', 'pout', 'eff')
+
+# DC-Load COM-port
+DCLOAD_COMPORT = "COM8"
+DCLOAD_BAUD = 38400
+DCLOAD_ADDRESS = 0
+
+shuntGainIin =    1
+shuntGainIout=    1
+
+# Set DMM names
+dmm_uin_name =  'TCPIP::128.138.189.186::3490::SOCKET'
+dmm_uout_name = 'TCPIP::128.138.189.69::3490::SOCKET'
+
+dmm_iin_name =  'TCPIP::128.138.189.39::3490::SOCKET'
+dmm_iout_name = 'TCPIP::128.138.189.162::3490::SOCKET'
+
+# serial numbers of the instruments, e.g. {'dmm_uin_name': 'MY57200123',
+# 'dcload': '...'}: their VISA names and the COM port are then looked up in
+# the instrument inventory (discovery.py) instead of the settings above
+INSTRUMENT_SERIALS = {}
+INVENTORY = discovery.INVENTORY_FILE
+
+
+def resolve_instruments():
+    ''' Replace the instrument settings by the ones found by serial number '''
+    global DCLOAD_COMPORT, DCLOAD_BAUD, DCLOAD_ADDRESS
+    if not INSTRUMENT_SERIALS:
+        return
+    inventory = discovery.discover(INVENTORY)
+    for setting, serial_number in INSTRUMENT_SERIALS.items():
+        if setting == 'dcload':
+            DCLOAD_COMPORT, DCLOAD_BAUD, DCLOAD_ADDRESS = \
+                inventory.dcload_port(serial_number)
+        else:
+            globals()[setting] = inventory.visa_name(serial_number)
+
+
+class Bench:
+
+    def __init__(self, load_port, load_baud, uin_name, uout_name, iin_name,
+                 iout_name, shunt_gain_iin=1, shunt_gain_iout=1,
+                 load_address=0):
+        self.load_port = load_port
+        self.load_baud = load_baud
+        self.load_address = load_address
+        self.names = (uin_name, uout_name, iin_name, iout_name)
+        self.shunt_gain_iin = shunt_gain_iin
+        self.shunt_gain_iout = shunt_gain_iout
+        self.load = None
+        self.setup = None
+
+    def open(self):
+        ''' Open and configure the DMMs, open the load in remote control '''
+        configs = (DMM_U_CONFIG, DMM_U_CONFIG, DMM_I_CONFIG, DMM_I_CONFIG)
+        meters = []
+        for name, config in zip(self.names, configs):
+            time.sleep(1)
+            meters.append(NTBResource(name, config))
+        self.dmm_uin, self.dmm_uout, self.dmm_iin, self.dmm_iout = meters
+        self.setup = NTBSetup(meters)
+        time.sleep(1)
+
+        self.load = dcload.DCLoad()
+        self.load.initialize(self.load_port, self.load_baud,
+                             self.load_address)
+        logger.info('DC-load, set remote control {0}'.format(
+            self.load.setRemoteControl()))
+
+    def configure_load(self, max_voltage, max_power, mode='cc'):
+        for status in (self.load.setMaxVoltage(max_voltage),
+                       self.load.setMaxPower(max_power),
+                       self.load.setMode(mode)):
+            if status:
+                raise dcload.InstrumentException(status)
+
+    def fetch(self):
+        ''' Raw readings of Uin, Uout, Iin, Iout of the last trigger '''
+        return (self.dmm_uin.query('FETC?', 'values')[0],
+                self.dmm_uout.query('FETC?', 'values')[0],
+                self.dmm_iin.query('FETC?', 'values')[0],
+                self.dmm_iout.query('FETC?', 'values')[0])
+
+    def scale(self, uin, uout, iin_raw, iout_raw):
+        ''' Apply the shunt gains, return the values in COLUMNS order '''
+        iin = iin_raw * self.shunt_gain_iin
+        iout = iout_raw * self.shunt_gain_iout
+        pin = uin * iin
+        pout = uout * iout
+        eff = pout / pin if pin else 0
+        return uin, iin, pin, uout, iout, pout, eff
+
+    def measure(self):
+        ''' Trigger all meters and return the values in COLUMNS order '''
+        self.setup.write_all('INIT')
+        return self.scale(*self.fetch())
+
+    def ramp_down(self, step, floor=0, delay=0.1):
+        ''' Step the CC current (in mA) down from its present setting '''
+        current = int(self.load.getCCCurrent())
+        for setting in range(current, floor - step, -step):
+            self.load.setCCCurrent(max(setting, floor))
+            time.sleep(delay)
+
+    def close(self):
+        ''' Close the DMMs, turn the load off and give it back to local '''
+        if self.setup is not None:
+            self.setup.close_all()
+            self.setup = None
+        if self.load is not None:
+            self.load.turnLoadOff()
+            self.load.setLocalControl()
+            self.load.close()
+            self.load = None
+
+
+def default_bench():
+    ''' Bench with the settings above '''
+    resolve_instruments()
+    return Bench(DCLOAD_COMPORT, DCLOAD_BAUD, dmm_uin_name, dmm_uout_name,
+                 dmm_iin_name, dmm_iout_name, shuntGainIin, shuntGainIout,
+                 DCLOAD_ADDRESS)
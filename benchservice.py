@@ -0,0 +1,278 @@
+"""
+Title:       Bench job-queue service
+Description: Small local service that owns the bench instruments and runs
+             sweep jobs from several users back to back.  The DC load and the
+             DMMs stay open between jobs, so only the first job pays for the
+             bring-up.
+Comments:    asyncio server on localhost (TCP, also works on Windows), one
+             JSON object per line.  Requests:
+                 {"cmd": "submit", "plan": {...}, "priority": 5,
+                  "user": "...", "dut": "...", "revision": "..."}
+                 {"cmd": "status"}
+                 {"cmd": "cancel", "id": 3}
+             A submitting client receives "queued", "started", one "point"
+             per measurement and finally "done" or "error" for its job.
+             Lower priority numbers run first, equal priorities in order of
+             submission.  Results are stored in the run archive.
+
+Usage:
+    python benchservice.py serve
+    python benchservice.py submit sweep_plan.json --priority 1 --dut ladder
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import logging
+import time
+import bench
+import runarchive
+import sweepplan
+
+logger = logging.getLogger(__name__)
+
+HOST = '127.0.0.1'
+PORT = 5025 + 1000          # SCPI raw socket port + 1000
+
+
+class Job:
+
+    def __init__(self, job_id, request, address=0):
+        self.id = job_id
+        self.priority = int(request.get('priority', 5))
+        self.user = request.get('user', '')
+        self.dut = request.get('dut')
+        self.revision = request.get('revision')
+        self.plan = sweepplan.CompiledPlan(
+            sweepplan.load_plan_dict(request['plan']), address)
+        self.state = 'queued'
+        self.cancelled = False
+        self.listeners = []
+
+    def describe(self):
+        return {'id': self.id, 'priority': self.priority, 'user': self.user,
+                'dut': self.dut, 'state': self.state, 'points': len(self.plan)}
+
+
+class BenchService:
+
+    def __init__(self, test_bench, archive_file=runarchive.DEFAULT_ARCHIVE,
+                 bench_name=None):
+        self.bench = test_bench
+        self.bench_name = bench_name
+        self.bench_open = False
+        self.archive_file = archive_file
+        self.queue = None           # created in the running loop by serve()
+        # sweeps run in this thread, one at a time
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.running = None         # job whose sweep is in the executor
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.sequence = itertools.count()
+
+    async def handle_client(self, reader, writer):
+        ''' One connection, requests and events as JSON lines '''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    await self.handle_request(request, writer)
+                except (ValueError, KeyError, sweepplan.PlanError) as e:
+                    await self.send(writer, {'event': 'error',
+                                             'message': str(e)})
+        except ConnectionError:
+            pass
+        finally:
+            for job in self.jobs.values():
+                if writer in job.listeners:
+                    job.listeners.remove(writer)
+            writer.close()
+
+    async def handle_request(self, request, writer):
+        cmd = request['cmd']
+        if cmd == 'submit':
+            job = Job(next(self.ids), request, self.bench.load_address)
+            job.listeners.append(writer)
+            self.jobs[job.id] = job
+            await self.queue.put((job.priority, next(self.sequence), job))
+            await self.send(writer, dict(job.describe(), event='queued'))
+        elif cmd == 'status':
+            await self.send(writer, {
+                'event': 'status',
+                'jobs': [job.describe() for job in self.jobs.values()
+                         if job.state in ('queued', 'running')]})
+        elif cmd == 'cancel':
+            job = self.jobs[int(request['id'])]
+            job.cancelled = True
+            await self.send(writer, dict(job.describe(), event='cancelling'))
+        else:
+            raise ValueError('Unknown command {0}'.format(cmd))
+
+    async def send(self, writer, message):
+        writer.write((json.dumps(message) + '\n').encode('utf-8'))
+        await writer.drain()
+
+    def publish(self, job, message):
+        ''' Send an event to all clients following the job '''
+        message['job'] = job.id
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        for writer in list(job.listeners):
+            if writer.is_closing():
+                job.listeners.remove(writer)
+            else:
+                writer.write(data)
+
+    async def run_jobs(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, sequence, job = await self.queue.get()
+            if job.cancelled:
+                job.state = 'cancelled'
+                self.publish(job, {'event': 'cancelled'})
+                continue
+            job.state = 'running'
+            self.publish(job, {'event': 'started'})
+            self.running = job
+            try:
+                rows = await loop.run_in_executor(self.executor,
+                                                  self.run_sweep, job, loop)
+                job.state = 'cancelled' if job.cancelled else 'done'
+                self.publish(job, {'event': job.state, 'rows': rows})
+            except Exception as e:
+                logger.exception('Job {0} failed'.format(job.id))
+                job.state = 'error'
+                self.publish(job, {'event': 'error', 'message': str(e)})
+                self.close_bench()
+            # not reached when run_jobs is cancelled: shutdown() then
+            # still sees the sweep running in the executor
+            self.running = None
+
+    def run_sweep(self, job, loop):
+        ''' Executor thread: measure the job's plan, return the rows '''
+        if not self.bench_open:
+            self.bench.open()
+            self.bench_open = True
+        plan = job.plan
+        load = self.bench.load
+        self.bench.configure_load(plan.max_voltage, plan.max_power, 'cc')
+        load.setCCCurrent(plan.start_current)
+        load.turnLoadOn()
+        rows = []
+        setpoints = []
+        ramps = [(plan.points(), plan.settle_time)]
+        if plan.bidirectional:
+            ramps.append((plan.down_points(), plan.down_settle_time))
+        try:
+            for ramp, (points, settle_time) in enumerate(ramps):
+                if ramp and not job.cancelled:
+                    time.sleep(plan.turnaround_time)
+                for current, packet in points:
+                    if job.cancelled:
+                        break
+                    load.sendPrepared(packet, "Set CC current")
+                    time.sleep(settle_time)
+                    values = self.bench.measure()
+                    row = [time.strftime('%H:%M:%S')] + list(values)
+                    rows.append(row)
+                    setpoints.append(current)
+                    loop.call_soon_threadsafe(self.publish, job, {
+                        'event': 'point', 'setpoint': current, 'values': row})
+        finally:
+            try:
+                self.bench.ramp_down(plan.step_size)
+            finally:
+                load.turnLoadOff()
+        archive = runarchive.RunArchive(self.archive_file)
+        archive.add_run(rows, dut=job.dut, revision=job.revision,
+                        bench=self.bench_name, plan=plan.plan, setpoints=setpoints,
+                        shunt_gain_iin=self.bench.shunt_gain_iin,
+                        shunt_gain_iout=self.bench.shunt_gain_iout)
+        archive.close()
+        return rows
+
+    def close_bench(self):
+        if self.bench_open:
+            self.bench_open = False
+            self.bench.close()
+
+    def shutdown(self):
+        '''Cancel the running job, wait until its sweep has turned the load
+        off and close the bench.
+        '''
+        if self.running is not None:
+            self.running.cancelled = True
+        self.executor.shutdown(wait=True)
+        self.close_bench()
+
+
+async def serve(service, host=HOST, port=PORT):
+    # before Python 3.10 a queue is bound to the loop running at its creation
+    service.queue = asyncio.PriorityQueue()
+    server = await asyncio.start_server(service.handle_client, host, port)
+    worker = asyncio.ensure_future(service.run_jobs())
+    logger.info('Bench service on {0}:{1}'.format(host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+        service.shutdown()
+
+
+async def submit(request, host=HOST, port=PORT):
+    ''' Submit a job and print its events until it is finished '''
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write((json.dumps(request) + '\n').encode('utf-8'))
+    await writer.drain()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        event = json.loads(line)
+        if event['event'] == 'point':
+            print(' '.join(str(value) for value in event['values']))
+        else:
+            print(event['event'], {k: v for k, v in event.items()
+                                   if k not in ('event', 'rows')})
+        if event['event'] in ('done', 'error', 'cancelled'):
+            break
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bench job-queue service')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve')
+    sub = commands.add_parser('submit')
+    sub.add_argument('plan', help='sweep plan file')
+    sub.add_argument('--priority', type=int, default=5)
+    sub.add_argument('--user', default='')
+    sub.add_argument('--dut')
+    sub.add_argument('--revision')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        logging.basicConfig(level=logging.INFO)
+        service = BenchService(bench.default_bench())
+        try:
+            asyncio.run(serve(service, args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'submit':
+        request = {'cmd': 'submit', 'plan': sweepplan.load_plan(args.plan),
+                   'priority': args.priority, 'user': args.user,
+                   'dut': args.dut, 'revision': args.revision}
+        asyncio.run(submit(request, args.host, args.port))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Title:       Per-range calibration of the measurement channels
+Description: Gain, offset, nonlinearity and temperature coefficient per
+             channel and meter range.  The tables are compiled once into
+             NumPy arrays and applied to whole blocks of raw readings, so
+             the correction costs the same for one point or a full run.
+Comments:    Calibration file (JSON), ranges as in the SENS:...:RANG
+             command, "*" for all other ranges of a channel:
+                 {"iout": {"10": {"gain": 1.0002, "offset": -0.0004,
+                                  "nonlinearity": [[0, 0], [5, 1e-4],
+                                                   [10, 3e-4]],
+                                  "tempco": 2e-5,
+                                  "reference_temperature": 23}},
+                  "uin": {"*": {"gain": 1, "offset": 0}}}
+             value = raw * gain * (1 + tempco * (T - Tref)) + offset
+                     + nonlinearity(raw)
+             The nonlinearity is interpolated linearly between the table
+             points and held constant outside.  A channel gain includes the
+             shunt if one is used; from_shunt_gains() gives the calibration
+             that matches the old shuntGainIin/shuntGainIout scaling.
+             The channels are the four bench meters (RAW_COLUMNS) unless
+             other columns are given, e.g. the channel names of a
+             channels.ChannelRegistry.
+"""
+
+import functools
+import json
+import os
+import numpy as np
+
+# Channels of the raw readings, in the order the meters are fetched
+RAW_COLUMNS = ('uin', 'uout', 'iin', 'iout')
+
+ANY_RANGE = '*'
+
+
+class CalibrationError(Exception):
+    pass
+
+
+class ChannelCalibration:
+    ''' The compiled tables of one channel '''
+
+    def __init__(self, name, ranges):
+        self.name = name
+        default = ranges.get(ANY_RANGE, {})
+        self.ranges = np.array(sorted(float(r) for r in ranges
+                                      if r != ANY_RANGE))
+        entries = [ranges[key] for key in sorted(
+            (r for r in ranges if r != ANY_RANGE), key=float)] + [default]
+        # last entry is the fallback for ranges without a table
+        self.gain = np.array([e.get('gain', 1.0) for e in entries])
+        self.offset = np.array([e.get('offset', 0.0) for e in entries])
+        self.tempco = np.array([e.get('tempco', 0.0) for e in entries])
+        self.reference = np.array([e.get('reference_temperature', 23.0)
+                                   for e in entries])
+        self.nonlinearity = []
+        for entry in entries:
+            table = np.array(entry.get('nonlinearity') or [], dtype=float)
+            if table.size and (table.ndim != 2 or table.shape[1] != 2 or
+                               np.any(np.diff(table[:, 0]) <= 0)):
+                raise CalibrationError(
+                    '{0}: nonlinearity must be [[raw, correction], ...] '
+                    'with increasing raw values'.format(name))
+            self.nonlinearity.append(
+                (table[:, 0], table[:, 1]) if table.size else None)
+
+    def entry_index(self, ranges):
+        ''' Table index for each range, the fallback for unknown ranges '''
+        fallback = len(self.ranges)
+        if ranges is None or not len(self.ranges):
+            return np.full(np.shape(ranges), fallback, dtype=int)
+        ranges = np.asarray(ranges, dtype=float)
+        index = np.minimum(np.searchsorted(self.ranges, ranges),
+                           fallback - 1)
+        return np.where(self.ranges[index] == ranges, index, fallback)
+
+    def apply(self, raw, ranges=None, temperature=None):
+        raw = np.asarray(raw, dtype=float)
+        index = np.broadcast_to(self.entry_index(ranges), raw.shape)
+        gain = self.gain[index]
+        if temperature is not None:
+            gain = gain * (1 + self.tempco[index] *
+                           (temperature - self.reference[index]))
+        value = raw * gain + self.offset[index]
+        for i in np.unique(index):
+            if self.nonlinearity[i] is not None:
+                x, y = self.nonlinearity[i]
+                value = value + np.where(index == i, np.interp(raw, x, y), 0)
+        return value
+
+
+class Calibration:
+
+    def __init__(self, tables, source=None, columns=RAW_COLUMNS):
+        self.columns = tuple(columns)
+        unknown = set(tables) - set(self.columns)
+        if unknown:
+            raise CalibrationError('Unknown channels {0}'.format(
+                ', '.join(sorted(unknown))))
+        self.tables = tables
+        self.source = source
+        self.channels = [ChannelCalibration(name, tables.get(name, {}))
+                         for name in self.columns]
+
+    def apply(self, raw, ranges=None, temperature=None):
+        '''Calibrate raw readings, an (n, len(columns)) array or one row.
+        ranges has the same shape (or is None, a range of None or NaN uses
+        the "*" table), temperature is a scalar or one value per row in
+        degC (None: no temperature term).
+        '''
+        raw = np.asarray(raw, dtype=float)
+        result = np.empty_like(raw)
+        if temperature is not None and np.ndim(temperature):
+            temperature = np.asarray(temperature, dtype=float)
+        for column, channel in enumerate(self.channels):
+            channel_ranges = None
+            if ranges is not None:
+                channel_ranges = np.asarray(ranges, dtype=float)[..., column]
+            result[..., column] = channel.apply(raw[..., column],
+                                                channel_ranges, temperature)
+        return result
+
+    def evaluate(self, raw, ranges=None, temperature=None):
+        '''Calibrated rows in bench.COLUMNS order (uin, iin, pin, uout,
+        iout, pout, eff)
+        '''
+        values = self.apply(raw, ranges, temperature)
+        uin, uout, iin, iout = (values[..., self.columns.index(name)]
+                                for name in RAW_COLUMNS)
+        pin = uin * iin
+        pout = uout * iout
+        with np.errstate(divide='ignore', invalid='ignore'):
+            eff = np.where(pin != 0, pout / pin, 0.0)
+        return np.stack((uin, iin, pin, uout, iout, pout, eff), axis=-1)
+
+    def dumps(self):
+        return json.dumps(self.tables, sort_keys=True)
+
+
+@functools.lru_cache(maxsize=8)
+def compile_file(filename, mtime, columns):
+    with open(filename) as f:
+        return Calibration(json.load(f), filename, columns)
+
+
+def load_calibration(filename, columns=RAW_COLUMNS):
+    ''' Compiled calibration of a file, compiled again when it changes '''
+    filename = os.path.abspath(filename)
+    return compile_file(filename, os.path.getmtime(filename), tuple(columns))
+
+
+def from_shunt_gains(shunt_gain_iin=1, shunt_gain_iout=1):
+    return Calibration({'iin': {ANY_RANGE: {'gain': shunt_gain_iin}},
+                        'iout': {ANY_RANGE: {'gain': shunt_gain_iout}}})
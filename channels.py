@@ -0,0 +1,302 @@
+"""
+Title:       Channel registry for benches with any number of meters
+Description: Declares the measurement channels of a bench (name, role, VISA
+             address, DMM config and calibration) and the derived values as
+             expressions of the channel names, e.g. "pin": "uin * iin".
+             All channels are fetched in parallel, readings are stored as
+             rows of a NumPy array and the derived values are evaluated on
+             whole columns.
+Comments:    Channel file (JSON):
+                 {"channels": [
+                     {"name": "uin", "role": "voltage",
+                      "address": "TCPIP::128.138.189.186::3490::SOCKET"},
+                     {"name": "iin", "role": "current", "address": "...",
+                      "gain": 1, "offset": 0},
+                     {"name": "iout", "role": "current", "address": "...",
+                      "calibration": {"10": {"gain": 1.0002},
+                                      "*": {"gain": 1}}},
+                     {"name": "vmid", "role": "voltage", "address": "...",
+                      "config": ["CONF:VOLT:DC 10", "TRIG:SOUR IMM"]}],
+                  "derived": {"pin": "uin * iin",
+                              "pout": "uout1 * iout1 + uout2 * iout2",
+                              "eff": "pout / pin"},
+                  "scpi": {"arm": "INIT", "fetch": "FETC?"}}
+             A channel without "config" gets the bench config of its role,
+             its range and NPLC then follow the readings (rangeschedule.py).
+             "calibration" is the channel's per-range table as in a
+             calibration file (calibration.py), "gain" and "offset" are
+             short for {"*": {"gain": ..., "offset": ...}}.
+             Derived values may use channels and derived values declared
+             before them, numbers, + - * / ** and abs, sqrt, minimum,
+             maximum.  A division by zero gives 0 like in Bench.scale().
+"""
+
+import ast
+import concurrent.futures
+import json
+import logging
+import numpy as np
+import bench
+import rangeschedule
+from calibration import ANY_RANGE, Calibration, load_calibration
+from ntbvisa import NTBResource, NTBSetup
+
+logger = logging.getLogger(__name__)
+
+# Config of a channel that does not declare its own
+ROLE_CONFIGS = {'voltage': bench.DMM_U_CONFIG, 'current': bench.DMM_I_CONFIG}
+
+# Function, ranges and configured range of the role configs, for ranging
+ROLE_RANGES = {'voltage': ('VOLT', rangeschedule.VOLT_RANGES, 100),
+               'current': ('CURR', rangeschedule.CURR_RANGES, 10)}
+
+# Functions allowed in derived expressions
+FUNCTIONS = {'abs': np.abs, 'sqrt': np.sqrt, 'minimum': np.minimum,
+             'maximum': np.maximum}
+
+EXPRESSION_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Name,
+                    ast.Load, ast.Constant, ast.Call, ast.Add, ast.Sub,
+                    ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+
+
+class ChannelError(Exception):
+    pass
+
+
+class Channel:
+
+    def __init__(self, name, role, address, config=None, gain=1, offset=0,
+                 calibration=None):
+        self.name = name
+        self.role = role
+        self.address = address
+        self.ranged = config is None    # role config, known ranges
+        if config is None:
+            if role not in ROLE_CONFIGS:
+                raise ChannelError('{0}: no config for role {1}'.format(
+                    name, role))
+            config = ROLE_CONFIGS[role]
+        self.config = list(config)
+        if calibration is None:
+            calibration = {ANY_RANGE: {'gain': gain, 'offset': offset}}
+        self.calibration = calibration  # per-range table
+        self.resource = None
+
+    def open(self):
+        self.resource = NTBResource(self.address, self.config)
+        return self.resource
+
+    def read(self, fetch):
+        ''' Raw reading of the last trigger '''
+        return self.resource.query(fetch, 'values')[0]
+
+    def wait(self):
+        ''' Wait until the triggered measurement is complete '''
+        return self.resource.query('*OPC?')
+
+    def scheduler(self):
+        ''' RangeScheduler of the channel, None if its ranges are unknown '''
+        if not self.ranged:
+            return None
+        function, ranges, initial_range = ROLE_RANGES[self.role]
+        return rangeschedule.RangeScheduler(self.resource, function, ranges,
+                                            initial_range)
+
+
+class Derived:
+    ''' A value computed from channel columns '''
+
+    def __init__(self, name, expression, known):
+        self.name = name
+        self.expression = expression
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError as e:
+            raise ChannelError('{0}: {1}'.format(name, e))
+        self.inputs = []
+        for node in ast.walk(tree):
+            if not isinstance(node, EXPRESSION_NODES):
+                raise ChannelError('{0}: {1} not allowed in "{2}"'.format(
+                    name, type(node).__name__, expression))
+            if isinstance(node, ast.Call) and not (
+                    isinstance(node.func, ast.Name) and
+                    node.func.id in FUNCTIONS):
+                raise ChannelError('{0}: unknown function in "{1}"'.format(
+                    name, expression))
+            if isinstance(node, ast.Name) and node.id not in FUNCTIONS:
+                if node.id not in known:
+                    raise ChannelError('{0}: "{1}" is not declared before'
+                                       .format(name, node.id))
+                self.inputs.append(node.id)
+        self.code = compile(tree, '<{0}>'.format(name), 'eval')
+
+    def evaluate(self, columns):
+        namespace = dict(FUNCTIONS)
+        namespace.update((key, columns[key]) for key in self.inputs)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value = eval(self.code, {'__builtins__': {}}, namespace)
+        value = np.asarray(value, dtype=float)
+        return np.where(np.isfinite(value), value, 0.0)
+
+
+class Records:
+    ''' Rows of raw channel readings in a growing float64 array '''
+
+    def __init__(self, columns, capacity=256):
+        self.columns = tuple(columns)
+        self.data = np.empty((capacity, len(self.columns)))
+        self.count = 0
+
+    def append(self, row):
+        if self.count == len(self.data):
+            self.data = np.concatenate((self.data, np.empty_like(self.data)))
+        self.data[self.count] = row
+        self.count += 1
+
+    @property
+    def array(self):
+        return self.data[:self.count]
+
+    def __len__(self):
+        return self.count
+
+
+class ChannelRegistry:
+    '''The channels of a bench.  The raw readings are calibrated with
+    calibration, by default the tables of the channels.
+    '''
+
+    def __init__(self, channels, derived=None, arm='INIT', fetch='FETC?',
+                 calibration=None):
+        self.channels = list(channels)
+        names = [channel.name for channel in self.channels]
+        if len(set(names)) != len(names):
+            raise ChannelError('Channel names must be unique')
+        self.names = tuple(names)
+        if calibration is None:
+            calibration = Calibration(
+                {channel.name: channel.calibration
+                 for channel in self.channels}, columns=self.names)
+        self.calibration = calibration
+        self.derived = []
+        known = set(names)
+        for name, expression in (derived or {}).items():
+            if name in known:
+                raise ChannelError('{0} declared twice'.format(name))
+            self.derived.append(Derived(name, expression, known))
+            known.add(name)
+        self.columns = self.names + tuple(d.name for d in self.derived)
+        self.arm = arm.encode('ascii') + b'\n'
+        self.fetch_command = fetch
+        self.setup = None
+        self.executor = None
+
+    def open(self):
+        ''' Open and configure all meters in parallel '''
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(self.channels), thread_name_prefix='channel')
+        meters = list(self.executor.map(Channel.open, self.channels))
+        self.setup = NTBSetup(meters)
+        logger.info('{0} channels open'.format(len(meters)))
+
+    def resource(self, name):
+        return self.channels[self.names.index(name)].resource
+
+    def load_calibration(self, filename):
+        ''' Calibrate with a calibration file instead of the channel tables '''
+        self.calibration = load_calibration(filename, self.names)
+
+    def range_setup(self):
+        '''RangeSetup in channel order, channels with their own config
+        stay on their configured range.
+        '''
+        return rangeschedule.RangeSetup([channel.scheduler()
+                                         for channel in self.channels])
+
+    def trigger(self, arm=None):
+        self.setup.write_raw_all(self.arm if arm is None else arm)
+
+    def wait(self):
+        ''' Wait until all channels have completed the measurement '''
+        list(self.executor.map(Channel.wait, self.channels))
+
+    def fetch(self, command=None):
+        ''' Raw readings of all channels, fetched in parallel '''
+        command = command or self.fetch_command
+        return np.fromiter(
+            self.executor.map(lambda channel: channel.read(command),
+                              self.channels),
+            dtype=float, count=len(self.channels))
+
+    def records(self, capacity=256):
+        return Records(self.names, capacity)
+
+    def measure(self, records=None):
+        ''' Trigger and fetch all channels, the raw row is also recorded '''
+        self.trigger()
+        row = self.fetch()
+        if records is not None:
+            records.append(row)
+        return row
+
+    def evaluate(self, raw, ranges=None, temperature=None):
+        '''Calibrated channels and derived values of raw rows (one row or an
+        (n, channels) array), as a dict of columns.  ranges and temperature
+        as in Calibration.apply().
+        '''
+        values = self.calibration.apply(raw, ranges, temperature)
+        columns = {name: values[..., i] for i, name in enumerate(self.names)}
+        for derived in self.derived:
+            columns[derived.name] = derived.evaluate(columns)
+        return columns
+
+    def table(self, raw, ranges=None, temperature=None):
+        ''' evaluate() as an array with the columns in self.columns order '''
+        columns = self.evaluate(raw, ranges, temperature)
+        return np.stack([columns[name] for name in self.columns], axis=-1)
+
+    def close(self):
+        if self.setup is not None:
+            self.setup.close_all()
+            self.setup = None
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def registry_from_dict(spec, source='channels'):
+    if not spec.get('channels'):
+        raise ChannelError('{0}: no channels'.format(source))
+    channels = []
+    for entry in spec['channels']:
+        try:
+            channels.append(Channel(entry['name'], entry.get('role'),
+                                    entry['address'], entry.get('config'),
+                                    entry.get('gain', 1),
+                                    entry.get('offset', 0),
+                                    entry.get('calibration')))
+        except KeyError as e:
+            raise ChannelError('{0}: channel without {1}'.format(source, e))
+    scpi = spec.get('scpi', {})
+    return ChannelRegistry(channels, spec.get('derived'),
+                           scpi.get('arm', 'INIT'), scpi.get('fetch', 'FETC?'))
+
+
+def load_registry(filename):
+    with open(filename) as f:
+        return registry_from_dict(json.load(f), filename)
+
+
+def default_registry():
+    '''The four meters of the bench as a registry, channels in
+    calibration.RAW_COLUMNS order.  Call bench.resolve_instruments() first
+    if the meters are found by serial number.
+    '''
+    return ChannelRegistry(
+        [Channel('uin', 'voltage', bench.dmm_uin_name),
+         Channel('uout', 'voltage', bench.dmm_uout_name),
+         Channel('iin', 'current', bench.dmm_iin_name,
+                 gain=bench.shuntGainIin),
+         Channel('iout', 'current', bench.dmm_iout_name,
+                 gain=bench.shuntGainIout)],
+        {'pin': 'uin * iin', 'pout': 'uout * iout', 'eff': 'pout / pin'})
@@ -0,0 +1,252 @@
+"""
+Title:       Shared serial bus for several DC loads
+Description: One DCLoadBus owns the serial port (e.g. an RS-485 adapter) and
+             serialises the 26 byte transactions of several addressed
+             DCLoad front-ends over it.
+Comments:    Requests are handled by a single worker thread, so callers
+             never hold a lock on the port and frames of different loads or
+             threads cannot interleave.  Responses are matched to the
+             request by the address byte; frames from other addresses are
+             dropped.
+             Requests are served by priority, in order within a priority:
+             turning a load off (SAFETY) before setpoints and other commands
+             (SETPOINT) before the polls of monitor front-ends (TELEMETRY).
+             A poll that waited longer than its max_age is dropped, the same
+             poll queued twice is sent once, and cancel_polls() drops the
+             queued polls.  metrics() gives the queue depths and waiting
+             times per priority.
+
+Usage:
+    bus = DCLoadBus("COM8", 38400)
+    load1 = bus.load(1)
+    load2 = bus.load(2)
+    load1.setCCCurrent(1000)
+    ...
+    bus.close()
+
+    # one load, set by the sweep and polled by a monitoring thread
+    bus = DCLoadBus("COM8", 38400)
+    load = bus.load(0)
+    monitor = bus.monitor(0, max_age=0.5)   # in the other thread
+    monitor.getInputValues()
+"""
+
+import itertools
+import logging
+import queue
+import threading
+import time
+import dcload
+
+logger = logging.getLogger(__name__)
+
+# Request priorities, lower is served first
+SAFETY = 0
+SETPOINT = 1
+TELEMETRY = 2
+PRIORITY_NAMES = {SAFETY: 'safety', SETPOINT: 'setpoint',
+                  TELEMETRY: 'telemetry'}
+STOP = 9                    # after all pending requests
+
+
+class StaleRequest(dcload.InstrumentException):
+    ''' A poll that was cancelled or waited too long in the queue '''
+    pass
+
+
+class BusRequest:
+    ''' A single command/response transaction waiting for the bus '''
+
+    def __init__(self, address, command, deadline=None, priority=SETPOINT,
+                 max_age=None):
+        self.address = address
+        self.command = command
+        self.deadline = deadline
+        self.priority = priority
+        self.max_age = max_age
+        self.queued = time.monotonic()
+        self.cancelled = False
+        self.response = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BusDCLoad(dcload.DCLoad):
+    ''' DCLoad front-end whose commands are sent through a DCLoadBus '''
+
+    def __init__(self, bus, address, priority=SETPOINT, max_age=None):
+        self.bus = bus
+        self.address = address
+        self.priority = priority
+        self.max_age = max_age
+
+    def initialize(self, com_port=None, baudrate=None, address=None):
+        ''' The port is owned by the bus, nothing to open '''
+        if address is not None:
+            self.address = address
+
+    def close(self):
+        ''' Detach from the bus, the port stays open for the other loads '''
+        if self.bus.loads.get(self.address) is self:
+            self.bus.detach(self.address)
+
+    def flushInput(self):
+        ''' Input is flushed by the bus before every transaction '''
+        pass
+
+    def sendCommand(self, command1, deadline=None):
+        '''Queues the command on the bus and returns the 26 byte response
+        once the bus has handled it.
+        '''
+        priority = self.priority
+        if command1[2] == chr(0x21) and command1[3] == chr(0):
+            priority = SAFETY                   # turn load off
+        return self.bus.transact(self.address, command1, deadline, priority,
+                                 self.max_age if priority == TELEMETRY
+                                 else None)
+
+
+class DCLoadBus(dcload.InstrumentInterface):
+
+    def __init__(self, com_port, baudrate):
+        self.initialize(com_port, baudrate)
+        self.loads = {}
+        self.requests = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.polls = {}             # (address, command) -> queued poll
+        self.closed = False
+        self.depth = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.max_depth = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.handled = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.dropped = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.wait_time = dict.fromkeys(PRIORITY_NAMES, 0.0)
+        self.worker = threading.Thread(target=self.run,
+                                       name='DCLoadBus ' + str(com_port))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def load(self, address):
+        ''' Return the DCLoad front-end for the load at address '''
+        if address in self.loads:
+            raise dcload.InstrumentException(
+                "Address %d already attached to the bus" % address)
+        if not 0 <= address < 0xff:
+            raise dcload.InstrumentException("Invalid address %d" % address)
+        self.loads[address] = BusDCLoad(self, address)
+        logger.debug('Load {0} attached'.format(address))
+        return self.loads[address]
+
+    def monitor(self, address, max_age=None):
+        '''Return an additional front-end for the load at address whose
+        commands are telemetry polls.  Polls older than max_age seconds are
+        not sent.
+        '''
+        return BusDCLoad(self, address, TELEMETRY, max_age)
+
+    def detach(self, address):
+        self.loads.pop(address, None)
+        logger.debug('Load {0} detached'.format(address))
+
+    def transact(self, address, command, deadline=None, priority=SETPOINT,
+                 max_age=None):
+        '''Queue a command for the load at address, wait until the worker
+        has handled it and return the response or raise its error.
+        '''
+        with self.lock:
+            if self.closed:
+                raise dcload.InstrumentException('Bus is closed')
+            request = None
+            if priority == TELEMETRY:
+                request = self.polls.get((address, command))
+            if request is None or request.cancelled:
+                request = BusRequest(address, command, deadline, priority,
+                                     max_age)
+                if priority == TELEMETRY:
+                    self.polls[(address, command)] = request
+                self.depth[priority] += 1
+                self.max_depth[priority] = max(self.max_depth[priority],
+                                               self.depth[priority])
+                self.requests.put((priority, next(self.sequence), request))
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.response
+
+    def cancel_polls(self, address=None):
+        ''' Drop the queued telemetry polls (of one load or all loads) '''
+        with self.lock:
+            for key, request in list(self.polls.items()):
+                if address is None or key[0] == address:
+                    request.cancelled = True
+                    del self.polls[key]
+
+    def queue_depth(self):
+        ''' Number of queued requests per priority name '''
+        with self.lock:
+            return {PRIORITY_NAMES[p]: n for p, n in self.depth.items()}
+
+    def metrics(self):
+        '''Queue depth, largest depth, handled and dropped requests and
+        the mean waiting time in s, per priority name.
+        '''
+        with self.lock:
+            return {PRIORITY_NAMES[p]: {
+                'depth': self.depth[p], 'max_depth': self.max_depth[p],
+                'handled': self.handled[p], 'dropped': self.dropped[p],
+                'mean_wait': (self.wait_time[p] / self.handled[p]
+                              if self.handled[p] else 0.0)}
+                for p in PRIORITY_NAMES}
+
+    def next_request(self):
+        '''Take the next request from the queue, drop cancelled and stale
+        polls.  Return None to stop.
+        '''
+        while True:
+            priority, sequence, request = self.requests.get()
+            if request is None:
+                return None
+            waited = time.monotonic() - request.queued
+            with self.lock:
+                self.depth[priority] -= 1
+                key = (request.address, request.command)
+                if self.polls.get(key) is request:
+                    del self.polls[key]
+                stale = request.cancelled or (
+                    request.max_age is not None and waited > request.max_age)
+                if stale:
+                    self.dropped[priority] += 1
+                else:
+                    self.handled[priority] += 1
+                    self.wait_time[priority] += waited
+            if not stale:
+                return request
+            request.error = StaleRequest('Poll dropped after {0:.3f} s'
+                                         .format(waited))
+            request.done.set()
+
+    def run(self):
+        ''' Worker thread: handle the queued requests one at a time '''
+        while True:
+            request = self.next_request()
+            if request is None:
+                break
+            # readFrame() only accepts frames from self.address
+            self.address = request.address
+            try:
+                request.response = dcload.InstrumentInterface.sendCommand(
+                    self, request.command, request.deadline)
+            except Exception as e:
+                request.error = e
+            request.done.set()
+
+    def close(self):
+        ''' Stop the worker after the pending requests and close the port '''
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.requests.put((STOP, next(self.sequence), None))
+        self.worker.join()
+        self.loads.clear()
+        dcload.InstrumentInterface.close(self)
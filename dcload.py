@@ -56,11 +56,30 @@ except:
 out = sys.stdout.write
 nl = "\n"
 
+# Opens the serial port in InstrumentInterface.initialize().  Can be
+# replaced, e.g. by trafficlog to record or replay the traffic.
+port_factory = serial.Serial
+
 
 class InstrumentException(Exception):
     pass
 
 
+class InstrumentTimeout(InstrumentException):
+    '''No complete response frame arrived before the command deadline.'''
+    pass
+
+
+class FramingError(InstrumentException):
+    '''A packet had the wrong length, header or reply code.'''
+    pass
+
+
+class ChecksumError(FramingError):
+    '''A response frame was found but its checksum did not match.'''
+    pass
+
+
 class InstrumentInterface:
     '''Provides the interface to a 26 byte instrument along with utility
     functions.
@@ -77,14 +96,22 @@ class InstrumentInterface:
     highest_register = 25
     # Values for setting modes of CC, CV, CW, or CR
     modes = {"cc": 0, "cv": 1, "cw": 2, "cr": 3}
+    header = 0xaa          # First byte of every packet
+    read_timeout = 0.02    # Serial read timeout in s, bounds a single stall
+    frame_deadline = 0.5   # Time in s allowed for one command, all retries
+    retries = 3            # Number of times a command is resent on error
+    retry_backoff = 0.005  # First retry delay in s, doubled for each retry
 
     def initialize(self, com_port, baudrate, address=0):
         try:
-            self.sp = serial.Serial(com_port, baudrate, timeout=5)
-        except:
-            print('unable to open port')
+            self.sp = port_factory(com_port, baudrate,
+                                   timeout=self.read_timeout)
+        except serial.SerialException as e:
+            raise InstrumentException("Unable to open port %s: %s" %
+                                      (com_port, e))
         self.address = address
         time.sleep(0.2)
+        self.flushInput()
 
     def close(self):
         self.sp.close()
@@ -167,16 +194,94 @@ class InstrumentInterface:
     def startCommand(self, byte):
         return chr(0xaa) + chr(self.address) + chr(byte)
 
-    def sendCommand(self, command1):
+    def flushInput(self):
+        '''Discard any stale bytes waiting in the serial input buffer.
+        '''
+        self.sp.reset_input_buffer()
+
+    def frameValid(self, frame):
+        '''Return True if the checksum of a 26 byte bytes frame matches.
+        '''
+        return (sum(frame[:self.length_packet - 1]) & 0xff) == frame[-1]
+
+    def readFrame(self, deadline):
+        '''Read bytes until a complete response frame with a valid
+        checksum is found and return it as bytes.  Garbage in front of
+        the 0xaa header is dropped; if a candidate frame fails the
+        checksum, its header byte is skipped and the scan resumes, so a
+        lost or extra byte only costs the bytes up to the next header.
+        Once a reply has started, a silent read_timeout before a valid
+        frame is found counts as a truncated reply instead of waiting for
+        the deadline.  Valid frames carrying another address (e.g. a late
+        reply to another load on a shared bus) are discarded.
+        deadline is a time.monotonic() value.
+        '''
+        buf = bytearray()
+        received = 0
+        bad_checksum = False
+        while True:
+            need = self.length_packet - len(buf)
+            if need > 0:
+                if time.monotonic() >= deadline:
+                    if bad_checksum:
+                        raise ChecksumError("No response with a valid "
+                                            "checksum before deadline")
+                    raise InstrumentTimeout("Timeout waiting for response "
+                                            "(%d of %d bytes)" %
+                                            (len(buf), self.length_packet))
+                chunk = self.sp.read(need)
+                if not chunk and received:
+                    raise FramingError("Truncated frame (%d bytes received)"
+                                       % received)
+                received += len(chunk)
+                buf += chunk
+            start = buf.find(self.header)
+            if start < 0:
+                del buf[:]
+                continue
+            del buf[:start]
+            if len(buf) < self.length_packet:
+                continue
+            frame = bytes(buf[:self.length_packet])
+            if not self.frameValid(frame):
+                bad_checksum = True
+                del buf[:1]
+                continue
+            del buf[:self.length_packet]
+            if frame[1] == self.address:
+                return frame
+
+    def sendCommand(self, command1, deadline=None):
         '''Sends the command to the serial stream and returns the 26 byte
-        response.
+        response.  Stale input is flushed before each attempt.  The whole
+        command, retries included, may take up to deadline seconds
+        (frame_deadline if None); failed attempts are retried with
+        exponential backoff while time is left and the last error is raised
+        once the retries or the time are used up.
         '''
         command = bytes(command1, 'latin-1')
-        assert(len(command) == self.length_packet)
-        self.sp.write(command)
-        response = self.sp.read(self.length_packet)
-        assert(len(response) == self.length_packet)
-        return str(response, 'latin-1')
+        if len(command) != self.length_packet:
+            raise FramingError("Command length = %d -- should be %d" %
+                               (len(command), self.length_packet))
+        if deadline is None:
+            deadline = self.frame_deadline
+        end = time.monotonic() + deadline
+        backoff = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            self.flushInput()
+            self.sp.write(command)
+            try:
+                response = self.readFrame(end)
+                return str(response, 'latin-1')
+            except InstrumentException as e:
+                error = e
+                if self.debug:
+                    out("Attempt %d failed: %s%s" % (attempt + 1, e, nl))
+            if time.monotonic() + backoff >= end:
+                break
+            time.sleep(backoff)
+            backoff *= 2
+        raise error
 
     def responseStatus(self, response):
         '''Return a message string about what the response meant.  The
@@ -189,8 +294,15 @@ class InstrumentInterface:
             0xC0: "Invalid command",
             0x80: "",
         }
-        assert(len(response) == self.length_packet)
-        assert(ord(response[2]) == 0x12)
+        if len(response) != self.length_packet:
+            raise FramingError("Response length = %d -- should be %d" %
+                               (len(response), self.length_packet))
+        if ord(response[2]) != 0x12:
+            raise FramingError("Expected status packet, got command "
+                               "0x%02x" % ord(response[2]))
+        if ord(response[3]) not in responses:
+            raise FramingError("Unknown status byte 0x%02x" %
+                               ord(response[3]))
         return responses[ord(response[3])]
 
     def codeInteger(self, value, num_bytes=4):
@@ -276,6 +388,16 @@ class InstrumentInterface:
         of the specified size.  Return the instrument's response status.
         '''
         cmd = self.getCommand(byte, value, num_bytes)
+        return self.sendPrepared(cmd, msg)
+
+    def sendPrepared(self, cmd, msg):
+        '''Send a command already built (and checked) with getCommand(),
+        e.g. taken from a compiled sweep plan.  Return the instrument's
+        response status.  A packet built for another address is refused.
+        '''
+        if ord(cmd[1]) != self.address:
+            raise FramingError("Packet for address %d, load is at %d" %
+                               (ord(cmd[1]), self.address))
         response = self.sendCommand(cmd)
         self.printCommandAndResponse(cmd, response, msg)
         return self.responseStatus(response)
@@ -573,7 +695,7 @@ class DCLoad(InstrumentInterface):
     def setLoadOnTimerState(self, enabled=0):
         '''Enables or disables the load on timer state'''
         msg = "Set load on timer state"
-        return self.SendIntegerToLoad(0x50, enabled, msg, num_bytes=1)
+        return self.SendIntegerToLoad(0x52, enabled, msg, num_bytes=1)
 
     def getLoadOnTimerState(self):
         '''Gets the load on timer state'''
@@ -624,7 +746,7 @@ class DCLoad(InstrumentInterface):
         if source not in trigger:
             raise Exception("Trigger type %s not recognized" % source)
         msg = "Set trigger type"
-        return self.SendIntegerToLoad(0x54, trigger[source], msg, num_bytes=1)
+        return self.SendIntegerToLoad(0x58, trigger[source], msg, num_bytes=1)
 
     def getTriggerSource(self):
         '''Get how the instrument will be triggered'''
@@ -713,6 +835,103 @@ class DCLoad(InstrumentInterface):
                 str(serial_number) + ',Ver.' + str(fw))
 
 
+class ShadowDCLoad(DCLoad):
+    '''DCLoad with shadow registers of the simple settings (limits, mode,
+    levels, battery voltage, remote sense, function).  The last value
+    written is remembered until something invalidates it, so setting the
+    same value again and reading it back need no round trip.  A value
+    read from the load is trusted for max_age seconds.  The shadow is
+    cleared by recallSettings(), by giving the load back to local or
+    front panel control, and by any protocol error.
+    '''
+    # set command byte: (get command byte, number of bytes of the value)
+    shadowed = {
+        0x22: (0x23, 4), 0x24: (0x25, 4), 0x26: (0x27, 4),
+        0x28: (0x29, 1), 0x2A: (0x2B, 4), 0x2C: (0x2D, 4),
+        0x2E: (0x2F, 4), 0x30: (0x31, 4), 0x4E: (0x4F, 4),
+        0x56: (0x57, 1), 0x5D: (0x5E, 1),
+    }
+    shadowed_gets = set(get for get, num_bytes in shadowed.values())
+    max_age = 1.0   # Time in s a value read from the load is trusted
+
+    def __init__(self):
+        self.invalidate()
+
+    def initialize(self, com_port, baudrate, address=0):
+        self.invalidate()
+        DCLoad.initialize(self, com_port, baudrate, address)
+
+    def invalidate(self):
+        '''Forget all shadowed values'''
+        # get command byte -> (value, time.monotonic() of a read or None)
+        self.shadow = {}
+
+    def cached(self, get_byte):
+        '''Return the shadowed value or None if unknown or too old'''
+        entry = self.shadow.get(get_byte)
+        if entry is None:
+            return None
+        value, read_time = entry
+        if read_time is not None and \
+                time.monotonic() - read_time > self.max_age:
+            return None
+        return value
+
+    def sendCommand(self, command1, deadline=None):
+        try:
+            return DCLoad.sendCommand(self, command1, deadline)
+        except InstrumentException:
+            self.invalidate()
+            raise
+
+    def remember(self, byte, value, status):
+        '''Update the shadow after a set command'''
+        get_byte, num_bytes = self.shadowed[byte]
+        if status:
+            self.shadow.pop(get_byte, None)
+        else:
+            mask = (1 << (8 * num_bytes)) - 1
+            self.shadow[get_byte] = (int(value) & mask, None)
+
+    def SendIntegerToLoad(self, byte, value, msg, num_bytes=4):
+        if byte in self.shadowed:
+            get_byte, length = self.shadowed[byte]
+            mask = (1 << (8 * length)) - 1
+            if self.cached(get_byte) == int(value) & mask:
+                return ""
+        status = DCLoad.SendIntegerToLoad(self, byte, value, msg, num_bytes)
+        if byte in self.shadowed:
+            self.remember(byte, value, status)
+        elif (byte == 0x20 and int(value) == 0) or \
+                (byte == 0x55 and int(value) == 1):
+            # Local control or front panel enabled
+            self.invalidate()
+        return status
+
+    def sendPrepared(self, cmd, msg):
+        status = DCLoad.sendPrepared(self, cmd, msg)
+        byte = ord(cmd[2])
+        if byte in self.shadowed:
+            num_bytes = self.shadowed[byte][1]
+            self.remember(byte, self.decodeInteger(cmd[3:3 + num_bytes]),
+                          status)
+        return status
+
+    def getIntegerFromLoad(self, cmd_byte, msg, num_bytes=4):
+        value = self.cached(cmd_byte)
+        if value is not None:
+            return value
+        value = DCLoad.getIntegerFromLoad(self, cmd_byte, msg, num_bytes)
+        if cmd_byte in self.shadowed_gets:
+            self.shadow[cmd_byte] = (value, time.monotonic())
+        return value
+
+    def recallSettings(self, register=0):
+        '''Restore instrument settings from a register'''
+        self.invalidate()
+        return DCLoad.recallSettings(self, register)
+
+
 def register(pyclass=DCLoad):
     from win32com.server.register import UseCommandLine
     UseCommandLine(pyclass)
@@ -0,0 +1,219 @@
+"""
+Title:       Instrument discovery and inventory
+Description: Finds the DMMs (VISA, *IDN?) and the DC loads (serial ports,
+             baud rates and addresses, getProductInformation()) of a bench
+             concurrently and keeps an inventory keyed by serial number, so
+             the bench configuration can name instruments by serial number
+             and survives changed IP addresses and COM port numbers.
+Comments:    The inventory is cached in inventory.json.  A discovery first
+             checks every cached instrument at its known location in
+             parallel; only if one is missing (or with rescan) all VISA
+             resources and serial ports are probed.  Raw socket resources
+             (TCPIP::host::port::SOCKET) are not listed by VISA and have to
+             be given as extra resources once; afterwards they are cached.
+
+Usage:
+    python discovery.py
+    python discovery.py --rescan --resource TCPIP::128.138.189.186::3490::SOCKET
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import time
+import serial.tools.list_ports
+import dcload
+import ntbvisa
+
+logger = logging.getLogger(__name__)
+
+INVENTORY_FILE = 'inventory.json'
+BAUD_RATES = (38400, 19200, 9600, 4800)
+DCLOAD_ADDRESSES = (0,)
+
+
+def parse_idn(idn):
+    ''' (maker, model, serial, firmware) of an *IDN? style string '''
+    fields = [field.strip().strip('\x00') for field in idn.split(',')]
+    if len(fields) < 3 or not fields[2]:
+        raise ValueError('No serial number in {0!r}'.format(idn))
+    return tuple((fields + [''])[:4])
+
+
+def probe_visa(name, timeout=0.5):
+    ''' Inventory entry of a VISA resource, None if it does not answer '''
+    try:
+        resource = ntbvisa.resource_manager_factory().open_resource(name)
+        try:
+            resource.read_termination = '\n'
+            resource.write_termination = '\n'
+            resource.timeout = int(timeout * 1000)
+            idn = resource.query('*IDN?')
+        finally:
+            resource.close()
+        maker, model, serial_number, firmware = parse_idn(idn)
+    except Exception as e:          # VISA raises many kinds of errors
+        logger.debug('{0}: {1}'.format(name, e))
+        return None
+    return {'serial': serial_number, 'kind': 'visa', 'resource': name,
+            'maker': maker, 'model': model, 'firmware': firmware}
+
+
+def probe_port(port, bauds=BAUD_RATES, addresses=DCLOAD_ADDRESSES,
+               timeout=0.15):
+    ''' Inventory entries of the DC loads on a serial port '''
+    found = []
+    for baud in bauds:
+        load = dcload.DCLoad()
+        load.retries = 0
+        load.frame_deadline = timeout
+        try:
+            load.initialize(port, baud)
+        except dcload.InstrumentException as e:
+            logger.debug('{0}: {1}'.format(port, e))
+            return found
+        try:
+            for address in addresses:
+                load.address = address
+                try:
+                    maker, model, serial_number, firmware = parse_idn(
+                        load.getProductInformation())
+                except (dcload.InstrumentException, ValueError,
+                        IndexError) as e:
+                    logger.debug('{0} {1} baud address {2}: {3}'.format(
+                        port, baud, address, e))
+                    continue
+                found.append({'serial': serial_number, 'kind': 'dcload',
+                              'port': port, 'baud': baud,
+                              'address': address, 'maker': maker,
+                              'model': model, 'firmware': firmware})
+        finally:
+            load.close()
+        if found:
+            break               # all loads on a port use the same baud rate
+    return found
+
+
+def serial_ports():
+    return [port.device for port in serial.tools.list_ports.comports()]
+
+
+class Inventory:
+
+    def __init__(self, filename=INVENTORY_FILE):
+        self.filename = filename
+        self.instruments = {}
+        if filename and os.path.isfile(filename):
+            with open(filename) as f:
+                self.instruments = json.load(f)
+
+    def save(self):
+        if self.filename:
+            with open(self.filename, 'w') as f:
+                json.dump(self.instruments, f, indent=4, sort_keys=True)
+
+    def update(self, entries):
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        for entry in entries:
+            entry = dict(entry, present=True, last_seen=now)
+            self.instruments[entry['serial']] = entry
+
+    def lookup(self, serial_number):
+        entry = self.instruments.get(serial_number)
+        if entry is None or not entry.get('present'):
+            raise dcload.InstrumentException(
+                'Instrument {0} not found'.format(serial_number))
+        return entry
+
+    def visa_name(self, serial_number):
+        return self.lookup(serial_number)['resource']
+
+    def dcload_port(self, serial_number):
+        ''' (port, baud, address) of a DC load '''
+        entry = self.lookup(serial_number)
+        return entry['port'], entry['baud'], entry['address']
+
+
+def discover(filename=INVENTORY_FILE, extra_resources=(), ports=None,
+             bauds=BAUD_RATES, addresses=DCLOAD_ADDRESSES, rescan=False,
+             max_workers=32):
+    ''' Revalidate the cached inventory, scan if something is missing '''
+    inventory = Inventory(filename)
+    cached = list(inventory.instruments.values())
+    for entry in cached:
+        entry['present'] = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        # the known locations first
+        checks = []
+        for entry in cached:
+            if entry['kind'] == 'visa':
+                checks.append(executor.submit(probe_visa, entry['resource']))
+            else:
+                checks.append(executor.submit(
+                    probe_port, entry['port'], (entry['baud'],),
+                    (entry['address'],)))
+        found = []
+        for entry, check in zip(cached, checks):
+            result = check.result()
+            results = result if isinstance(result, list) else [result]
+            found += [r for r in results
+                      if r is not None and r['serial'] == entry['serial']]
+        inventory.update(found)
+
+        found_serials = {e['serial'] for e in found}
+        missing = [e for e in cached if e['serial'] not in found_serials]
+        if rescan or missing or not cached or extra_resources:
+            used_resources = {e['resource'] for e in found
+                              if e['kind'] == 'visa'}
+            used_ports = {e['port'] for e in found if e['kind'] == 'dcload'}
+            rm = ntbvisa.resource_manager_factory()
+            names = set(rm.list_resources()) | set(extra_resources)
+            names |= {e['resource'] for e in missing if e['kind'] == 'visa'}
+            # serial VISA resources are the DC load ports, probed below
+            names = [n for n in names if not n.upper().startswith('ASRL')
+                     and n not in used_resources]
+            if ports is None:
+                ports = serial_ports()
+            ports = [p for p in ports if p not in used_ports]
+            visa_jobs = [executor.submit(probe_visa, n) for n in names]
+            port_jobs = [executor.submit(probe_port, p, bauds, addresses)
+                         for p in ports]
+            inventory.update(job.result() for job in visa_jobs
+                             if job.result() is not None)
+            for job in port_jobs:
+                inventory.update(job.result())
+
+    inventory.save()
+    return inventory
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the bench instruments')
+    parser.add_argument('--inventory', default=INVENTORY_FILE)
+    parser.add_argument('--rescan', action='store_true')
+    parser.add_argument('--resource', action='append', default=[],
+                        help='VISA resource that is not listed by VISA')
+    parser.add_argument('--port', action='append',
+                        help='serial port to probe (default: all)')
+    parser.add_argument('--address', type=int, action='append',
+                        help='DC load address to probe (default: 0)')
+    args = parser.parse_args()
+
+    start = time.time()
+    inventory = discover(args.inventory, args.resource, args.port,
+                         addresses=args.address or DCLOAD_ADDRESSES,
+                         rescan=args.rescan)
+    for serial_number, entry in sorted(inventory.instruments.items()):
+        location = entry.get('resource') or '{0} {1} baud address {2}'.format(
+            entry['port'], entry['baud'], entry['address'])
+        print('{0:16} {1:8} {2:10} {3}{4}'.format(
+            serial_number, entry['maker'], entry['model'], location,
+            '' if entry['present'] else ' (missing)'))
+    print('{0:.1f} s'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Title:       Efficiency maps from archived sweeps
+Description: Builds an N-dimensional efficiency map, e.g. over (Uin, Iout),
+             from runs in the run archive and looks up the efficiency at any
+             number of points at once with multilinear interpolation.
+Comments:    The points of the runs are averaged on a regular grid (each
+             point goes to the nearest grid node, resolution per axis), grid
+             nodes without data are filled by linear interpolation along
+             the axes.  The compiled grid is cached as .npz in cache_dir,
+             keyed by a hash of the source data and the map settings, so a
+             map is only compiled again when the data change.  Points
+             outside the grid get the value of the nearest edge.
+
+Usage:
+    python efficiencymap.py 12 13 14 --axes uin iout --resolution 0.5 0.1
+    python efficiencymap.py 12 13 14 --lookup 12 5.5
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+import runarchive
+
+# Columns of the points table that can be used as axes or value
+MAP_COLUMNS = ('setpoint', 'uin', 'iin', 'pin', 'uout', 'iout', 'pout',
+               'eff')
+DEFAULT_CACHE_DIR = '.efficiencymap_cache'
+
+
+def fill_gaps(grid):
+    ''' Fill NaN nodes by linear interpolation along each axis in turn '''
+    grid = grid.copy()
+    for axis in range(grid.ndim):
+        if not np.isnan(grid).any():
+            break
+        lines = np.moveaxis(grid, axis, -1).reshape(-1, grid.shape[axis])
+        x = np.arange(lines.shape[1])
+        for line in lines:
+            known = ~np.isnan(line)
+            if known.any() and not known.all():
+                line[~known] = np.interp(x[~known], x[known], line[known])
+        grid = np.moveaxis(lines.reshape(np.moveaxis(grid, axis, -1).shape),
+                           -1, axis)
+    return grid
+
+
+class EfficiencyMap:
+
+    def __init__(self, axes, coordinates, values):
+        self.axes = tuple(axes)
+        self.coordinates = [np.asarray(c, dtype=float) for c in coordinates]
+        self.values = np.asarray(values, dtype=float)
+        self.shape = np.array(self.values.shape)
+        # corner offsets of a grid cell, flat index steps of the axes
+        self.corners = np.array(np.meshgrid(
+            *[[0, 1]] * len(self.axes), indexing='ij')).reshape(
+                len(self.axes), -1).T
+        self.strides = np.array([int(np.prod(self.shape[i + 1:]))
+                                 for i in range(len(self.axes))])
+        self.flat = self.values.ravel()
+
+    @classmethod
+    def from_points(cls, axes, points, values, resolution):
+        '''Average scattered points (n, len(axes)) on a grid with the given
+        resolution per axis.
+        '''
+        points = np.asarray(points, dtype=float)
+        values = np.asarray(values, dtype=float)
+        coordinates = []
+        nodes = []
+        for column, step in zip(points.T, resolution):
+            rounded = np.round(column / step) * step
+            axis_values, index = np.unique(rounded, return_inverse=True)
+            coordinates.append(axis_values)
+            nodes.append(index)
+        shape = tuple(len(c) for c in coordinates)
+        flat = np.ravel_multi_index(nodes, shape)
+        totals = np.bincount(flat, weights=values, minlength=int(np.prod(shape)))
+        counts = np.bincount(flat, minlength=int(np.prod(shape)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grid = (totals / counts).reshape(shape)
+        return cls(axes, coordinates, fill_gaps(grid))
+
+    def lookup(self, points):
+        '''Values at points, an (n, len(axes)) array (or one point), by
+        multilinear interpolation.
+        '''
+        points = np.asarray(points, dtype=float)
+        single = points.ndim == 1
+        points = np.atleast_2d(points)
+        base = np.empty(points.shape, dtype=np.intp)
+        fraction = np.empty(points.shape)
+        for i, axis_values in enumerate(self.coordinates):
+            if len(axis_values) == 1:
+                base[:, i] = 0
+                fraction[:, i] = 0.0
+                continue
+            x = np.clip(points[:, i], axis_values[0], axis_values[-1])
+            j = np.clip(np.searchsorted(axis_values, x) - 1, 0,
+                        len(axis_values) - 2)
+            base[:, i] = j
+            fraction[:, i] = (x - axis_values[j]) / (axis_values[j + 1] -
+                                                     axis_values[j])
+        result = np.zeros(len(points))
+        flat_base = base @ self.strides
+        for corner in self.corners:
+            if np.any(corner & (self.shape == 1)):
+                continue                # no neighbour on a single-node axis
+            weight = np.prod(np.where(corner, fraction, 1 - fraction),
+                             axis=1)
+            result += weight * self.flat[flat_base + corner @ self.strides]
+        return result[0] if single else result
+
+    def save(self, filename):
+        np.savez(filename, axes=np.array(self.axes), values=self.values,
+                 **{'axis{0}'.format(i): c
+                    for i, c in enumerate(self.coordinates)})
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            axes = [str(a) for a in data['axes']]
+            return cls(axes, [data['axis{0}'.format(i)]
+                              for i in range(len(axes))], data['values'])
+
+
+def archive_points(archive, run_ids, columns):
+    ''' Rows of the given point columns of runs, in a stable order '''
+    for column in columns:
+        if column not in MAP_COLUMNS:
+            raise ValueError('Unknown column {0}'.format(column))
+    rows = archive.db.execute(
+        'SELECT {0} FROM points WHERE run_id IN ({1}) '
+        'ORDER BY run_id, idx'.format(', '.join(columns),
+                                      ', '.join('?' * len(run_ids))),
+        list(run_ids)).fetchall()
+    data = np.array(rows, dtype=float).reshape(-1, len(columns))
+    return data[~np.isnan(data).any(axis=1)]
+
+
+def build_map(archive, run_ids, axes=('uin', 'iout'), resolution=(0.5, 0.1),
+              value='eff', cache_dir=DEFAULT_CACHE_DIR):
+    ''' Map of value over axes from archived runs, cached on disk '''
+    if len(axes) != len(resolution):
+        raise ValueError('One resolution per axis needed')
+    data = archive_points(archive, run_ids, tuple(axes) + (value,))
+    if not len(data):
+        raise ValueError('No points in runs {0}'.format(list(run_ids)))
+    digest = hashlib.sha1(json.dumps(
+        [list(axes), list(resolution), value]).encode('utf-8'))
+    digest.update(np.ascontiguousarray(data).tobytes())
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, digest.hexdigest() + '.npz')
+        if os.path.isfile(cache_file):
+            return EfficiencyMap.load(cache_file)
+    efficiency_map = EfficiencyMap.from_points(axes, data[:, :-1],
+                                               data[:, -1], resolution)
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        efficiency_map.save(cache_file)
+    return efficiency_map
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Efficiency map')
+    parser.add_argument('runs', type=int, nargs='+')
+    parser.add_argument('--archive', default=runarchive.DEFAULT_ARCHIVE)
+    parser.add_argument('--axes', nargs='+', default=['uin', 'iout'])
+    parser.add_argument('--resolution', type=float, nargs='+',
+                        default=[0.5, 0.1])
+    parser.add_argument('--value', default='eff')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--lookup', type=float, nargs='+',
+                        help='print the value at this point')
+    args = parser.parse_args()
+
+    archive = runarchive.RunArchive(args.archive)
+    efficiency_map = build_map(archive, args.runs, args.axes,
+                               args.resolution, args.value, args.cache_dir)
+    archive.close()
+    if args.lookup:
+        print('{0:1.4f}'.format(efficiency_map.lookup(args.lookup)))
+    else:
+        for axis, values in zip(efficiency_map.axes,
+                                efficiency_map.coordinates):
+            print('{0}: {1} nodes {2:g}..{3:g}'.format(
+                axis, len(values), values[0], values[-1]))
+
+
+if __name__ == '__main__':
+    main()
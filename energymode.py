@@ -0,0 +1,194 @@
+"""
+Title:       Energy-integrating efficiency sweep
+Description: For converters in burst or pulse-skipping mode a single
+             reading of Uin, Iin, Uout and Iout can fall anywhere in a burst.
+             In energy mode all four meters sample continuously over a
+             window at their fastest rate, the samples are read back as
+             binary blocks and Ein and Eout are integrated from u * i of
+             every sample.  The efficiency is the energy ratio Eout / Ein.
+Comments:    The window is split into segments; the spread of the segment
+             efficiencies is reported as a check that the window is long
+             enough.  The log has the Just_Efficiency columns, with mean
+             values, Pin = Ein / T and Pout = Eout / T, so the run can be
+             archived and analysed like any other.  Use trigger 'EXT' so
+             that all meters sample at the same instants.
+             *OPC? only returns when the window is sampled, so the VISA
+             timeout of the meters is set to the window plus
+             TIMEOUT_MARGIN.
+
+Usage:
+    python energymode.py --window 0.5 --interval 20e-6 --trigger EXT
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+import bench
+import runarchive
+import sweepplan
+import transienttest
+
+# time in s allowed for trigger, read-out and network on top of the window
+TIMEOUT_MARGIN = 2.0
+
+
+def sample_count(window, interval, max_samples=transienttest.MAX_SAMPLES,
+                 segments=10):
+    '''Samples and sample interval for a window.  A window that needs more
+    than max_samples is sampled slower, one with fewer samples than
+    segments raises ValueError.
+    '''
+    samples = int(round(window / interval))
+    if samples > max_samples:
+        # keep the window, sample slower
+        samples = max_samples
+        interval = window / samples
+    if samples < max(segments, 1):
+        raise ValueError('A window of {0} s has {1} samples of {2} s, at '
+                         'least {3} are needed'.format(
+                             window, samples, interval, max(segments, 1)))
+    return samples, interval
+
+
+def configure(test_bench, samples, interval, trigger='EXT',
+              voltage_range=100, current_range=10):
+    timeout = int(1000 * (samples * interval + TIMEOUT_MARGIN))     # ms
+    for meter, function, rang in (
+            (test_bench.dmm_uin, 'VOLT', voltage_range),
+            (test_bench.dmm_uout, 'VOLT', voltage_range),
+            (test_bench.dmm_iin, 'CURR', current_range),
+            (test_bench.dmm_iout, 'CURR', current_range)):
+        meter.resource.timeout = timeout
+        meter.write_multi(transienttest.digitize_config(
+            function, rang, samples, interval, trigger))
+
+
+def capture(test_bench, trigger='EXT'):
+    ''' Sample all channels once, return (uin, iin, uout, iout) arrays '''
+    meters = (test_bench.dmm_uin, test_bench.dmm_uout, test_bench.dmm_iin,
+              test_bench.dmm_iout)
+    for meter in meters:
+        meter.write('INIT')
+    if trigger == 'BUS':
+        for meter in meters:
+            meter.write('*TRG')
+    for meter in meters:
+        meter.query('*OPC?')
+    uin, uout, iin, iout = (meter.query_block('FETC?') for meter in meters)
+    n = min(len(uin), len(uout), len(iin), len(iout))
+    return (uin[:n], iin[:n] * test_bench.shunt_gain_iin, uout[:n],
+            iout[:n] * test_bench.shunt_gain_iout)
+
+
+def integrate(uin, iin, uout, iout, interval, segments=10):
+    '''Energy evaluation of one capture.  Return the row (uin, iin, pin,
+    uout, iout, pout, eff) with mean values and Pin, Pout = E / T, and the
+    (snapshot efficiency, stddev of the segment efficiencies).  A capture
+    with fewer samples than segments has one segment per sample.
+    '''
+    channels = np.stack((uin, iin, uout, iout))
+    if not channels.shape[1]:
+        raise ValueError('Capture without samples')
+    segments = max(1, min(segments, channels.shape[1]))
+    n = channels.shape[1] - channels.shape[1] % segments
+    power = np.stack((uin * iin, uout * iout))
+    energy = power.sum(axis=1) * interval           # Ein, Eout in J
+    duration = channels.shape[1] * interval
+    pin, pout = energy / duration
+    eff = pout / pin if pin else 0.0
+    means = channels.mean(axis=1)
+
+    # efficiency of each segment: Eout / Ein of a part of the window
+    with np.errstate(divide='ignore', invalid='ignore'):
+        parts = power[:, :n].reshape(2, segments, -1).sum(axis=2)
+        segment_eff = np.where(parts[0] != 0, parts[1] / parts[0], 0.0)
+        snapshot = power[1, 0] / power[0, 0] if power[0, 0] else 0.0
+    row = tuple(float(x) for x in (means[0], means[1], pin, means[2],
+                                   means[3], pout, eff))
+    spread = segment_eff.std(ddof=1) if segments > 1 else 0.0
+    return row, (float(snapshot), float(spread))
+
+
+def sweep(test_bench, plan, window, interval, trigger, logdata,
+          max_samples=transienttest.MAX_SAMPLES, segments=10):
+    ''' Energy measurement at every plan point, return the setpoints '''
+    samples, interval = sample_count(window, interval, max_samples, segments)
+    configure(test_bench, samples, interval, trigger)
+    load = test_bench.load
+    load.setCCCurrent(plan.start_current)
+    load.turnLoadOn()
+    setpoints = []
+    try:
+        for current, packet in plan.points():
+            load.sendPrepared(packet, "Set CC current")
+            time.sleep(plan.settle_time)
+            row, (snapshot, spread) = integrate(
+                *capture(test_bench, trigger), interval, segments)
+            res_time = time.strftime('%H:%M:%S')
+            print(res_time, *row, file=logdata)
+            print(("{0},Uin={1:2.3f}V,Iin={2:1.3f}A,Pin={3:3.3f}W,"
+                   "Uout={4:2.3f}V,Iout={5:2.3f}A,Pout={6:3.3f}W,n={7:1.4f} "
+                   "(snapshot {8:1.4f}, sd {9:1.4f})").format(
+                       res_time, *row, snapshot, spread))
+            setpoints.append(current)
+    except KeyboardInterrupt:
+        print('Aborted')
+    return setpoints
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Energy-integrating sweep')
+    parser.add_argument('--plan', default='sweep_plan.json')
+    parser.add_argument('--window', type=float, default=0.5,
+                        help='integration window per point in s')
+    parser.add_argument('--interval', type=float, default=20e-6,
+                        help='sample interval in s')
+    parser.add_argument('--segments', type=int, default=10)
+    parser.add_argument('--trigger', choices=('BUS', 'EXT'), default='EXT')
+    parser.add_argument('--max-samples', type=int,
+                        default=transienttest.MAX_SAMPLES,
+                        help='reading memory of the meters')
+    parser.add_argument('--archive', default=runarchive.DEFAULT_ARCHIVE)
+    parser.add_argument('logfile', nargs='?',
+                        default=time.strftime("%Y%m%d-%H%M%S") + ".txt")
+    args = parser.parse_args()
+
+    try:
+        sample_count(args.window, args.interval, args.max_samples,
+                     args.segments)
+    except ValueError as e:
+        parser.error(str(e))
+    if os.path.isfile(args.logfile):
+        print('file already exists')
+        return
+    test_bench = bench.default_bench()
+    # the packets of the plan are built for the address of the bench's load
+    plan = sweepplan.compile_plan(args.plan, test_bench.load_address)
+    test_bench.open()
+    setpoints = []
+    try:
+        test_bench.configure_load(plan.max_voltage, plan.max_power, 'cc')
+        with open(args.logfile, 'w') as logdata:
+            print("Time Uin[V] Iin[A] Pin[W] Uout[V] Iout[A] Pout[W] n[]",
+                  file=logdata)
+            setpoints = sweep(test_bench, plan, args.window, args.interval,
+                              args.trigger, logdata, args.max_samples,
+                              args.segments)
+        print("Ramp down current")
+        test_bench.ramp_down(plan.step_size)
+    finally:
+        print("turn off load and set local control")
+        test_bench.close()
+
+    archive = runarchive.RunArchive(args.archive)
+    plan.plan['energy'] = {'window': args.window, 'interval': args.interval,
+                           'trigger': args.trigger}
+    archive.import_log(args.logfile, plan=plan.plan, setpoints=setpoints,
+                       shunt_gain_iin=test_bench.shunt_gain_iin,
+                       shunt_gain_iout=test_bench.shunt_gain_iout)
+    archive.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Title:       Up/down ramp comparison
+Description: Compares the efficiency measured on the up and the down ramp of
+             a bidirectional sweep at the same load currents and merges both
+             ramps into one curve.
+Comments:    Currents are matched exactly (both ramps use the same plan
+             setpoints).  The difference is down - up, a positive value
+             means the DUT is more efficient when it is warm.
+"""
+
+import numpy as np
+
+REPORT_COLUMNS = ('I[A]', 'n_up[]', 'n_down[]', 'dn[]')
+
+
+def compare(up_currents, up_values, down_currents, down_values):
+    '''Rows of (current, up, down, down - up) for the currents measured on
+    both ramps, sorted by current.
+    '''
+    up = dict(zip(up_currents, up_values))
+    down = dict(zip(down_currents, down_values))
+    currents = sorted(set(up) & set(down))
+    rows = np.array([(c, up[c], down[c], down[c] - up[c]) for c in currents],
+                    dtype=float)
+    return rows.reshape(-1, len(REPORT_COLUMNS))
+
+
+def merge(up_currents, up_values, down_currents, down_values):
+    '''(currents, values) of both ramps, the mean where a current was
+    measured twice.
+    '''
+    currents = np.concatenate((up_currents, down_currents)).astype(float)
+    values = np.concatenate((up_values, down_values)).astype(float)
+    merged, index = np.unique(currents, return_inverse=True)
+    totals = np.bincount(index, weights=values)
+    return merged, totals / np.bincount(index)
+
+
+def summary(rows):
+    ''' Text of the largest and the mean hysteresis '''
+    if not len(rows):
+        return 'no points on both ramps'
+    worst = np.argmax(np.abs(rows[:, 3]))
+    return ('hysteresis max {0:+1.4f} at {1:g} A, mean {2:+1.4f}'
+            .format(rows[worst, 3], rows[worst, 0], rows[:, 3].mean()))
+
+
+def write_report(filename, rows):
+    np.savetxt(filename, rows, header=' '.join(REPORT_COLUMNS), comments='')
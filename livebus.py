@@ -0,0 +1,249 @@
+"""
+Title:       Shared-memory live data bus
+Description: The acquisition publishes its samples into a ring buffer in
+             shared memory.  Any number of local processes (plots,
+             dashboards, watchdogs, notebooks) can attach by name and read
+             the samples as NumPy views without copying and without taking
+             a lock; the writer never waits for a reader.
+Comments:    Layout: 64 byte header (magic, version, number of columns,
+             capacity, write index), the column names as 32 byte strings and
+             the ring of float64 rows.  The write index is the number of
+             rows written and is stored after the row.  A reader that fell
+             more than capacity rows behind loses the oldest rows.
+             Column 0 of every row is a seqlock word: 2n+1 while row n is
+             being written, 2n+2 once it is complete.  A reader checks the
+             word before and after it uses a row: an odd or changed word
+             means the row was torn by the writer, read_copy() and
+             latest() then read it again or drop it if it was overwritten.
+
+Usage:
+    python livebus.py ntb_efficiency            (prints new rows)
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+MAGIC = b'NTBLIVE1'
+VERSION = 1
+NAME_LENGTH = 32
+
+HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('columns', '<u4'),
+                   ('capacity', '<u8'), ('write_index', '<u8'),
+                   ('started', '<f8')])
+HEADER_SIZE = 64
+
+# names of the segments created by writers in this process
+created = set()
+
+
+def data_offset(columns):
+    size = HEADER_SIZE + NAME_LENGTH * columns
+    return (size + 63) // 64 * 64
+
+
+def writing(index):
+    ''' Seqlock word of a row while it is written '''
+    return 2 * index + 1
+
+
+def complete(index):
+    ''' Seqlock word of a complete row '''
+    return 2 * index + 2
+
+
+def row_index(word):
+    ''' Row number of a complete row's seqlock word '''
+    return word // 2 - 1
+
+
+class LiveBusError(Exception):
+    pass
+
+
+class LiveBusWriter:
+
+    def __init__(self, name, columns, capacity=65536):
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        width = len(self.columns) + 1
+        offset = data_offset(width)
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=True, size=offset + capacity * width * 8)
+        created.add(self.shm._name)
+        self.header = np.ndarray((), HEADER, self.shm.buf)
+        schema = np.ndarray((width,), 'S{0}'.format(NAME_LENGTH),
+                            self.shm.buf, HEADER_SIZE)
+        schema[:] = [c.encode('ascii') for c in ('seq',) + self.columns]
+        self.ring = np.ndarray((capacity, width), '<f8', self.shm.buf, offset)
+        self.ring[:, 0] = 0                     # no row complete yet
+        self.write_index = 0
+        self.header['capacity'] = capacity
+        self.header['columns'] = width
+        self.header['version'] = VERSION
+        self.header['write_index'] = 0
+        self.header['started'] = time.time()
+        self.header['magic'] = MAGIC            # last: header is complete
+
+    def publish(self, values):
+        ''' Append one row (values in column order) '''
+        row = self.ring[self.write_index % self.capacity]
+        row[0] = writing(self.write_index)
+        row[1:] = values
+        row[0] = complete(self.write_index)
+        self.write_index += 1
+        self.header['write_index'] = self.write_index
+
+    def publish_block(self, block):
+        ''' Append the rows of an (n, columns) array '''
+        block = np.asarray(block, dtype=float)
+        self.write_index += max(len(block) - self.capacity, 0)
+        block = block[-self.capacity:]
+        start = self.write_index
+        index = np.arange(start, start + len(block))
+        slots = index % self.capacity
+        self.ring[slots, 0] = writing(index)
+        self.ring[slots, 1:] = block
+        self.ring[slots, 0] = complete(index)
+        self.write_index += len(block)
+        self.header['write_index'] = self.write_index
+
+    def close(self):
+        ''' Remove the bus, attached readers keep their mapping '''
+        del self.header, self.ring
+        self.shm.close()
+        self.shm.unlink()
+        created.discard(self.shm._name)
+
+
+class LiveBusReader:
+
+    def __init__(self, name):
+        self.shm = shared_memory.SharedMemory(name=name)
+        # the writer owns the segment, a reader must not unlink it at exit.
+        # Only POSIX tracks attached segments, and in the writer's own
+        # process the registration is the writer's.
+        if os.name == 'posix' and self.shm._name not in created:
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.header = np.ndarray((), HEADER, self.shm.buf)
+        if bytes(self.header['magic']) != MAGIC:
+            raise LiveBusError('{0} is not a live bus'.format(name))
+        width = int(self.header['columns'])
+        self.capacity = int(self.header['capacity'])
+        schema = np.ndarray((width,), 'S{0}'.format(NAME_LENGTH),
+                            self.shm.buf, HEADER_SIZE)
+        self.columns = tuple(c.decode('ascii') for c in schema[1:])
+        self.ring = np.ndarray((self.capacity, width), '<f8', self.shm.buf,
+                               data_offset(width))
+        self.position = int(self.header['write_index'])
+
+    @property
+    def write_index(self):
+        return int(self.header['write_index'])
+
+    def column(self, name):
+        ''' Index of a column in the rows returned by read() '''
+        return self.columns.index(name) + 1
+
+    def read(self):
+        '''Views of the rows written since the last read (one view, two if
+        the ring wrapped) and the number of rows that were lost.  The views
+        point into the ring: use them before the writer comes round again,
+        valid() tells afterwards if they still hold the expected rows.
+        read_copy() returns a consistent copy instead.
+        '''
+        end = self.write_index
+        start = max(self.position, end - self.capacity)
+        lost = start - self.position
+        self.position = end
+        first, last = start % self.capacity, end % self.capacity
+        if start == end:
+            return [], lost
+        if first < last:
+            return [self.ring[first:last]], lost
+        return [self.ring[first:], self.ring[:last]], lost
+
+    def valid(self, views):
+        '''True if all rows in views are complete and none was overwritten
+        yet, the seqlock check after using views from read().
+        '''
+        for view in views:
+            if not len(view):
+                continue
+            words = view[:, 0]
+            expected = complete(row_index(words[0]) + np.arange(len(view)))
+            if np.any(words != expected) or (row_index(words[0]) <
+                                             self.write_index - self.capacity):
+                return False
+        return True
+
+    def consistent(self, index, retries=10):
+        '''Copy of rows index (an array of row numbers).  Torn rows are
+        copied again, rows already overwritten are dropped.
+        '''
+        expected = complete(index)
+        rows = self.ring[index % self.capacity]      # fancy index: a copy
+        for attempt in range(retries):
+            after = self.ring[index % self.capacity, 0]
+            good = (rows[:, 0] == expected) & (after == expected)
+            # a word beyond the expected one: the writer came round again
+            retry = ~good & (after <= expected)
+            if not retry.any():
+                return rows[good]
+            rows[retry] = self.ring[index[retry] % self.capacity]
+        raise LiveBusError('Rows still changing after {0} reads'.format(
+            retries))
+
+    def read_copy(self):
+        '''Like read(), but a consistent copy of the new rows as one array
+        and the number of rows lost (including rows overwritten while they
+        were copied).
+        '''
+        end = self.write_index
+        start = max(self.position, end - self.capacity)
+        index = np.arange(start, end)
+        rows = self.consistent(index)
+        lost = end - self.position - len(rows)
+        self.position = end
+        return rows, lost
+
+    def latest(self, count):
+        ''' Copy of the last count rows, overwritten rows dropped '''
+        end = self.write_index
+        return self.consistent(np.arange(max(end - count, 0), end))
+
+    def close(self):
+        del self.header, self.ring
+        self.shm.close()
+
+
+def follow(reader, interval):
+    print(' '.join(reader.columns))
+    while True:
+        rows, lost = reader.read_copy()
+        if lost:
+            print('{0} rows lost'.format(lost))
+        for row in rows:
+            print(' '.join('{0:g}'.format(x) for x in row[1:]))
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print rows of a live bus')
+    parser.add_argument('name')
+    parser.add_argument('--interval', type=float, default=0.5)
+    args = parser.parse_args()
+
+    reader = LiveBusReader(args.name)
+    try:
+        follow(reader, args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Title:       Multi-mode sweep (CC, CV, CW, CR)
+Description: Measures operating points in all four load modes.  The limit
+             configuration of every mode (max voltage, max power, max
+             current and the mode itself) is stored once in a register of the
+             load; afterwards a mode change is a single recallSettings()
+             instead of four or five separate commands.
+Comments:    Plan file (JSON), setpoints in mA, V, W or ohm:
+                 {"settle_time": 2,
+                  "modes": {
+                     "cc": {"register": 1, "max_voltage": 15,
+                            "max_power": 300, "max_current": 30000,
+                            "points": [1000, 2000, 3000]},
+                     "cw": {"register": 3, "max_voltage": 15,
+                            "max_power": 300, "points": [10, 50, 100]}}}
+             Points are measured mode by mode in the order cc, cv, cw, cr,
+             so every mode is recalled once.
+             Each register also holds a setpoint, so a recall never brings
+             back a stale level (e.g. 0 V in CV, close to a short): by
+             default the first point of the mode, "start" in a mode sets
+             another one.  The load is turned off around every recall and
+             turned on again once the new setpoint is set.
+
+Usage:
+    python multimodesweep.py multimode_plan.json [logfile]
+"""
+
+import argparse
+import json
+import os
+import time
+import bench
+import dcload
+
+MODE_ORDER = ('cc', 'cv', 'cw', 'cr')
+UNITS = {'cc': 'mA', 'cv': 'V', 'cw': 'W', 'cr': 'ohm'}
+
+
+def load_plan(filename):
+    with open(filename) as f:
+        plan = json.load(f)
+    modes = plan.get('modes', {})
+    registers = set()
+    for mode, config in modes.items():
+        if mode not in MODE_ORDER:
+            raise ValueError('Unknown mode {0}'.format(mode))
+        register = config.get('register', 0)
+        if not (dcload.InstrumentInterface.lowest_register <= register <=
+                dcload.InstrumentInterface.highest_register):
+            raise ValueError('{0}: register must be 1..25'.format(mode))
+        if register in registers:
+            raise ValueError('{0}: register {1} used twice'.format(
+                mode, register))
+        registers.add(register)
+        if not config.get('points'):
+            raise ValueError('{0}: no points'.format(mode))
+        config.setdefault('start', config['points'][0])
+    plan.setdefault('settle_time', 2)
+    return plan
+
+
+class ModeSwitcher:
+    ''' Mode changes through the load's settings registers '''
+
+    def __init__(self, load, modes):
+        self.load = load
+        self.modes = modes
+        self.setters = {'cc': load.setCCCurrent, 'cv': load.setCVVoltage,
+                        'cw': load.setCWPower, 'cr': load.setCRResistance}
+        self.active = None
+        self.load_on = False
+
+    def store(self):
+        '''Program each mode's limits and start setpoint once and save them
+        to its register.  The load has to be off.
+        '''
+        for mode, config in self.modes.items():
+            commands = [(self.load.setMode, mode)]
+            if 'max_voltage' in config:
+                commands.append((self.load.setMaxVoltage,
+                                 config['max_voltage']))
+            if 'max_power' in config:
+                commands.append((self.load.setMaxPower, config['max_power']))
+            if 'max_current' in config:
+                commands.append((self.load.setMaxCurrent,
+                                 config['max_current']))
+            commands.append((self.setters[mode], config['start']))
+            commands.append((self.load.saveSettings, config['register']))
+            for command, value in commands:
+                status = command(value)
+                if status:
+                    raise dcload.InstrumentException(
+                        '{0}: {1}'.format(mode, status))
+        self.active = None
+
+    def check(self, status):
+        if status:
+            raise dcload.InstrumentException(status)
+
+    def turn_on(self):
+        self.check(self.load.turnLoadOn())
+        self.load_on = True
+
+    def turn_off(self):
+        self.check(self.load.turnLoadOff())
+        self.load_on = False
+
+    def set(self, mode, value):
+        '''Set a setpoint, after switching to mode with one recall if it is
+        not active already.  A recall is done with the load off.
+        '''
+        if mode == self.active:
+            self.check(self.setters[mode](value))
+            return
+        was_on = self.load_on
+        if was_on:
+            self.turn_off()
+        self.check(self.load.recallSettings(self.modes[mode]['register']))
+        self.active = mode
+        self.check(self.setters[mode](value))
+        if was_on:
+            self.turn_on()
+
+
+def points(plan):
+    ''' (mode, setpoint) in measuring order '''
+    for mode in MODE_ORDER:
+        if mode in plan['modes']:
+            for value in plan['modes'][mode]['points']:
+                yield mode, value
+
+
+def run(test_bench, plan, logdata):
+    switcher = ModeSwitcher(test_bench.load, plan['modes'])
+    switcher.store()
+    row_head = "Time Mode Setpoint Uin[V] Iin[A] Pin[W] Uout[V] Iout[A] Pout[W] n[]"
+    print(row_head, file=logdata)
+    print(row_head)
+    first = True
+    for mode, value in points(plan):
+        switcher.set(mode, value)
+        if first:
+            switcher.turn_on()
+            first = False
+        time.sleep(plan['settle_time'])
+        values = test_bench.measure()
+        res_time = time.strftime('%H:%M:%S')
+        print(' '.join(str(x) for x in (res_time, mode, value) + values),
+              file=logdata)
+        print(("{0},{1}={2}{3},Uin={4:2.3f}V,Iin={5:1.3f}A,Pin={6:3.3f}W,"
+               "Uout={7:2.3f}V,Iout={8:2.3f}A,Pout={9:3.3f}W,n={10:1.4f}")
+              .format(res_time, mode, value, UNITS[mode], *values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CC/CV/CW/CR sweep')
+    parser.add_argument('plan')
+    parser.add_argument('logfile', nargs='?',
+                        default=time.strftime("%Y%m%d-%H%M%S") + ".txt")
+    args = parser.parse_args()
+
+    plan = load_plan(args.plan)
+    if os.path.isfile(args.logfile):
+        print('file already exists')
+        return
+    test_bench = bench.default_bench()
+    test_bench.open()
+    try:
+        with open(args.logfile, 'w') as logdata:
+            run(test_bench, plan, logdata)
+    except KeyboardInterrupt:
+        print('Aborted')
+    finally:
+        print("turn off load and set local control")
+        test_bench.close()
+
+
+if __name__ == '__main__':
+    main()
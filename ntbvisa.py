@@ -7,6 +7,7 @@ Author: fkyburz
 """
 
 import logging
+import numpy as np
 import visa
 ##import ntbdcload
 
@@ -27,10 +28,59 @@ formatter = logging.Formatter('%(levelname)s - %(message)s')
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
+# Creates the VISA resource manager.  Can be replaced, e.g. by trafficlog
+# to record or replay the traffic.
+resource_manager_factory = visa.ResourceManager
+
+
+class SCPIError(Exception):
+    ''' The instrument reported errors in its SYST:ERR? queue '''
+
+    def __init__(self, name, errors):
+        self.name = name
+        self.errors = errors
+        Exception.__init__(self, '{0}: {1}'.format(name, '; '.join(errors)))
+
+
+def coalesce(message_list, max_length=256):
+    '''Join SCPI commands into ';'-separated program messages of at most
+    max_length characters.  Queries are sent on their own because their
+    responses have to be read.  Commands after the first get a leading
+    ':' so that they are parsed from the root of the command tree and not
+    relative to the previous header.
+    '''
+    program = ''
+    for message in message_list:
+        if '?' in message:
+            if program:
+                yield program
+            program = ''
+            yield message
+            continue
+        if program and not message.startswith(('*', ':')):
+            message = ':' + message
+        if program and len(program) + 1 + len(message) <= max_length:
+            program += ';' + message
+        else:
+            if program:
+                yield program
+            program = message.lstrip(':')
+    if program:
+        yield program
+
+
+def parse_block_header(data):
+    ''' Return (offset, length) of the data in an IEEE 488.2 block '''
+    if data[:1] != b'#' or not data[1:2].isdigit() or data[1:2] == b'0':
+        raise ValueError('Not a definite length block: {0!r}'.format(
+            data[:12]))
+    digits = int(data[1:2])
+    return 2 + digits, int(data[2:2 + digits])
+
 
 def list_resources():
     # Visa resource manager instance for debug
-    rm = visa.ResourceManager()
+    rm = resource_manager_factory()
     # Print resources list for debugging
     print(rm.list_resources())
 
@@ -57,6 +107,14 @@ class NTBSetup:
         for resource in self.resource_list:
             resource.write(command)
 
+    def write_multi_all(self, message_list):
+        for resource in self.resource_list:
+            resource.write_multi(message_list)
+
+    def write_raw_all(self, data):
+        for resource in self.resource_list:
+            resource.write_raw(data)
+
     def close_all(self):
         for resource in self.resource_list:
             resource.close()
@@ -66,12 +124,14 @@ class NTBSetup:
 class NTBResource:
 
     def __init__(self, visa_name, config_message_list,
-                 read_termination='\n', write_termination='\n'):
+                 read_termination='\n', write_termination='\n',
+                 max_message_length=256):
 
         self.name = visa_name
         self.config = config_message_list
         self.read_termination = read_termination
         self.write_termination = write_termination
+        self.max_message_length = max_message_length
         self.resource = None
         self.open()
 
@@ -84,7 +144,7 @@ class NTBResource:
     def open(self):
         ''' Open instrument with visa interface '''
         logger.debug('Try to open {0}'.format(self.name))
-        rm = visa.ResourceManager()
+        rm = resource_manager_factory()
         self.resource = rm.open_resource(self.name)
         self.resource.read_termination = self.read_termination
         self.resource.write_termination = self.write_termination
@@ -105,13 +165,73 @@ class NTBResource:
     def write(self, message):
         self.resource.write(message)
         
+    def query_block(self, message, dtype='>f8'):
+        '''Query a binary block (e.g. FETC? after FORM:DATA REAL,64) and
+        return it as a NumPy array.  read_raw() may stop at a termination
+        character inside the data, so reading goes on until the length
+        given in the block header has arrived.
+        '''
+        self.resource.write(message)
+        data = self.resource.read_raw()
+        while len(data) < 2 or (data[1:2].isdigit() and
+                                len(data) < 2 + int(data[1:2])):
+            data += self.resource.read_raw()
+        offset, length = parse_block_header(data)
+        while len(data) < offset + length:
+            data += self.resource.read_raw()
+        return np.frombuffer(data[offset:offset + length], dtype)
+
+    def write_raw(self, data):
+        ''' Send pre-encoded bytes including the write termination '''
+        self.resource.write_raw(data)
+
     def read_raw(self):
         return self.resource.read_raw()
 
     def write_multi(self, message_list):
-        ''' Send all messages in a list '''
-        for message in message_list:
-            self.resource.write(message)
+        '''Send all messages in a list, coalesced into as few program
+        messages as possible, and check the error queue once afterwards.
+        The first SYST:ERR? rides along with the last program message, so
+        a short list costs a single round trip.  Queries (e.g. *OPC?) are
+        sent on their own and their responses are read before the error
+        query; they are returned as a list.
+        '''
+        error_query = ';:SYST:ERR?'
+        programs = list(coalesce(message_list,
+                                 self.max_message_length - len(error_query)))
+        replies = []
+        if not programs:
+            return replies
+        for message in programs[:-1]:
+            if '?' in message:
+                replies.append(self.resource.query(message))
+            else:
+                self.resource.write(message)
+        if '?' in programs[-1]:
+            replies.append(self.resource.query(programs[-1]))
+            self.check_errors()
+        else:
+            self.check_errors(
+                self.resource.query(programs[-1] + error_query))
+        return replies
+
+    def check_errors(self, first_error=None, max_errors=20):
+        '''Read the error queue until it is empty, raise SCPIError if not.
+        first_error is an already read SYST:ERR? response.
+        '''
+        errors = []
+        for i in range(max_errors):
+            if first_error is None:
+                error = self.resource.query('SYST:ERR?').strip()
+            else:
+                error = first_error.strip()
+                first_error = None
+            if error.startswith(('+0', '0')):
+                break
+            errors.append(error)
+        if errors:
+            logger.error('{0}: {1}'.format(self.name, errors))
+            raise SCPIError(self.name, errors)
 
 
 class NTBResourceDCLoad:
@@ -0,0 +1,372 @@
+"""
+Title:       Peak-efficiency search over converter parameters
+Description: Finds the converter settings (switching frequency, dead time,
+             phase count, ...) with the best efficiency in few measurements.
+             The settings are applied by a user callback, the efficiency is
+             measured at one or a few load currents, and a quadratic
+             response surface fitted to all measurements so far chooses the
+             next settings within a trust region around the best point.
+Comments:    Parameter file (JSON), "step" rounds a parameter, e.g. to whole
+             phases:
+                 {"parameters": {
+                     "frequency": {"low": 100e3, "high": 500e3},
+                     "dead_time": {"low": 20e-9, "high": 200e-9},
+                     "phases": {"low": 1, "high": 4, "step": 1}},
+                  "currents": [3000, 6000],
+                  "xtol": 0.02, "ftol": 0.0005, "max_evaluations": 30}
+             The callback is a function callback(settings) in a module,
+             given as module:function; settings is a dict of parameter name
+             and value.  The load is off while the callback runs.
+             Load limits and settle time come from the sweep plan.  The load
+             is configured with setMaxVoltage/setMaxPower, in addition a
+             measurement above max_voltage or max_power ends the
+             evaluation and the settings count as not feasible.  Every
+             current step is checked before it is applied: at the last
+             Uout, or at max_voltage before the first measurement, it must
+             stay within max_power.
+             Settings that are not feasible do not count for the fit, the
+             initial design is extended with random points until enough
+             of them are feasible (or max_evaluations is reached).
+             The search stops when the surface predicts no gain of more than
+             ftol within the trust region, when the trust region is smaller
+             than xtol (of the parameter ranges) or after max_evaluations.
+
+Usage:
+    python optimiser.py parameters.json --callback converter:apply
+"""
+
+import argparse
+import importlib
+import json
+import time
+import numpy as np
+import bench
+import sweepplan
+
+
+class Parameter:
+
+    def __init__(self, name, low, high, step=None):
+        if not high > low:
+            raise ValueError('{0}: high must be above low'.format(name))
+        self.name = name
+        self.low = low
+        self.high = high
+        self.step = step
+        # whole-number steps (phase count) are passed to the callback as int
+        self.integer = all(isinstance(v, int) for v in (low, high, step))
+
+    def value(self, unit):
+        ''' Parameter value of a position in -1..1 '''
+        value = self.low + (np.clip(unit, -1, 1) + 1) / 2 * (self.high -
+                                                            self.low)
+        if self.step:
+            value = self.low + np.round((value - self.low) / self.step) * \
+                self.step
+            value = np.minimum(value, self.high)
+        return int(value) if self.integer else float(value)
+
+    def unit(self, value):
+        return 2 * (value - self.low) / (self.high - self.low) - 1
+
+
+def quadratic_terms(x):
+    ''' 1, x_i and x_i * x_j (i <= j) of the rows of x '''
+    x = np.atleast_2d(x)
+    i, j = np.triu_indices(x.shape[1])
+    return np.hstack((np.ones((len(x), 1)), x, x[:, i] * x[:, j]))
+
+
+class QuadraticSurface:
+
+    def __init__(self, x, y):
+        self.coefficients = np.linalg.lstsq(quadratic_terms(x), y,
+                                            rcond=None)[0]
+
+    def predict(self, x):
+        return quadratic_terms(x) @ self.coefficients
+
+    def stationary_point(self, dimensions):
+        ''' Point with zero gradient, None if there is none '''
+        linear = self.coefficients[1:dimensions + 1]
+        hessian = np.zeros((dimensions, dimensions))
+        i, j = np.triu_indices(dimensions)
+        hessian[i, j] += self.coefficients[dimensions + 1:]
+        hessian = hessian + hessian.T
+        try:
+            return np.linalg.solve(hessian, -linear)
+        except np.linalg.LinAlgError:
+            return None
+
+
+class Optimiser:
+    '''Trust-region search with a quadratic response surface.  evaluate is
+    called with a settings dict and returns the efficiency, or None if the
+    settings are not feasible.
+    '''
+
+    def __init__(self, parameters, evaluate, xtol=0.02, ftol=0.0005,
+                 max_evaluations=30, radius=0.5, candidates=2000, seed=0):
+        self.parameters = list(parameters)
+        self.evaluate = evaluate
+        self.xtol = xtol
+        self.ftol = ftol
+        self.max_evaluations = max_evaluations
+        self.radius = radius
+        self.candidates = candidates
+        self.random = np.random.default_rng(seed)
+        self.x = []                 # positions in -1..1
+        self.y = []                 # efficiency, None if not feasible
+        self.settings = []
+        self.converged = False
+
+    @property
+    def dimensions(self):
+        return len(self.parameters)
+
+    def snap(self, unit):
+        ''' Settings and the position of a point after rounding '''
+        settings = {p.name: p.value(u)
+                    for p, u in zip(self.parameters, unit)}
+        return settings, np.array([p.unit(settings[p.name])
+                                   for p in self.parameters])
+
+    def known(self, settings):
+        return settings in self.settings
+
+    def measure(self, settings, unit):
+        efficiency = self.evaluate(settings)
+        self.settings.append(settings)
+        self.x.append(unit)
+        self.y.append(efficiency)
+        return efficiency
+
+    def feasible(self):
+        index = [i for i, y in enumerate(self.y) if y is not None]
+        return np.array([self.x[i] for i in index]), \
+            np.array([self.y[i] for i in index])
+
+    def best(self):
+        ''' (settings, efficiency) of the best feasible measurement '''
+        x, y = self.feasible()
+        if not len(y):
+            return None, None
+        i = [k for k, e in enumerate(self.y) if e is not None][np.argmax(y)]
+        return self.settings[i], self.y[i]
+
+    @property
+    def needed(self):
+        ''' Feasible points needed to fit the surface, one to spare '''
+        return quadratic_terms(np.zeros(self.dimensions)).shape[1] + 1
+
+    def initial_design(self):
+        ''' Centre, axial points and random points to fit the surface '''
+        points = [np.zeros(self.dimensions)]
+        for axis in range(self.dimensions):
+            for sign in (-1, 1):
+                point = np.zeros(self.dimensions)
+                point[axis] = sign * self.radius
+                points.append(point)
+        attempts = 0
+        design = []
+        while points or (len(design) < self.needed and
+                         attempts < 100 * self.needed):
+            if points:
+                point = points.pop(0)
+            else:
+                point = self.random.uniform(-1, 1, self.dimensions)
+                attempts += 1
+            settings, unit = self.snap(point)
+            if settings not in [s for s, u in design]:
+                design.append((settings, unit))
+        return design
+
+    def extend_design(self, report=None):
+        '''Measure random points until enough are feasible for the surface,
+        within max_evaluations.
+        '''
+        attempts = 0
+        while (len(self.feasible()[1]) < self.needed and
+               len(self.y) < self.max_evaluations and
+               attempts < 100 * self.needed):
+            attempts += 1
+            settings, unit = self.snap(
+                self.random.uniform(-1, 1, self.dimensions))
+            if self.known(settings):
+                continue
+            efficiency = self.measure(settings, unit)
+            if report:
+                report(settings, efficiency, None)
+
+    def propose(self, x, y):
+        '''Next point within the trust region around the best feasible
+        point, with its predicted gain, None if all candidates are known.
+        '''
+        surface = QuadraticSurface(x, y)
+        centre = x[np.argmax(y)]
+        candidates = centre + self.radius * self.random.uniform(
+            -1, 1, (self.candidates, self.dimensions))
+        stationary = surface.stationary_point(self.dimensions)
+        if stationary is not None and \
+                np.all(np.abs(stationary - centre) <= self.radius):
+            candidates = np.vstack((stationary, candidates))
+        candidates = np.clip(candidates, -1, 1)
+        predicted = surface.predict(candidates)
+        for i in np.argsort(-predicted):
+            settings, unit = self.snap(candidates[i])
+            if not self.known(settings):
+                return settings, unit, \
+                    float(surface.predict(unit)[0] - y.max())
+        return None
+
+    def run(self, report=None):
+        ''' Search until converged, return (best settings, efficiency) '''
+        for settings, unit in self.initial_design():
+            if len(self.y) >= self.max_evaluations:
+                break
+            efficiency = self.measure(settings, unit)
+            if report:
+                report(settings, efficiency, None)
+        self.extend_design(report)
+
+        while len(self.y) < self.max_evaluations:
+            x, y = self.feasible()
+            if len(y) < quadratic_terms(np.zeros(self.dimensions)).shape[1]:
+                break               # too few feasible points for a surface
+            proposal = self.propose(x, y)
+            if proposal is None:
+                self.radius /= 2
+            else:
+                settings, unit, gain = proposal
+                if gain < self.ftol:
+                    self.converged = True
+                    break
+                efficiency = self.measure(settings, unit)
+                if report:
+                    report(settings, efficiency, gain)
+                ratio = (efficiency - y.max()) / gain \
+                    if efficiency is not None else -1
+                if ratio < 0.25:
+                    self.radius /= 2
+                elif ratio > 0.75:
+                    self.radius = min(2 * self.radius, 2.0)
+            if self.radius < self.xtol:
+                self.converged = True
+                break
+        return self.best()
+
+
+def bench_objective(test_bench, callback, currents, settle_time, max_voltage,
+                    max_power, ramp_step=1000):
+    '''evaluate function for Optimiser: apply the settings with the load
+    off, measure the efficiency at the currents (mA) and return the mean,
+    None if a limit is exceeded.  Measured rows are kept in rows.
+    '''
+    load = test_bench.load
+    rows = []
+
+    def evaluate(settings):
+        load.turnLoadOff()
+        callback(settings)
+        measured = []
+        try:
+            for current in currents:
+                # check the step before it is applied: at the last Uout, at
+                # max_voltage as the worst case before the first measurement
+                uout = measured[-1][3] if measured else max_voltage
+                if uout * current / 1000 > max_power:
+                    return None
+                load.setCCCurrent(current)
+                if not measured:
+                    load.turnLoadOn()
+                time.sleep(settle_time)
+                values = test_bench.measure()
+                measured.append(values)
+                rows.append((settings, current, values))
+                if values[3] > max_voltage or values[5] > max_power:
+                    return None
+        finally:
+            test_bench.ramp_down(ramp_step)
+            load.turnLoadOff()
+        return float(np.mean([values[-1] for values in measured]))
+
+    evaluate.rows = rows
+    return evaluate
+
+
+def load_parameters(filename):
+    with open(filename) as f:
+        spec = json.load(f)
+    parameters = [Parameter(name, p['low'], p['high'], p.get('step'))
+                  for name, p in spec['parameters'].items()]
+    return parameters, spec
+
+
+def load_callback(name):
+    ''' The function of "module:function" '''
+    module, _, function = name.partition(':')
+    if not function:
+        raise ValueError('Callback must be given as module:function')
+    return getattr(importlib.import_module(module), function)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak-efficiency search')
+    parser.add_argument('parameters')
+    parser.add_argument('--callback', required=True,
+                        help='module:function that applies the settings')
+    parser.add_argument('--plan', default='sweep_plan.json')
+    parser.add_argument('--current', type=int, action='append',
+                        help='load current in mA (default from parameters)')
+    parser.add_argument('--max-evaluations', type=int)
+    parser.add_argument('logfile', nargs='?',
+                        default=time.strftime("%Y%m%d-%H%M%S") + ".opt")
+    args = parser.parse_args()
+
+    parameters, spec = load_parameters(args.parameters)
+    callback = load_callback(args.callback)
+    plan = sweepplan.compile_plan(args.plan)
+    currents = args.current or spec.get('currents') or [plan.end_current]
+    names = [p.name for p in parameters]
+
+    test_bench = bench.default_bench()
+    test_bench.open()
+    try:
+        test_bench.configure_load(plan.max_voltage, plan.max_power, 'cc')
+        evaluate = bench_objective(test_bench, callback, currents,
+                                   plan.settle_time, plan.max_voltage,
+                                   plan.max_power)
+        optimiser = Optimiser(
+            parameters, evaluate, spec.get('xtol', 0.02),
+            spec.get('ftol', 0.0005),
+            args.max_evaluations or spec.get('max_evaluations', 30))
+        with open(args.logfile, 'w') as logdata:
+            print('Time', *names, 'n[]', 'predicted_gain', file=logdata)
+
+            def report(settings, efficiency, gain):
+                res_time = time.strftime('%H:%M:%S')
+                print(res_time, *(settings[n] for n in names),
+                      efficiency if efficiency is not None else 'limit',
+                      gain if gain is not None else '-', file=logdata)
+                print('{0},{1},n={2}'.format(
+                    res_time, ','.join('{0}={1:g}'.format(n, settings[n])
+                                       for n in names),
+                    'limit exceeded' if efficiency is None
+                    else '{0:1.4f}'.format(efficiency)))
+
+            settings, efficiency = optimiser.run(report)
+    finally:
+        print("turn off load and set local control")
+        test_bench.close()
+
+    if settings is None:
+        print('No feasible settings found')
+    else:
+        print('{0} after {1} measurements: {2}, n={3:1.4f}'.format(
+            'Optimum' if optimiser.converged else 'Best',
+            len(optimiser.y), ', '.join('{0}={1:g}'.format(n, settings[n])
+                                        for n in names), efficiency))
+
+
+if __name__ == '__main__':
+    main()
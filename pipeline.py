@@ -0,0 +1,204 @@
+"""
+Title:       Pipelined sweep executor
+Description: Overlaps the read-out of one point with the settling of the
+             next.  As soon as the meters have captured point k (INIT, then
+             *OPC? returns) the load is set to point k+1, and the readings
+             of point k are fetched from the meters' memory while the load
+             settles.  The meters are the channels of a
+             channels.ChannelRegistry, waited for and fetched in parallel.
+Comments:    Sample attribution is checked twice:
+             - every capture gets a sequence number; the readings are only
+               fetched while no newer INIT was sent, otherwise the meters
+               would return the samples of the next point
+             - optionally the load current measured by one of the meters has
+               to match the setpoint of the capture it is attributed to
+             After an overload the load goes back to the point, which is
+             measured again without pipelining on the largest range, at
+             most max_remeasure times before the point fails.
+             When a sweep fails (or is interrupted) the load is ramped down
+             to the start current and turned off before the error is
+             passed on, it is never left at the failing point.
+"""
+
+import logging
+import time
+import dcload
+import rangeschedule
+
+logger = logging.getLogger(__name__)
+
+
+class AttributionError(dcload.InstrumentException):
+    ''' Readings do not belong to the setpoint they would be stored for '''
+    pass
+
+
+class Capture:
+    ''' A point whose samples are in the meters' memory '''
+
+    def __init__(self, sequence, setpoint, packet):
+        self.sequence = sequence
+        self.setpoint = setpoint
+        self.packet = packet
+        self.captured_at = None
+
+
+class PipelinedSweep:
+    '''Runs a CompiledPlan on the open channels of registry.  ranging has
+    the schedulers in channel order, check_channel is the name of the
+    calibrated channel (or derived value) that measures the load current in
+    A, None to skip the plausibility check.
+    '''
+
+    def __init__(self, plan, load, registry, ranging=None, latency=None,
+                 check_channel=None, tolerance=0.05, tolerance_abs=0.02,
+                 max_remeasure=2):
+        self.plan = plan
+        self.load = load
+        self.registry = registry
+        self.ranging = ranging
+        self.latency = latency
+        self.check_channel = check_channel
+        self.tolerance = tolerance
+        self.tolerance_abs = tolerance_abs
+        self.max_remeasure = max_remeasure
+        self.sequence = 0           # number of the last INIT sent
+        self.load_setpoint = None
+        self.settle_time = plan.settle_time
+
+    def timed(self, key, function, *args):
+        if self.latency is None:
+            return function(*args)
+        return self.latency.timed(key, function, *args)
+
+    def set_load(self, setpoint, packet):
+        self.timed('load_set', self.load.sendPrepared, packet,
+                   "Set CC current")
+        self.load_setpoint = setpoint
+
+    def capture(self, setpoint, packet):
+        ''' Trigger all meters and wait until the samples are taken '''
+        if self.load_setpoint != setpoint:
+            raise AttributionError('Load is at {0} mA, not {1} mA'.format(
+                self.load_setpoint, setpoint))
+        self.sequence += 1
+        point = Capture(self.sequence, setpoint, packet)
+        self.timed('arm', self.registry.trigger, self.plan.arm)
+        self.registry.wait()
+        point.captured_at = time.monotonic()
+        return point
+
+    def fetch(self, point):
+        if point.captured_at is None or point.sequence != self.sequence:
+            raise AttributionError(
+                'Samples of {0} mA were overwritten by a later trigger'
+                .format(point.setpoint))
+        readings = self.timed('fetch_all', self.registry.fetch,
+                              self.plan.fetch)
+        if self.ranging is None or not self.ranging.record_all(
+                point.setpoint, readings):
+            return readings
+        return None
+
+    def remeasure(self, point):
+        '''Measure a point again after an overload, without overlap.  Raise
+        OverloadError if it still overloads after max_remeasure attempts.
+        '''
+        readings = None
+        for attempt in range(self.max_remeasure):
+            logger.info('Measure {0} mA again'.format(point.setpoint))
+            self.set_load(point.setpoint, point.packet)
+            settled = time.monotonic() + self.settle_time
+            self.ranging.program_all(point.setpoint)
+            time.sleep(max(0, settled - time.monotonic()))
+            readings = self.fetch(self.capture(point.setpoint, point.packet))
+            if readings is not None:
+                return readings
+        raise rangeschedule.OverloadError(
+            'Overload at {0} mA after {1} attempts'.format(
+                point.setpoint, self.max_remeasure))
+
+    def check(self, point, readings):
+        if self.check_channel is None:
+            return
+        ranges = None if self.ranging is None else self.ranging.ranges()
+        measured = float(self.registry.evaluate(readings, ranges)[
+            self.check_channel])
+        expected = point.setpoint / 1000
+        if abs(measured - expected) > max(self.tolerance * abs(expected),
+                                          self.tolerance_abs):
+            raise AttributionError(
+                'Readings of {0} mA show a load current of {1:.4f} A'
+                .format(point.setpoint, measured))
+
+    def complete(self, point, on_point):
+        '''Fetch and hand over the readings of a captured point.  Return
+        True if the load had to leave the present setpoint.
+        '''
+        readings = self.fetch(point)
+        moved = readings is None
+        if moved:
+            readings = self.remeasure(point)
+        self.check(point, readings)
+        on_point(point.setpoint, readings)
+        return moved
+
+    def stop(self, step_time=0.1):
+        ''' Ramp the load down to the start current and turn it off '''
+        logger.warning('Sweep stopped at {0} mA, ramping down'.format(
+            self.load_setpoint))
+        try:
+            current = self.load_setpoint
+            while (current is not None and
+                   current - self.plan.step_size >= self.plan.start_current):
+                current -= self.plan.step_size
+                self.load.setCCCurrent(current)
+                time.sleep(step_time)
+        finally:
+            self.load.turnLoadOff()
+            self.load_setpoint = None
+
+    def run(self, on_point, points=None, settle_time=None):
+        '''Measure points, (setpoint, packet) pairs, by default the
+        points of the plan.  on_point(setpoint in mA, readings) is called
+        once per point, in order.  On an error the load is stopped, see
+        stop(), and the error raised again.
+        '''
+        if points is None:
+            points = self.plan.points()
+        if settle_time is None:
+            settle_time = self.plan.settle_time
+        self.settle_time = settle_time
+        pending = None
+        try:
+            for setpoint, packet in points:
+                self.set_load(setpoint, packet)
+                settled = time.monotonic() + settle_time
+                if pending is not None:
+                    # read out the previous point while this one settles
+                    point, pending = pending, None
+                    if self.complete(point, on_point):
+                        self.set_load(setpoint, packet)
+                        settled = time.monotonic() + settle_time
+                if self.ranging is not None:
+                    self.ranging.program_all(setpoint)
+                time.sleep(max(0, settled - time.monotonic()))
+                pending = self.capture(setpoint, packet)
+            if pending is not None:
+                point, pending = pending, None
+                self.complete(point, on_point)
+        except BaseException:
+            try:
+                if pending is not None:
+                    # interrupted: keep the captured point if it can be read
+                    try:
+                        self.complete(pending, on_point)
+                    except Exception:
+                        logger.warning('Readings of {0} mA lost'.format(
+                            pending.setpoint), exc_info=True)
+            finally:
+                try:
+                    self.stop()
+                except Exception:
+                    logger.exception('Load could not be stopped')
+            raise
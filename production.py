@@ -0,0 +1,200 @@
+"""
+Title:       Production pass/fail test against a golden curve
+Description: End-of-line test: the efficiency of a board is compared with a
+             golden curve and its tolerance band point by point, right after
+             each measurement.  The first point outside the band fails the
+             board and the load is ramped down at once.
+Comments:    The golden curve is made from archived Just_Efficiency runs of
+             good boards (mean of the runs, band of +-tolerance or
+             +-sigma standard deviations if that is wider).  Its points are
+             ordered by how often the other archived runs of the same DUT
+             were outside the band there, so the points that reject most
+             boards are measured first.
+
+Usage:
+    python production.py golden 12 13 14 --tolerance 0.01 --output golden.json
+    python production.py test golden.json --serial SN0042
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+import bench
+import runarchive
+
+
+class GoldenCurve:
+
+    def __init__(self, setpoints, efficiency, lower, upper, order=None,
+                 settle_time=2, source=None):
+        self.setpoints = np.asarray(setpoints, dtype=float)
+        self.efficiency = np.asarray(efficiency, dtype=float)
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+        if order is None:
+            order = range(len(self.setpoints))
+        self.order = [int(i) for i in order]
+        self.settle_time = settle_time
+        self.source = source
+
+    def limits(self, setpoints):
+        ''' (lower, upper) band at any setpoints in mA, interpolated '''
+        return (np.interp(setpoints, self.setpoints, self.lower),
+                np.interp(setpoints, self.setpoints, self.upper))
+
+    def outside(self, setpoints, efficiency):
+        ''' Boolean array, True where efficiency is outside the band '''
+        lower, upper = self.limits(setpoints)
+        efficiency = np.asarray(efficiency, dtype=float)
+        return (efficiency < lower) | (efficiency > upper)
+
+    def test_points(self):
+        ''' Setpoints in mA in measuring order '''
+        return [int(self.setpoints[i]) for i in self.order]
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'setpoints': self.setpoints.tolist(),
+                       'efficiency': self.efficiency.tolist(),
+                       'lower': self.lower.tolist(),
+                       'upper': self.upper.tolist(),
+                       'order': self.order, 'settle_time': self.settle_time,
+                       'source': self.source}, f, indent=4)
+
+
+def load_golden(filename):
+    with open(filename) as f:
+        return GoldenCurve(**json.load(f))
+
+
+def run_curve(archive, run_id):
+    ''' (setpoints in mA, efficiency) of an archived run, sorted '''
+    rows = archive.run_points(run_id)
+    if not rows:
+        raise ValueError('Run {0} has no points'.format(run_id))
+    # older imports have no setpoint, the output current is close to it
+    setpoints = np.array([row[3] if row[3] is not None else
+                          round(row[8] * 1000) for row in rows], dtype=float)
+    efficiency = np.array([row[10] for row in rows], dtype=float)
+    order = np.argsort(setpoints, kind='stable')
+    return setpoints[order], efficiency[order]
+
+
+def make_golden(archive, run_ids, tolerance=0.01, sigma=3, settle_time=2):
+    '''Golden curve from good runs, points ordered by the rejection rate
+    among the other archived runs of the same DUT.
+    '''
+    curves = [run_curve(archive, run_id) for run_id in run_ids]
+    setpoints = np.unique(np.concatenate([c[0] for c in curves]))
+    matrix = np.array([np.interp(setpoints, s, e) for s, e in curves])
+    mean = matrix.mean(axis=0)
+    spread = (sigma * matrix.std(axis=0, ddof=1) if len(curves) > 1
+              else np.zeros_like(mean))
+    band = np.maximum(tolerance, spread)
+    golden = GoldenCurve(setpoints, mean, mean - band, mean + band,
+                         settle_time=settle_time,
+                         source='runs ' + ','.join(str(r) for r in run_ids))
+
+    duts = {row[0] for row in archive.db.execute(
+        'SELECT DISTINCT dut FROM runs WHERE id IN ({0})'.format(
+            ','.join('?' * len(run_ids))), list(run_ids))}
+    others = [row[0] for row in archive.db.execute(
+        'SELECT id FROM runs WHERE dut IN ({0})'.format(
+            ','.join('?' * len(duts))), list(duts))
+        if row[0] not in run_ids]
+    if others:
+        rejected = np.zeros(len(setpoints))
+        for run_id in others:
+            s, e = run_curve(archive, run_id)
+            covered = (setpoints >= s[0]) & (setpoints <= s[-1])
+            rejected += covered & golden.outside(setpoints,
+                                                 np.interp(setpoints, s, e))
+        # most rejections first, then the narrowest band
+        golden.order = np.lexsort((band, -rejected)).tolist()
+    else:
+        golden.order = np.argsort(band, kind='stable').tolist()
+    return golden
+
+
+def run_test(test_bench, golden, ramp_step=1000):
+    '''Measure the golden points in order and stop at the first failure.
+    Return (passed, rows) with rows of (setpoint, efficiency, lower,
+    upper) of the measured points.  The load is configured by the caller.
+    '''
+    load = test_bench.load
+    rows = []
+    passed = True
+    points = golden.test_points()
+    lower, upper = (limit.tolist() for limit in golden.limits(points))
+    load.setCCCurrent(points[0])
+    load.turnLoadOn()
+    try:
+        for setpoint, low, high in zip(points, lower, upper):
+            load.setCCCurrent(setpoint)
+            time.sleep(golden.settle_time)
+            eff = test_bench.measure()[-1]
+            rows.append((setpoint, eff, low, high))
+            if not low <= eff <= high:
+                passed = False
+                break
+    finally:
+        test_bench.ramp_down(ramp_step)
+        load.turnLoadOff()
+    return passed, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Production pass/fail test')
+    parser.add_argument('--archive', default=runarchive.DEFAULT_ARCHIVE)
+    commands = parser.add_subparsers(dest='command')
+    gold = commands.add_parser('golden', help='golden curve from good runs')
+    gold.add_argument('runs', type=int, nargs='+')
+    gold.add_argument('--tolerance', type=float, default=0.01,
+                      help='minimum half width of the band')
+    gold.add_argument('--sigma', type=float, default=3)
+    gold.add_argument('--settle-time', type=float, default=2)
+    gold.add_argument('--output', default='golden.json')
+    test = commands.add_parser('test', help='test one board')
+    test.add_argument('golden')
+    test.add_argument('--serial', default='')
+    test.add_argument('--max-voltage', type=float, default=15)
+    test.add_argument('--max-power', type=float, default=300)
+    test.add_argument('--log', default='production.log')
+    args = parser.parse_args()
+
+    if args.command == 'golden':
+        archive = runarchive.RunArchive(args.archive)
+        golden = make_golden(archive, args.runs, args.tolerance, args.sigma,
+                             args.settle_time)
+        archive.close()
+        golden.save(args.output)
+        print('{0} points, order {1}'.format(len(golden.order),
+                                             golden.test_points()))
+    elif args.command == 'test':
+        golden = load_golden(args.golden)
+        test_bench = bench.default_bench()
+        test_bench.open()
+        start = time.time()
+        try:
+            test_bench.configure_load(args.max_voltage, args.max_power, 'cc')
+            passed, rows = run_test(test_bench, golden)
+        finally:
+            test_bench.close()
+        duration = time.time() - start
+        result = 'PASS' if passed else 'FAIL'
+        detail = '' if passed else \
+            ' at {0} mA: n={1:1.4f} not in {2:1.4f}..{3:1.4f}'.format(
+                *rows[-1])
+        print('{0} {1}{2} ({3} points, {4:.1f} s)'.format(
+            args.serial, result, detail, len(rows), duration))
+        with open(args.log, 'a') as f:
+            print(time.strftime('%Y-%m-%d %H:%M:%S'), args.serial, result,
+                  len(rows), '{0:.1f}'.format(duration), detail.strip(),
+                  file=f)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Title:       Predictive DMM range and integration time scheduling
+Description: Predicts the reading of each meter at the next sweep point from
+             the previous points and selects the smallest fixed range (and
+             the NPLC) that fits.  The changes are written while the load
+             settles, so they cost no extra time and avoid the relay delays
+             of autorange.
+Comments:    Readings above the range (9.9E37) are reported by record(); the
+             channel then falls back to its largest range and the point has
+             to be measured again.  An overload on the largest range raises
+             OverloadError, there is nothing left to switch to.
+"""
+
+import logging
+import dcload
+
+logger = logging.getLogger(__name__)
+
+# DC ranges of the bench meters
+VOLT_RANGES = (0.1, 1, 10, 100, 1000)
+# The 10 A range uses its own input terminal on the meters, only add lower
+# ranges if a meter is wired to the 3 A terminal.
+CURR_RANGES = (10,)
+
+OVERLOAD = 9.9e37   # Value returned by the meters for an overload
+
+
+class OverloadError(dcload.InstrumentException):
+    ''' A reading is above the largest range of its meter '''
+    pass
+
+
+def overloaded(reading):
+    return abs(reading) >= OVERLOAD
+
+
+class RangeScheduler:
+    ''' Range and NPLC selection for one meter '''
+
+    def __init__(self, resource, function, ranges, initial_range,
+                 headroom=1.2, nplc=1, nplc_low_signal=10,
+                 line_frequency=50, max_integration_time=0.2):
+        self.resource = resource
+        self.function = function            # 'VOLT' or 'CURR'
+        self.ranges = sorted(ranges)
+        self.headroom = headroom            # margin above predicted reading
+        self.nplc = nplc
+        self.nplc_low_signal = min(nplc_low_signal,
+                                   max_integration_time * line_frequency)
+        self.range = initial_range          # as programmed by the config
+        self.active_nplc = None             # unknown until programmed
+        self.setpoints = []
+        self.readings = []
+
+    def predict(self, setpoint):
+        ''' Extrapolate the reading at setpoint from the last two points '''
+        if not self.readings:
+            return None
+        if len(self.readings) == 1 or self.setpoints[-1] == self.setpoints[-2]:
+            return self.readings[-1]
+        slope = ((self.readings[-1] - self.readings[-2]) /
+                 (self.setpoints[-1] - self.setpoints[-2]))
+        return self.readings[-1] + slope * (setpoint - self.setpoints[-1])
+
+    def select(self, setpoint):
+        ''' Return (range, nplc) for the next point '''
+        predicted = self.predict(setpoint)
+        if predicted is None:
+            return self.range, self.nplc
+        expected = abs(predicted) * self.headroom
+        new_range = self.ranges[-1]
+        for candidate in self.ranges:
+            if expected <= candidate:
+                new_range = candidate
+                break
+        nplc = self.nplc
+        if abs(predicted) < 0.1 * new_range:
+            nplc = self.nplc_low_signal
+        return new_range, nplc
+
+    def schedule(self, setpoint):
+        ''' SCPI commands needed before measuring at setpoint '''
+        new_range, nplc = self.select(setpoint)
+        commands = []
+        if new_range != self.range:
+            commands.append('SENS:{0}:DC:RANG {1}'.format(self.function,
+                                                         new_range))
+            self.range = new_range
+        if nplc != self.active_nplc:
+            commands.append('SENS:{0}:DC:NPLC {1}'.format(self.function,
+                                                         nplc))
+            self.active_nplc = nplc
+        return commands
+
+    def program(self, setpoint):
+        commands = self.schedule(setpoint)
+        if commands:
+            logger.debug('{0}: {1}'.format(self.resource.name, commands))
+            self.resource.write_multi(commands)
+
+    def record(self, setpoint, reading):
+        '''Store a reading for the prediction.  Return True if it was an
+        overload, the meter is then switched to its largest range.  Raise
+        OverloadError if it already was on the largest range.
+        '''
+        if overloaded(reading):
+            logger.warning('{0}: overload on range {1}'
+                           .format(self.resource.name, self.range))
+            self.setpoints = []
+            self.readings = []
+            if self.range == self.ranges[-1]:
+                raise OverloadError('{0}: overload at {1} on the largest '
+                                    'range {2}'.format(self.resource.name,
+                                                       setpoint, self.range))
+            self.resource.write_multi(['SENS:{0}:DC:RANG {1}'.format(
+                self.function, self.ranges[-1])])
+            self.range = self.ranges[-1]
+            return True
+        self.setpoints.append(setpoint)
+        self.readings.append(reading)
+        del self.setpoints[:-2]
+        del self.readings[:-2]
+        return False
+
+
+class RangeSetup:
+    '''Range schedulers of all meters in a setup, None for a meter that
+    stays on its configured range.
+    '''
+
+    def __init__(self, scheduler_list):
+        self.scheduler_list = scheduler_list
+
+    def program_all(self, setpoint):
+        for scheduler in self.scheduler_list:
+            if scheduler is not None:
+                scheduler.program(setpoint)
+
+    def record_all(self, setpoint, readings):
+        '''Return True if any of the readings was an overload, raise
+        OverloadError if a meter overloads on its largest range.
+        '''
+        overload = False
+        for scheduler, reading in zip(self.scheduler_list, readings):
+            if scheduler is not None:
+                overload |= scheduler.record(setpoint, reading)
+        return overload
+
+    def ranges(self):
+        ''' Present range of each meter, None if it is not scheduled '''
+        return [None if scheduler is None else scheduler.range
+                for scheduler in self.scheduler_list]
@@ -0,0 +1,99 @@
+"""
+Title:       Background writer for measurement results
+Description: Formats result records and writes them to the log file and the
+             console in a separate thread, so the sweep loop only appends a
+             tuple and goes on with the next setpoint.
+Comments:    The records are passed in a collections.deque; append() and
+             popleft() are atomic, so the queue needs no lock.  File rows are
+             written in batches, the console shows at most one row per
+             console_interval; a row held back is shown when the interval
+             is over, also if no new rows arrive.  close() drains
+             everything that was queued, also after a KeyboardInterrupt.
+             If writing fails the thread stops and the error is raised
+             again by the next put() or by close().
+"""
+
+import collections
+import sys
+import threading
+import time
+
+FILE_FORMAT = '{0} {1} {2} {3} {4} {5} {6} {7}'
+CONSOLE_FORMAT = ("{0},Uin={1:2.3f}V,Iin={2:1.3f}A,Pin={3:3.3f}W,"
+                  "Uout={4:2.3f}V,Iout={5:2.3f}A,Pout={6:3.3f}W,n={7:1.4f}")
+
+
+class ResultWriter:
+
+    def __init__(self, logdata, file_format=FILE_FORMAT,
+                 console_format=CONSOLE_FORMAT, console=sys.stdout,
+                 console_interval=0.5, flush_interval=0.2):
+        self.logdata = logdata
+        self.file_format = file_format
+        self.console_format = console_format
+        self.console = console
+        self.console_interval = console_interval
+        self.flush_interval = flush_interval
+        self.records = collections.deque()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.written = 0
+        self.next_console = 0
+        self.pending_console = None
+        self.error = None           # exception that stopped the thread
+        self.thread = threading.Thread(target=self.run, name='ResultWriter',
+                                       daemon=True)
+        self.thread.start()
+
+    def put(self, record):
+        ''' Queue one record (tuple of format arguments) '''
+        if self.error is not None:
+            raise self.error
+        self.records.append(record)
+
+    def run(self):
+        try:
+            while not self.stopping:
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
+                self.write_pending()
+            self.write_pending()
+            if self.pending_console is not None:
+                self.show(self.pending_console)
+        except Exception as e:
+            self.error = e
+
+    def write_pending(self):
+        batch = []
+        while self.records:
+            batch.append(self.records.popleft())
+        if batch:
+            self.logdata.write(''.join(self.file_format.format(*record) +
+                                       '\n' for record in batch))
+            self.logdata.flush()
+            self.written += len(batch)
+            self.pending_console = batch[-1]
+        now = time.monotonic()
+        if self.pending_console is not None and now >= self.next_console:
+            self.show(self.pending_console)
+            self.next_console = now + self.console_interval
+
+    def show(self, record):
+        print(self.console_format.format(*record), file=self.console)
+        self.pending_console = None
+
+    def close(self):
+        '''Write all queued records and stop the thread.  Raise the error
+        that stopped the thread, if any.
+        '''
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,287 @@
+"""
+Title:       Run archive
+Description: Indexed SQLite store for the results of Just_Efficiency runs
+             together with their metadata (DUT, revision, bench, shunt gains,
+             sweep plan).  Existing text logs can be imported.
+Comments:    The database runs in WAL mode so that queries can be made while
+             a run is being stored.  Points are inserted in one transaction
+             per run.  Raw meter readings, their ranges and the calibration
+             are kept, so a run can be recalibrated later.
+
+Usage:
+    python runarchive.py import logs/ --dut ladder3to1 --revision B
+    python runarchive.py peak
+    python runarchive.py at 5 --last 100
+    python runarchive.py recalibrate 12 calibration.json
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+import calibration
+
+DEFAULT_ARCHIVE = 'runs.sqlite'
+
+# Columns of the text log written by Just_Efficiency, in file order
+LOG_COLUMNS = ('time', 'uin', 'iin', 'pin', 'uout', 'iout', 'pout', 'eff')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    source TEXT UNIQUE,
+    dut TEXT,
+    revision TEXT,
+    bench TEXT,
+    shunt_gain_iin REAL,
+    shunt_gain_iout REAL,
+    plan TEXT,
+    calibration TEXT
+);
+CREATE TABLE IF NOT EXISTS points (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    idx INTEGER NOT NULL,
+    time TEXT,
+    setpoint REAL,
+    uin REAL, iin REAL, pin REAL,
+    uout REAL, iout REAL, pout REAL,
+    eff REAL,
+    PRIMARY KEY (run_id, idx)
+);
+CREATE TABLE IF NOT EXISTS raw_points (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    idx INTEGER NOT NULL,
+    uin REAL, uout REAL, iin REAL, iout REAL,
+    uin_range REAL, uout_range REAL, iin_range REAL, iout_range REAL,
+    temperature REAL,
+    PRIMARY KEY (run_id, idx)
+);
+CREATE INDEX IF NOT EXISTS runs_dut ON runs(dut, revision);
+CREATE INDEX IF NOT EXISTS runs_started ON runs(started);
+CREATE INDEX IF NOT EXISTS points_iout ON points(iout, run_id);
+'''
+
+
+def read_log(filename):
+    ''' Return the rows of a Just_Efficiency text log as lists of values '''
+    rows = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) != len(LOG_COLUMNS):
+                continue
+            try:
+                rows.append([fields[0]] + [float(x) for x in fields[1:]])
+            except ValueError:
+                continue            # header line
+    return rows
+
+
+def log_start_time(filename):
+    ''' Start time from a timestamp file name, else the modification time '''
+    name = os.path.splitext(os.path.basename(filename))[0]
+    try:
+        started = time.strptime(name, '%Y%m%d-%H%M%S')
+    except ValueError:
+        started = time.localtime(os.path.getmtime(filename))
+    return time.strftime('%Y-%m-%d %H:%M:%S', started)
+
+
+class RunArchive:
+
+    def __init__(self, filename=DEFAULT_ARCHIVE):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(runs)')]
+        if 'calibration' not in columns:        # archive of an older version
+            self.db.execute('ALTER TABLE runs ADD COLUMN calibration TEXT')
+
+    def close(self):
+        self.db.close()
+
+    def add_run(self, rows, started=None, source=None, dut=None,
+                revision=None, bench=None, shunt_gain_iin=None,
+                shunt_gain_iout=None, plan=None, setpoints=None, raw=None,
+                calibration=None):
+        '''Store one run.  rows are [time, uin, iin, pin, uout, iout, pout,
+        eff] as in the text log, setpoints the load currents in mA if
+        known.  raw are [uin, uout, iin, iout, uin_range, uout_range,
+        iin_range, iout_range, temperature] per row, calibration the
+        Calibration (or its JSON) the rows were made with.  Return the run
+        id.
+        '''
+        if started is None:
+            started = time.strftime('%Y-%m-%d %H:%M:%S')
+        if plan is not None and not isinstance(plan, str):
+            plan = json.dumps(plan, sort_keys=True)
+        setpoints = list(setpoints or [])
+        setpoints += [None] * (len(rows) - len(setpoints))
+        if calibration is not None and not isinstance(calibration, str):
+            calibration = calibration.dumps()
+        with self.db:
+            run_id = self.db.execute(
+                'INSERT INTO runs (started, source, dut, revision, bench, '
+                'shunt_gain_iin, shunt_gain_iout, plan, calibration) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (started, source, dut, revision, bench, shunt_gain_iin,
+                 shunt_gain_iout, plan, calibration)).lastrowid
+            self.db.executemany(
+                'INSERT INTO points VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ([run_id, i, row[0], setpoint] + list(row[1:])
+                 for i, (row, setpoint) in enumerate(zip(rows, setpoints))))
+            if raw is not None:
+                self.db.executemany(
+                    'INSERT INTO raw_points VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ([run_id, i] + list(row) for i, row in enumerate(raw)))
+        return run_id
+
+    def import_log(self, filename, **metadata):
+        '''Import a text log, return the run id or None if the file was
+        imported before.
+        '''
+        source = os.path.abspath(filename)
+        if self.db.execute('SELECT 1 FROM runs WHERE source = ?',
+                           (source,)).fetchone():
+            return None
+        metadata.setdefault('started', log_start_time(filename))
+        return self.add_run(read_log(filename), source=source, **metadata)
+
+    def import_directory(self, path, pattern='.txt', **metadata):
+        ''' Import all logs below path, return the number of new runs '''
+        count = 0
+        for root, dirs, files in os.walk(path):
+            for name in sorted(files):
+                if name.endswith(pattern):
+                    if self.import_log(os.path.join(root, name),
+                                       **metadata) is not None:
+                        count += 1
+        return count
+
+    def peak_efficiency(self):
+        ''' Rows of (dut, revision, runs, peak efficiency) '''
+        return self.db.execute(
+            'SELECT r.dut, r.revision, COUNT(DISTINCT r.id), MAX(p.eff) '
+            'FROM runs r JOIN points p ON p.run_id = r.id '
+            'GROUP BY r.dut, r.revision ORDER BY r.dut, r.revision'
+        ).fetchall()
+
+    def efficiency_at(self, iout, last=100, tolerance=0.05):
+        '''Rows of (run id, started, dut, revision, Iout, efficiency) for
+        points within tolerance (in A) of iout in the last runs.
+        '''
+        return self.db.execute(
+            'SELECT r.id, r.started, r.dut, r.revision, p.iout, p.eff '
+            'FROM points p JOIN runs r ON p.run_id = r.id '
+            'WHERE p.iout BETWEEN ? AND ? AND r.id IN '
+            '(SELECT id FROM runs ORDER BY started DESC LIMIT ?) '
+            'ORDER BY r.started DESC',
+            (iout - tolerance, iout + tolerance, last)).fetchall()
+
+    def recalibrate(self, run_id, new_calibration, temperature=None):
+        '''Store a run again with the values calculated from its raw
+        readings with new_calibration, return the new run id.  temperature
+        replaces the stored temperatures if given.
+        '''
+        run = self.db.execute(
+            'SELECT started, dut, revision, bench, plan FROM runs '
+            'WHERE id = ?', (run_id,)).fetchone()
+        raw = self.db.execute(
+            'SELECT p.time, p.setpoint, r.uin, r.uout, r.iin, r.iout, '
+            'r.uin_range, r.uout_range, r.iin_range, r.iout_range, '
+            'r.temperature FROM raw_points r JOIN points p '
+            'ON p.run_id = r.run_id AND p.idx = r.idx '
+            'WHERE r.run_id = ? ORDER BY r.idx', (run_id,)).fetchall()
+        if run is None or not raw:
+            raise ValueError('No raw readings stored for run {0}'.format(
+                run_id))
+        readings = [row[2:6] for row in raw]
+        ranges = [[stored_range(x) for x in row[6:10]] for row in raw]
+        if temperature is None and all(row[10] is not None for row in raw):
+            temperature = [row[10] for row in raw]
+        values = new_calibration.evaluate(readings, ranges, temperature)
+        rows = [[row[0]] + list(v) for row, v in zip(raw, values.tolist())]
+        prefix = 'recalibrated:{0}:'.format(run_id)
+        count = self.db.execute('SELECT COUNT(*) FROM runs WHERE source '
+                                'LIKE ?', (prefix + '%',)).fetchone()[0]
+        return self.add_run(
+            rows, started=run[0], source=prefix + str(count + 1),
+            dut=run[1], revision=run[2], bench=run[3], plan=run[4],
+            setpoints=[row[1] for row in raw],
+            raw=[row[2:] for row in raw], calibration=new_calibration)
+
+    def run_points(self, run_id):
+        return self.db.execute(
+            'SELECT * FROM points WHERE run_id = ? ORDER BY idx',
+            (run_id,)).fetchall()
+
+
+def stored_range(value):
+    ''' Range as stored, NaN (no table) if it was not recorded '''
+    return float('nan') if value is None else value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Efficiency run archive')
+    parser.add_argument('--archive', default=DEFAULT_ARCHIVE)
+    commands = parser.add_subparsers(dest='command')
+    imp = commands.add_parser('import', help='import text logs')
+    imp.add_argument('paths', nargs='+')
+    imp.add_argument('--dut')
+    imp.add_argument('--revision')
+    imp.add_argument('--bench')
+    commands.add_parser('peak', help='peak efficiency per DUT revision')
+    at = commands.add_parser('at', help='efficiency at an output current')
+    at.add_argument('iout', type=float, help='output current in A')
+    at.add_argument('--last', type=int, default=100)
+    at.add_argument('--tolerance', type=float, default=0.05)
+    recal = commands.add_parser('recalibrate',
+                                help='store a run again with a new calibration')
+    recal.add_argument('run', type=int)
+    recal.add_argument('calibration', help='calibration file')
+    recal.add_argument('--temperature', type=float)
+    args = parser.parse_args()
+
+    archive = RunArchive(args.archive)
+    if args.command == 'import':
+        metadata = {'dut': args.dut, 'revision': args.revision,
+                    'bench': args.bench}
+        count = 0
+        for path in args.paths:
+            if os.path.isdir(path):
+                count += archive.import_directory(path, **metadata)
+            elif archive.import_log(path, **metadata) is not None:
+                count += 1
+        print('{0} runs imported'.format(count))
+    elif args.command == 'peak':
+        rows = archive.peak_efficiency()
+        if not rows:
+            print('no points')
+        for dut, revision, runs, peak in rows:
+            if peak is None:
+                print('{0} {1} runs={2} no points'.format(dut, revision, runs))
+            else:
+                print('{0} {1} runs={2} n_max={3:1.4f}'.format(
+                    dut, revision, runs, peak))
+    elif args.command == 'at':
+        for row in archive.efficiency_at(args.iout, args.last,
+                                         args.tolerance):
+            print('{0} {1} {2} {3} Iout={4:2.3f}A n={5:1.4f}'.format(*row))
+    elif args.command == 'recalibrate':
+        run_id = archive.recalibrate(
+            args.run, calibration.load_calibration(args.calibration),
+            args.temperature)
+        print('stored as run {0}'.format(run_id))
+    else:
+        parser.print_help()
+    archive.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Title:       Soak / long-duration test
+Description: Holds a load current (or cycles a profile) for hours or days
+             and samples the efficiency at a fixed rate.  Full-rate samples
+             go to a binary file, the console only gets a status line every
+             few seconds and the statistics use fixed memory.
+Comments:    The profile file is a JSON list of [current in mA, duration in
+             s] steps that is repeated until the end of the test.  The
+             downsampled history is written to <output>.summary.json.
+
+Usage:
+    python soaktest.py --current 5000 --hours 72 --interval 0.1
+    python soaktest.py --profile burnin.json --hours 72
+"""
+
+import argparse
+import itertools
+import json
+import time
+import bench
+import streamstats
+
+# Columns of the binary sample file
+SAMPLE_COLUMNS = ('t', 'setpoint') + bench.COLUMNS
+
+# Values with rolling statistics on the console
+CONSOLE_COLUMNS = ('pin', 'pout', 'eff')
+
+
+class SoakStats:
+    ''' Running, rolling and downsampled statistics of all columns '''
+
+    def __init__(self, window):
+        self.running = {c: streamstats.RunningStats() for c in bench.COLUMNS}
+        self.rolling = {c: streamstats.RollingStats(window)
+                        for c in bench.COLUMNS}
+        self.history = {c: streamstats.Downsampler() for c in bench.COLUMNS}
+
+    def add(self, timestamp, values):
+        for column, value in zip(bench.COLUMNS, values):
+            self.running[column].add(value)
+            self.rolling[column].add(value)
+            self.history[column].add(timestamp, value)
+
+    def status(self):
+        return ' '.join(
+            '{0}={1:.4f}({2:.4f}..{3:.4f},sd={4:.2g})'.format(
+                c, self.rolling[c].mean, self.rolling[c].min,
+                self.rolling[c].max, self.rolling[c].stddev)
+            for c in CONSOLE_COLUMNS)
+
+    def summary(self):
+        return {c: {'count': self.running[c].count,
+                    'mean': self.running[c].mean,
+                    'stddev': self.running[c].stddev,
+                    'min': self.running[c].min,
+                    'max': self.running[c].max,
+                    'history': [self.history[c].buckets(level)
+                                for level in range(len(
+                                    self.history[c].levels))]}
+                for c in bench.COLUMNS}
+
+
+def load_profile(filename):
+    with open(filename) as f:
+        profile = json.load(f)
+    if not profile or any(len(step) != 2 or step[1] <= 0
+                          for step in profile):
+        raise ValueError('{0}: expected [[mA, s], ...]'.format(filename))
+    return [(int(current), float(duration)) for current, duration in profile]
+
+
+def run(test_bench, profile, duration, interval, output,
+        console_interval=10, window=600, flush_interval=10):
+    '''Run the soak test, return the SoakStats.  The load has to be
+    configured, the first profile current is set before the load is on.
+    '''
+    load = test_bench.load
+    sink = streamstats.SampleSink(output, SAMPLE_COLUMNS)
+    stats = SoakStats(window)
+    steps = itertools.cycle(profile)
+    setpoint, step_time = next(steps)
+    load.setCCCurrent(setpoint)
+    load.turnLoadOn()
+
+    # intervals on the monotonic clock, the samples get wall clock times
+    start = time.monotonic()
+    wall_start = time.time()
+    step_end = start + step_time
+    next_console = start + console_interval
+    next_flush = start + flush_interval
+    sample = 0
+    try:
+        while True:
+            now = time.monotonic()
+            if now - start >= duration:
+                break
+            if now >= step_end and len(profile) > 1:
+                setpoint, step_time = next(steps)
+                load.setCCCurrent(setpoint)
+                step_end = now + step_time
+
+            values = test_bench.measure()
+            timestamp = time.monotonic()
+            sink.write((wall_start + timestamp - start, setpoint) + values)
+            stats.add(timestamp - start, values)
+
+            if timestamp >= next_console:
+                print('{0} I={1}mA {2}'.format(time.strftime('%H:%M:%S'),
+                                               setpoint, stats.status()))
+                next_console += console_interval
+            if timestamp >= next_flush:
+                sink.flush()
+                next_flush += flush_interval
+
+            # sample on a fixed grid, late samples are skipped not queued
+            sample = max(sample + 1,
+                         int((time.monotonic() - start) / interval))
+            delay = start + sample * interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    except KeyboardInterrupt:
+        print('Aborted')
+    finally:
+        sink.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak / burn-in test')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--current', type=int, help='load current in mA')
+    group.add_argument('--profile', help='JSON list of [mA, s] steps')
+    parser.add_argument('--hours', type=float, default=72)
+    parser.add_argument('--interval', type=float, default=0.1,
+                        help='sample interval in s')
+    parser.add_argument('--console-interval', type=float, default=10)
+    parser.add_argument('--max-voltage', type=float, default=15)
+    parser.add_argument('--max-power', type=float, default=300)
+    parser.add_argument('--output',
+                        default=time.strftime("%Y%m%d-%H%M%S") + ".soak")
+    args = parser.parse_args()
+
+    if args.profile:
+        profile = load_profile(args.profile)
+    else:
+        profile = [(args.current, args.hours * 3600)]
+
+    test_bench = bench.default_bench()
+    test_bench.open()
+    try:
+        test_bench.configure_load(args.max_voltage, args.max_power, 'cc')
+        stats = run(test_bench, profile, args.hours * 3600, args.interval,
+                    args.output, args.console_interval)
+        with open(args.output + '.summary.json', 'w') as f:
+            json.dump(stats.summary(), f)
+        print("Ramp down current")
+        test_bench.ramp_down(1000)
+    finally:
+        print("turn off load and set local control")
+        test_bench.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Title:       Fixed-memory aggregators for long sample streams
+Description: Running and rolling statistics, multi-resolution downsampling
+             and a binary disk sink for full-rate data.  Memory use does not
+             grow with the number of samples.
+Comments:    RollingStats keeps the window sums and monotonic deques for
+             min/max, so add() is O(1) amortized.
+"""
+
+import collections
+import math
+import struct
+import numpy as np
+
+
+class RunningStats:
+    ''' Count, mean, stddev, min and max since the start (Welford) '''
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class RollingStats:
+    ''' Mean, stddev, min and max of the last window samples '''
+
+    def __init__(self, window):
+        self.window = window
+        self.values = collections.deque()
+        self.total = 0.0            # sums of value - shift, the shift
+        self.total_sq = 0.0         # avoids cancellation in the variance
+        self.shift = None
+        self.index = 0
+        self.min_queue = collections.deque()    # (index, value), increasing
+        self.max_queue = collections.deque()    # (index, value), decreasing
+
+    def add(self, value):
+        if self.shift is None:
+            self.shift = value
+        self.values.append(value)
+        shifted = value - self.shift
+        self.total += shifted
+        self.total_sq += shifted * shifted
+        if len(self.values) > self.window:
+            old = self.values.popleft() - self.shift
+            self.total -= old
+            self.total_sq -= old * old
+        while self.min_queue and self.min_queue[-1][1] >= value:
+            self.min_queue.pop()
+        self.min_queue.append((self.index, value))
+        while self.max_queue and self.max_queue[-1][1] <= value:
+            self.max_queue.pop()
+        self.max_queue.append((self.index, value))
+        first = self.index - self.window + 1
+        if self.min_queue[0][0] < first:
+            self.min_queue.popleft()
+        if self.max_queue[0][0] < first:
+            self.max_queue.popleft()
+        self.index += 1
+        if self.index % self.window == 0:
+            # recompute the sums once per window to stop rounding drift
+            self.shift = self.values[-1]
+            self.total = math.fsum(v - self.shift for v in self.values)
+            self.total_sq = math.fsum((v - self.shift) ** 2
+                                      for v in self.values)
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    @property
+    def mean(self):
+        if not self.values:
+            return 0.0
+        return self.shift + self.total / len(self.values)
+
+    @property
+    def stddev(self):
+        n = len(self.values)
+        if n < 2:
+            return 0.0
+        variance = (self.total_sq - self.total * self.total / n) / (n - 1)
+        return math.sqrt(max(variance, 0.0))
+
+    @property
+    def min(self):
+        return self.min_queue[0][1] if self.min_queue else math.nan
+
+    @property
+    def max(self):
+        return self.max_queue[0][1] if self.max_queue else math.nan
+
+
+class Downsampler:
+    '''Buckets of (start time, mean, min, max) at several resolutions.
+    levels is a list of (bucket length in s, number of buckets kept).
+    '''
+
+    def __init__(self, levels=((1, 3600), (60, 1440), (3600, 168))):
+        self.levels = [(period, collections.deque(maxlen=capacity))
+                       for period, capacity in levels]
+        self.current = [None] * len(self.levels)
+
+    def add(self, timestamp, value):
+        for i, (period, buckets) in enumerate(self.levels):
+            start = timestamp - timestamp % period
+            bucket = self.current[i]
+            if bucket is None or bucket[0] != start:
+                if bucket is not None:
+                    buckets.append(self.close_bucket(bucket))
+                bucket = self.current[i] = [start, 0, 0.0, value, value]
+            bucket[1] += 1
+            bucket[2] += value
+            bucket[3] = min(bucket[3], value)
+            bucket[4] = max(bucket[4], value)
+
+    def close_bucket(self, bucket):
+        start, count, total, low, high = bucket
+        return start, total / count, low, high
+
+    def buckets(self, level):
+        ''' Closed buckets of a level plus the one being filled '''
+        result = list(self.levels[level][1])
+        if self.current[level] is not None:
+            result.append(self.close_bucket(self.current[level]))
+        return result
+
+
+class SampleSink:
+    ''' Appends fixed-size float64 records to a binary file '''
+
+    def __init__(self, filename, columns, buffer_size=1 << 20):
+        self.columns = columns
+        self.record = struct.Struct('<{0}d'.format(len(columns)))
+        self.file = open(filename, 'ab', buffering=buffer_size)
+
+    def write(self, values):
+        self.file.write(self.record.pack(*values))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_samples(filename, columns):
+    ''' Read a SampleSink file as an (n, len(columns)) array '''
+    data = np.fromfile(filename, dtype='<f8')
+    return data[:len(data) - len(data) % len(columns)].reshape(-1,
+                                                                len(columns))
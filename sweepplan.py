@@ -0,0 +1,206 @@
+"""
+Title:       Compiled sweep plans
+Description: Loads a declarative sweep plan (JSON, or YAML if PyYAML is
+             installed), validates it once and pre-encodes every DC-load
+             packet and SCPI string, so the measurement loop only sends
+             ready-made buffers.
+Comments:    Currents are in mA like the rest of the scripts.  Runtime is
+             estimated from latencies recorded by LatencyRecorder in earlier
+             runs.  With "bidirectional" the points are measured again on
+             the way down (without the top point), after turnaround_time at
+             the top and with down_settle_time (default settle_time).
+
+Example plan (sweep_plan.json):
+    {
+        "sweep": {"start_current": 1000, "end_current": 9000,
+                  "step_size": 1000, "settle_time": 2},
+        "load":  {"max_voltage": 15, "max_power": 300},
+        "scpi":  {"arm": "INIT", "fetch": "FETC?"}
+    }
+"""
+
+import json
+import logging
+import os
+import time
+import dcload
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+logger = logging.getLogger(__name__)
+
+# Defaults for keys that may be omitted in a plan file
+PLAN_DEFAULTS = {
+    'sweep': {'settle_time': 2, 'bidirectional': False,
+              'down_settle_time': None, 'turnaround_time': 0},
+    'load': {'max_voltage': 15, 'max_power': 300},
+    'scpi': {'arm': 'INIT', 'fetch': 'FETC?', 'write_termination': '\n'},
+}
+
+
+class PlanError(Exception):
+    pass
+
+
+def load_plan(filename):
+    ''' Read a plan file and fill in the defaults '''
+    with open(filename) as f:
+        if os.path.splitext(filename)[1].lower() in ('.yaml', '.yml'):
+            if yaml is None:
+                raise PlanError('PyYAML is needed to read ' + filename)
+            plan = yaml.safe_load(f)
+        else:
+            plan = json.load(f)
+    return load_plan_dict(plan, filename)
+
+
+def load_plan_dict(plan, source='plan'):
+    ''' Copy of a plan dict with the defaults filled in '''
+    if not isinstance(plan, dict) or 'sweep' not in plan:
+        raise PlanError('{0}: plan needs a "sweep" section'.format(source))
+    plan = dict(plan)
+    for section, defaults in PLAN_DEFAULTS.items():
+        values = dict(defaults)
+        values.update(plan.get(section) or {})
+        plan[section] = values
+    return plan
+
+
+def validate_plan(plan):
+    ''' Check a plan once so that the measurement loop does not have to '''
+    sweep = plan['sweep']
+    for key in ('start_current', 'end_current', 'step_size', 'settle_time'):
+        if key not in sweep:
+            raise PlanError('sweep.{0} missing'.format(key))
+        if not isinstance(sweep[key], (int, float)) or sweep[key] < 0:
+            raise PlanError('sweep.{0} must be a number >= 0'.format(key))
+    for key in ('start_current', 'end_current', 'step_size'):
+        if int(sweep[key]) != sweep[key]:
+            raise PlanError('sweep.{0} must be a whole number of mA'
+                            .format(key))
+    for key in ('down_settle_time', 'turnaround_time'):
+        if sweep[key] is not None and (
+                not isinstance(sweep[key], (int, float)) or sweep[key] < 0):
+            raise PlanError('sweep.{0} must be a number >= 0'.format(key))
+    if sweep['step_size'] == 0:
+        raise PlanError('sweep.step_size must not be 0')
+    if sweep['end_current'] < sweep['start_current']:
+        raise PlanError('sweep.end_current is below sweep.start_current')
+    for key in ('max_voltage', 'max_power'):
+        if plan['load'][key] <= 0:
+            raise PlanError('load.{0} must be > 0'.format(key))
+    max_counts = 0xffffffff
+    if (sweep['end_current'] + sweep['step_size']) * \
+            dcload.InstrumentInterface.convert_current > max_counts:
+        raise PlanError('sweep.end_current out of range')
+
+
+class CompiledPlan:
+
+    def __init__(self, plan, address=0):
+        validate_plan(plan)
+        self.plan = plan
+        sweep = plan['sweep']
+        self.start_current = int(sweep['start_current'])
+        self.end_current = int(sweep['end_current'])
+        self.step_size = int(sweep['step_size'])
+        self.settle_time = sweep['settle_time']
+        self.bidirectional = bool(sweep['bidirectional'])
+        self.down_settle_time = sweep['down_settle_time']
+        if self.down_settle_time is None:
+            self.down_settle_time = self.settle_time
+        self.turnaround_time = sweep['turnaround_time'] or 0
+        self.max_voltage = plan['load']['max_voltage']
+        self.max_power = plan['load']['max_power']
+        self.currents = list(range(self.start_current,
+                                   self.end_current + self.step_size,
+                                   self.step_size))
+
+        # Build every packet once, getCommand() also checks it
+        encoder = dcload.DCLoad()
+        encoder.address = address
+        self.load_packets = [
+            encoder.getCommand(0x2A, current * encoder.convert_current,
+                               num_bytes=4)
+            for current in self.currents]
+
+        termination = plan['scpi']['write_termination']
+        self.arm = (plan['scpi']['arm'] + termination).encode('ascii')
+        self.fetch = plan['scpi']['fetch']
+
+    def __len__(self):
+        return len(self.currents) + len(self.down_currents())
+
+    def points(self):
+        ''' Iterate over (current in mA, ready-made load packet) '''
+        return zip(self.currents, self.load_packets)
+
+    def down_currents(self):
+        ''' Currents of the down ramp, empty if not bidirectional '''
+        if not self.bidirectional:
+            return []
+        return self.currents[-2::-1]
+
+    def down_points(self):
+        ''' (current, packet) of the down ramp, highest first '''
+        return zip(self.down_currents(), self.load_packets[-2::-1])
+
+    def estimate_runtime(self, latencies, meters=4, pipelined=False):
+        '''Estimated sweep duration in s.  latencies are in s: 'load_set'
+        per packet, 'arm' for all meters together, 'fetch' per meter or
+        'fetch_all' for all meters fetched in parallel.  With pipelined the
+        fetch overlaps the settle time.
+        '''
+        fetch = latencies.get('fetch_all', meters * latencies.get('fetch', 0))
+        overhead = latencies.get('load_set', 0) + latencies.get('arm', 0)
+        if pipelined:
+            up = max(self.settle_time, fetch)
+            down = max(self.down_settle_time, fetch)
+        else:
+            up = self.settle_time + fetch
+            down = self.down_settle_time + fetch
+        down_points = len(self.down_currents())
+        return (len(self.currents) * (up + overhead) +
+                down_points * (down + overhead) +
+                (self.turnaround_time if down_points else 0))
+
+
+def compile_plan(filename, address=0):
+    ''' Load, validate and compile a plan file '''
+    return CompiledPlan(load_plan(filename), address)
+
+
+class LatencyRecorder:
+    ''' Keeps running means of operation latencies across runs '''
+
+    def __init__(self, filename='latencies.json'):
+        self.filename = filename
+        self.latencies = {}
+        self.counts = {}
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                stored = json.load(f)
+            self.latencies = stored.get('latencies', {})
+            self.counts = stored.get('counts', {})
+
+    def record(self, key, seconds):
+        n = self.counts.get(key, 0)
+        mean = self.latencies.get(key, 0.0)
+        self.latencies[key] = mean + (seconds - mean) / (n + 1)
+        self.counts[key] = n + 1
+
+    def timed(self, key, function, *args):
+        ''' Call function(*args), record its duration and return its result '''
+        start = time.perf_counter()
+        result = function(*args)
+        self.record(key, time.perf_counter() - start)
+        return result
+
+    def save(self):
+        with open(self.filename, 'w') as f:
+            json.dump({'latencies': self.latencies, 'counts': self.counts},
+                      f, indent=4, sort_keys=True)
+        logger.debug('Latencies saved to {0}'.format(self.filename))
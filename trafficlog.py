@@ -0,0 +1,357 @@
+"""
+Title:       Record and replay of raw instrument traffic
+Description: Records every byte written to and read from the DC-load serial
+             ports and every VISA write, query and response into a compact
+             binary trace with monotonic timestamps.  A trace can be fed back
+             to dcload and ntbvisa instead of the instruments, at full speed
+             or with the original timing.
+Comments:    Recording and replay hook into dcload.port_factory and
+             ntbvisa.resource_manager_factory, so the scripts run unchanged:
+
+                 recorder = trafficlog.Recorder('run.trace')
+                 trafficlog.install_recorder(recorder)
+                 ...                         # run as usual
+                 recorder.close()
+
+                 trafficlog.install_replay(trafficlog.Trace('run.trace'))
+                 ...                         # same calls, no hardware
+
+             In replay, every write is compared with the recorded one and a
+             ReplayMismatch is raised at the first difference.
+
+File format: 8 byte magic, then records of
+             <float64 time> <uint8 channel> <uint8 kind> <uint32 length> data
+             A NAME record maps a channel number to the port or VISA name.
+"""
+
+import argparse
+import struct
+import threading
+import time
+import dcload
+import ntbvisa
+
+MAGIC = b'NTBTRC01'
+RECORD = struct.Struct('<dBBI')
+
+# Record kinds
+WRITE = 0       # bytes written to the instrument
+READ = 1        # bytes read from the instrument
+FLUSH = 2       # input buffer flushed
+QUERY = 3       # VISA query, followed by a READ with the response
+CLOSE = 4
+NAME = 255      # channel name
+
+KIND_NAMES = {WRITE: 'write', READ: 'read', FLUSH: 'flush', QUERY: 'query',
+              CLOSE: 'close', NAME: 'name'}
+
+
+class ReplayMismatch(dcload.InstrumentException):
+    pass
+
+
+class Recorder:
+    ''' Writes a binary trace, can be shared by several threads '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.start = time.monotonic()
+
+    def channel(self, name):
+        ''' Channel number of a port or VISA name '''
+        with self.lock:
+            if name not in self.channels:
+                number = len(self.channels)
+                if number > 0xff:
+                    raise ValueError('Too many channels in trace')
+                self.channels[name] = number
+                self._write(number, NAME, name.encode('utf-8'))
+            return self.channels[name]
+
+    def record(self, channel, kind, data=b''):
+        with self.lock:
+            self._write(channel, kind, data)
+
+    def _write(self, channel, kind, data):
+        self.file.write(RECORD.pack(time.monotonic() - self.start,
+                                    channel, kind, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class RecordingSerial:
+    ''' Wraps a serial port and records its traffic '''
+
+    def __init__(self, port, recorder, channel):
+        self.port = port
+        self.recorder = recorder
+        self.channel = channel
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def __setattr__(self, name, value):
+        if name in ('port', 'recorder', 'channel'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.port, name, value)
+
+    def write(self, data):
+        self.recorder.record(self.channel, WRITE, bytes(data))
+        return self.port.write(data)
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        self.recorder.record(self.channel, READ, data)
+        return data
+
+    def reset_input_buffer(self):
+        self.recorder.record(self.channel, FLUSH)
+        self.port.reset_input_buffer()
+
+    def close(self):
+        self.recorder.record(self.channel, CLOSE)
+        self.port.close()
+
+
+class RecordingResource:
+    ''' Wraps a VISA resource and records its traffic '''
+
+    def __init__(self, resource, recorder, channel):
+        self.resource = resource
+        self.recorder = recorder
+        self.channel = channel
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def __setattr__(self, name, value):
+        if name in ('resource', 'recorder', 'channel'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.resource, name, value)
+
+    def write(self, message):
+        self.recorder.record(self.channel, WRITE, message.encode('ascii'))
+        return self.resource.write(message)
+
+    def write_raw(self, data):
+        self.recorder.record(self.channel, WRITE, bytes(data))
+        return self.resource.write_raw(data)
+
+    def query(self, message):
+        self.recorder.record(self.channel, QUERY, message.encode('ascii'))
+        response = self.resource.query(message)
+        self.recorder.record(self.channel, READ, response.encode('ascii'))
+        return response
+
+    def query_ascii_values(self, message):
+        return parse_values(self.query(message))
+
+    def read_raw(self):
+        data = self.resource.read_raw()
+        self.recorder.record(self.channel, READ, data)
+        return data
+
+    def close(self):
+        self.recorder.record(self.channel, CLOSE)
+        self.resource.close()
+
+
+class RecordingResourceManager:
+
+    def __init__(self, rm, recorder):
+        self.rm = rm
+        self.recorder = recorder
+
+    def list_resources(self):
+        return self.rm.list_resources()
+
+    def open_resource(self, name):
+        return RecordingResource(self.rm.open_resource(name), self.recorder,
+                                 self.recorder.channel(name))
+
+
+def parse_values(response):
+    ''' Same result as query_ascii_values() with the default converter '''
+    return [float(value) for value in response.split(',') if value.strip()]
+
+
+class Trace:
+    ''' A recorded trace, split into one list of records per channel '''
+
+    def __init__(self, filename):
+        self.names = {}
+        self.records = {}
+        self.players = {}
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('{0} is not a traffic trace'.format(filename))
+        position = len(MAGIC)
+        while position < len(data):
+            timestamp, channel, kind, length = RECORD.unpack_from(data,
+                                                                  position)
+            position += RECORD.size
+            payload = data[position:position + length]
+            position += length
+            if kind == NAME:
+                self.names[payload.decode('utf-8')] = channel
+                self.records[channel] = []
+            else:
+                self.records[channel].append((timestamp, kind, payload))
+
+    def player(self, name, realtime=False, start=None):
+        '''Player of a channel.  A reopened port or resource gets the same
+        player, so the replay goes on where the previous one was closed.
+        '''
+        if name not in self.names:
+            raise ReplayMismatch('{0} not in trace'.format(name))
+        if name not in self.players:
+            self.players[name] = Player(name, self.records[self.names[name]],
+                                        realtime, start)
+        return self.players[name]
+
+
+class Player:
+    ''' Hands out the records of one channel in order '''
+
+    def __init__(self, name, records, realtime=False, start=None):
+        self.name = name
+        self.records = records
+        self.position = 0
+        self.realtime = realtime
+        self.start = time.monotonic() if start is None else start
+
+    def next(self, kind, data=None):
+        '''Return the payload of the next record, which must be of the
+        given kind (and carry data if given).
+        '''
+        if self.position >= len(self.records):
+            raise ReplayMismatch('{0}: end of trace'.format(self.name))
+        timestamp, recorded_kind, payload = self.records[self.position]
+        if recorded_kind != kind or (data is not None and data != payload):
+            raise ReplayMismatch(
+                '{0}: record {1} is {2} {3!r}, got {4} {5!r}'.format(
+                    self.name, self.position, KIND_NAMES[recorded_kind],
+                    payload, KIND_NAMES[kind], data))
+        self.position += 1
+        if self.realtime:
+            delay = self.start + timestamp - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return payload
+
+
+class ReplaySerial:
+    ''' Serial port stand-in that plays back a trace '''
+
+    def __init__(self, player):
+        self.player = player
+        self.timeout = None
+
+    def write(self, data):
+        self.player.next(WRITE, bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        return self.player.next(READ)
+
+    def reset_input_buffer(self):
+        self.player.next(FLUSH)
+
+    def close(self):
+        self.player.next(CLOSE)
+
+
+class ReplayResource:
+    ''' VISA resource stand-in that plays back a trace '''
+
+    def __init__(self, player):
+        self.player = player
+        self.read_termination = None
+        self.write_termination = None
+
+    def write(self, message):
+        self.player.next(WRITE, message.encode('ascii'))
+
+    def write_raw(self, data):
+        self.player.next(WRITE, bytes(data))
+
+    def query(self, message):
+        self.player.next(QUERY, message.encode('ascii'))
+        return self.player.next(READ).decode('ascii')
+
+    def query_ascii_values(self, message):
+        return parse_values(self.query(message))
+
+    def read_raw(self):
+        return self.player.next(READ)
+
+    def close(self):
+        self.player.next(CLOSE)
+
+
+class ReplayResourceManager:
+
+    def __init__(self, trace, realtime=False, start=None):
+        self.trace = trace
+        self.realtime = realtime
+        self.start = start
+
+    def list_resources(self):
+        return tuple(self.trace.names)
+
+    def open_resource(self, name):
+        return ReplayResource(self.trace.player(name, self.realtime,
+                                                self.start))
+
+
+def install_recorder(recorder):
+    ''' Record the traffic of all ports and resources opened from now on '''
+    open_port = dcload.port_factory
+    rm_factory = ntbvisa.resource_manager_factory
+
+    def recording_port(com_port, *args, **kwargs):
+        return RecordingSerial(open_port(com_port, *args, **kwargs),
+                               recorder, recorder.channel(str(com_port)))
+
+    dcload.port_factory = recording_port
+    ntbvisa.resource_manager_factory = (
+        lambda: RecordingResourceManager(rm_factory(), recorder))
+
+
+def install_replay(trace, realtime=False):
+    '''Serve all ports and resources opened from now on from trace.  With
+    realtime the original timing is reproduced, else it runs at full speed.
+    '''
+    start = time.monotonic()
+    dcload.port_factory = (
+        lambda com_port, *args, **kwargs:
+        ReplaySerial(trace.player(str(com_port), realtime, start)))
+    ntbvisa.resource_manager_factory = (
+        lambda: ReplayResourceManager(trace, realtime, start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print a traffic trace')
+    parser.add_argument('trace')
+    args = parser.parse_args()
+    trace = Trace(args.trace)
+    for name, channel in sorted(trace.names.items(), key=lambda x: x[1]):
+        records = trace.records[channel]
+        print('{0}: {1} records'.format(name, len(records)))
+        for timestamp, kind, payload in records:
+            print('  {0:10.6f} {1:6s} {2!r}'.format(timestamp,
+                                                   KIND_NAMES[kind], payload))
+
+
+if __name__ == '__main__':
+    main()
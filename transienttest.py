@@ -0,0 +1,253 @@
+"""
+Title:       Load-step (transient) response capture
+Description: Runs the DC load in CC transient mode between levels A and B and
+             digitizes Uout and Iout with two DMMs.  The samples are read
+             back as binary blocks, split into steps at the edges of the
+             current and evaluated per step: deviation peak (overshoot or
+             undershoot), settling time and recovery time.
+Comments:    All steps of a capture are evaluated at once with NumPy, so a
+             run can contain thousands of steps.  With trigger 'EXT' both
+             meters are started by the same hardware trigger line; with
+             'BUS' they get *TRG one after the other, which leaves a skew of
+             a few ms between Uout and Iout.
+             A capture has to fit in the reading memory of the meters
+             (MAX_SAMPLES); longer runs are cut to fewer steps.  In the
+             'pulse' (two steps per trigger) and 'toggled' operations the
+             load is triggered on a fixed schedule, so the serial round
+             trips do not add up and the steps stay within the capture.
+
+Usage:
+    python transienttest.py --a 1000 --b 5000 --dwell 0.005 --steps 2000
+"""
+
+import argparse
+import time
+import numpy as np
+import bench
+import dcload
+
+MAX_SAMPLES = 50000     # reading memory of the meters
+
+# Columns of the result file
+STEP_COLUMNS = ('edge[s]', 'Istep[A]', 'Uinitial[V]', 'Ufinal[V]',
+                'Upeak[V]', 'overshoot[%]', 'settling[s]', 'recovery[s]')
+
+
+def digitize_config(function, rang, samples, interval, trigger='BUS'):
+    ''' DMM commands for a timed capture of samples readings '''
+    return ['CONF:{0}:DC {1}'.format(function, rang),
+            'SENS:{0}:DC:NPLC 0.001'.format(function),   #shortest aperture (34465A/70A)
+            'SENS:{0}:DC:ZERO:AUTO OFF'.format(function),
+            'TRIG:SOUR {0}'.format(trigger),
+            'TRIG:DEL 0',
+            'TRIG:COUN 1',
+            'SAMP:SOUR TIM',
+            'SAMP:TIM {0}'.format(interval),
+            'SAMP:COUN {0}'.format(samples),
+            'FORM:DATA REAL,64']
+
+
+def step_time(operation, dwell_a, dwell_b):
+    ''' Time in s per step (edge) of a transient operation '''
+    if operation == 'toggled':
+        return dwell_a          # one trigger and one step every dwell_a
+    return (dwell_a + dwell_b) / 2
+
+
+def sample_count(steps, dwell_a, dwell_b, interval, operation='continuous',
+                 max_samples=MAX_SAMPLES):
+    '''Steps and samples of a capture.  Steps that do not fit in
+    max_samples are dropped (with a message), a capture that cannot hold
+    two steps raises ValueError.
+    '''
+    per_step = step_time(operation, dwell_a, dwell_b)
+    max_steps = int((max_samples - 1) * interval / per_step)
+    if operation == 'pulse':
+        steps += steps % 2          # a pulse is two steps
+        max_steps -= max_steps % 2
+    if max_steps < 2:
+        raise ValueError('Two steps of {0} s do not fit in {1} samples of '
+                         '{2} s'.format(per_step, max_samples, interval))
+    if steps > max_steps:
+        print('{0} steps need {1} samples, the meters hold {2}: measuring '
+              '{3} steps'.format(steps, int(steps * per_step / interval) + 1,
+                                 max_samples, max_steps))
+        steps = max_steps
+    return steps, int(steps * per_step / interval) + 1
+
+
+def find_edges(current, threshold, holdoff):
+    '''Sample indices where current crosses threshold.  Crossings closer
+    than holdoff samples to the previous edge are treated as noise.
+    '''
+    above = current > threshold
+    edges = np.flatnonzero(above[1:] != above[:-1]) + 1
+    if len(edges) < 2:
+        return edges
+    keep = np.ones(len(edges), dtype=bool)
+    keep[1:] = np.diff(edges) >= holdoff
+    return edges[keep]
+
+
+def step_metrics(voltage, current, edges, interval, band, tail=0.1):
+    '''Evaluate every step between consecutive edges in one pass.
+    band is the settling band in V, tail the fraction of a step used for
+    the final value.  Returns a (steps, len(STEP_COLUMNS)) array.
+    '''
+    starts = edges[:-1]
+    ends = edges[1:]
+    lengths = ends - starts
+    width = int(lengths.max())
+    tails = np.maximum((lengths * tail).astype(int), 1)
+
+    # final value: mean of the tail of each step, from the cumulative sum
+    cumulative = np.concatenate(([0.0], np.cumsum(voltage)))
+    final = (cumulative[ends] - cumulative[ends - tails]) / tails
+    initial = np.concatenate(([voltage[:starts[0]].mean()
+                               if starts[0] else voltage[0]], final[:-1]))
+    level = current[ends - 1]
+
+    index = starts[:, None] + np.arange(width)
+    valid = np.arange(width) < lengths[:, None]
+    index = np.where(valid, index, 0)
+    deviation = np.where(valid, voltage[index] - final[:, None], 0.0)
+
+    rows = np.arange(len(starts))
+    peak_index = np.argmax(np.abs(deviation), axis=1)
+    peak = deviation[rows, peak_index]
+    outside = np.abs(deviation) > band
+    settled = np.where(outside.any(axis=1),
+                       width - np.argmax(outside[:, ::-1], axis=1), 0)
+    settled = np.minimum(settled, lengths)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overshoot = np.where(final != 0, 100 * peak / final, 0.0)
+
+    return np.column_stack((starts * interval, level, initial, final,
+                            final + peak, overshoot, settled * interval,
+                            np.maximum(settled - peak_index, 0) * interval))
+
+
+def capture(test_bench, a, b, dwell_a, dwell_b, steps, interval,
+            trigger='BUS', operation='continuous', vrange=100, irange=10):
+    '''Run the load transient and return (Uout, Iout) sample arrays.
+    a and b are in mA, dwell times in s.  See sample_count() for the
+    number of steps.
+    '''
+    load = test_bench.load
+    steps, samples = sample_count(steps, dwell_a, dwell_b, interval,
+                                  operation)
+    test_bench.dmm_uout.write_multi(
+        digitize_config('VOLT', vrange, samples, interval, trigger))
+    test_bench.dmm_iout.write_multi(
+        digitize_config('CURR', irange, samples, interval, trigger))
+
+    for status in (load.setMode('cc'),
+                   load.setTransient('cc', a, dwell_a, b, dwell_b,
+                                     operation),
+                   load.setFunction('transient'),
+                   load.setTriggerSource('bus')):
+        if status:
+            raise dcload.InstrumentException(status)
+
+    test_bench.dmm_uout.write('INIT')
+    test_bench.dmm_iout.write('INIT')
+    load.turnLoadOn()
+    if trigger == 'BUS':
+        test_bench.dmm_uout.write('*TRG')
+        test_bench.dmm_iout.write('*TRG')
+    if operation == 'continuous':
+        load.triggerLoad()
+        time.sleep(samples * interval)
+    else:
+        # software triggers on a fixed schedule, a late trigger does not
+        # delay the following ones
+        period = dwell_a if operation == 'toggled' else dwell_a + dwell_b
+        triggers = steps if operation == 'toggled' else steps // 2
+        start = time.monotonic()
+        late = 0
+        for i in range(triggers):
+            delay = start + i * period - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            late = max(late, -delay)
+            load.triggerLoad()
+        time.sleep(max(0, start + triggers * period - time.monotonic()))
+        if late > period:
+            print('Triggers up to {0:.1f} ms late, use longer dwell times'
+                  .format(late * 1000))
+
+    test_bench.dmm_uout.query('*OPC?')
+    test_bench.dmm_iout.query('*OPC?')
+    voltage = test_bench.dmm_uout.query_block('FETC?')
+    current = test_bench.dmm_iout.query_block('FETC?')
+    load.turnLoadOff()
+    load.setFunction('fixed')
+    n = min(len(voltage), len(current))
+    return voltage[:n], current[:n] * test_bench.shunt_gain_iout
+
+
+def evaluate(voltage, current, a, b, interval, band):
+    ''' Per-step metrics for a capture between a and b (in mA) '''
+    threshold = (a + b) / 2000
+    edges = find_edges(current, threshold, holdoff=5)
+    if len(edges) < 2:
+        return np.empty((0, len(STEP_COLUMNS)))
+    return step_metrics(voltage, current, edges, interval, band)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-step response')
+    parser.add_argument('--a', type=int, required=True,
+                        help='level A in mA')
+    parser.add_argument('--b', type=int, required=True,
+                        help='level B in mA')
+    parser.add_argument('--dwell', type=float, default=0.005,
+                        help='dwell time per level in s')
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--interval', type=float, default=20e-6,
+                        help='sample interval in s')
+    parser.add_argument('--band', type=float, default=0.05,
+                        help='settling band in V')
+    parser.add_argument('--trigger', choices=('BUS', 'EXT'), default='BUS')
+    parser.add_argument('--operation', default='continuous',
+                        choices=('continuous', 'pulse', 'toggled'))
+    parser.add_argument('--max-voltage', type=float, default=15)
+    parser.add_argument('--max-power', type=float, default=300)
+    parser.add_argument('--output',
+                        default=time.strftime("%Y%m%d-%H%M%S") + "_steps.txt")
+    args = parser.parse_args()
+
+    try:
+        steps, samples = sample_count(args.steps, args.dwell, args.dwell,
+                                      args.interval, args.operation)
+    except ValueError as e:
+        parser.error(str(e))
+
+    test_bench = bench.default_bench()
+    test_bench.open()
+    try:
+        test_bench.configure_load(args.max_voltage, args.max_power, 'cc')
+        voltage, current = capture(test_bench, args.a, args.b, args.dwell,
+                                   args.dwell, steps, args.interval,
+                                   args.trigger, args.operation)
+    finally:
+        print("turn off load and set local control")
+        test_bench.close()
+
+    result = evaluate(voltage, current, args.a, args.b, args.interval,
+                      args.band)
+    np.savetxt(args.output, result, header=' '.join(STEP_COLUMNS),
+               comments='')
+    print('{0} steps in {1}'.format(len(result), args.output))
+    threshold = (args.a + args.b) / 2000
+    for step in ('up', 'down'):
+        rows = result[(result[:, 1] > threshold) == (step == 'up')]
+        if len(rows):
+            print('{0}: peak {1:.4f} V, settling {2:.1f} us (max {3:.1f})'
+                  .format(step, np.median(rows[:, 4] - rows[:, 3]),
+                          np.median(rows[:, 6]) * 1e6,
+                          rows[:, 6].max() * 1e6))
+
+
+if __name__ == '__main__':
+    main()